@@ -1,51 +1,21 @@
-import csv
+import argparse
 
-header_mapping = {
-    "deal_id": "Deal",
-    "external_id": "ExternalID",
-    "login": "Login",
-    "dealer": "Dealer",
-    "order_id": "Order",
-    "action": "Action",
-    "entry": "Entry",
-    "digits": "Digits",
-    "digits_currency": "DigitsCurrency",
-    "contract_size": "ContractSize",
-    "symbol": "Symbol",
-    "volume": "Volume",
-    "profit": "Profit",
-    "storage": "Storage",
-    "commission": "Commission",
-    "rate_profit": "RateProfit",
-    "rate_margin": "RateMargin",
-    "expert_id": "ExpertID",
-    "position_id": "PositionID",
-    "comment": "Comment",
-    "profit_raw": "ProfitRaw",
-    "reason": "Reason",
-    "gateway": "Gateway",
-    "price_gateway": "PriceGateway",
-    "fee": "Fee",
-    "value": "Value",
-    "server": "server"
-}
+from account_metrics.csv_converter import SUPERSET_DEAL_COLUMNS as header_mapping, convert_csv
 
 
-def read_and_convert_csv(input_file_path, output_file_path, header_mapping):
-    with open(input_file_path, mode='r') as infile, open(output_file_path, mode='w', newline='') as outfile:
-        csv_reader = csv.DictReader(infile, delimiter=',')
-        fieldnames = [header_mapping.get(field, field)
-                      for field in csv_reader.fieldnames]
-        csv_writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-
-        csv_writer.writeheader()
-        for row in csv_reader:
-            modified_row = {header_mapping.get(
-                key, key): value for key, value in row.items()}
-            csv_writer.writerow(modified_row)
+# Converts a Superset deal export to MT5Deal headers and types, streaming it in chunks
+def read_and_convert_csv(input_file_path, output_file_path, header_mapping, chunksize=100_000, output_format=None, processes=1, limit=None):
+    return convert_csv(input_file_path, output_file_path, header_mapping, chunksize=chunksize, output_format=output_format,
+                       processes=processes, limit=limit or None)
 
 
 if __name__ == "__main__":
-    input_file_path = 'auda_deals_100000.csv'
-    output_file_path = 'modified_auda_deals_100000.csv'
-    read_and_convert_csv(input_file_path, output_file_path, header_mapping)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file_path", nargs="?", default="auda_deals_100000.csv")
+    parser.add_argument("output_file_path", nargs="?", default="modified_auda_deals_100000.csv")
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument("--format", dest="output_format", choices=["csv", "parquet"], help="default: from the output file extension")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None, help="number of rows to convert")
+    args = parser.parse_args()
+    read_and_convert_csv(args.input_file_path, args.output_file_path, header_mapping, args.chunksize, args.output_format, args.processes, args.limit)
@@ -4,6 +4,10 @@ from .account_symbol_metric_by_deal import AccountSymbolMetricByDeal, AccountSym
 from .position_metric_by_deal import PositionMetricByDeal, PositionMetricByDealCalculator
 from .mt5_deal import MT5Deal
 from .mt5_deal_daily import MT5DealDaily
+from .fused_deal_calculator import FusedDealMetricCalculator
+from .streaming_calculator import StreamingDealMetricCalculator
+from .calculator_scheduler import CalculatorScheduler
+from .instrumentation import InstrumentationRegistry
 
 
 from .account_metrics import METRIC_CALCULATORS
@@ -14,4 +18,8 @@ __all__ = [ "AccountMetricDaily", "AccountMetricDailyCalculator",
            "AccountSymbolMetricByDeal","AccountSymbolMetricByDealCalculator", 
            "PositionMetricByDeal", "PositionMetricByDealCalculator", 
            "MT5Deal",
-           "MT5DealDaily"]
\ No newline at end of file
+           "MT5DealDaily",
+           "FusedDealMetricCalculator",
+           "StreamingDealMetricCalculator",
+           "CalculatorScheduler",
+           "InstrumentationRegistry"]
@@ -1,5 +1,5 @@
-import datetime
 from typing import Any, Dict, Type, Union
+import numpy as np
 import pandas as pd
 
 from account_metrics.metric_model import MetricData
@@ -8,20 +8,44 @@ from .account_metric_by_day_data_model import AccountMetricDaily
 
 from account_metrics.mt5_deal.mt5_deal_data_model import MT5Deal
 from account_metrics.mt5_deal_daily.mt5_deal_daily_data_model import MT5DealDaily
-from account_metrics.mt_deal_enum import EnDealAction,EnDealEntry
+from account_metrics import mt_deal_enum as deal_enum
+from account_metrics.mt_deal_enum import (
+    enum_value,
+    is_balance,
+    is_buy,
+    is_close,
+    is_non_trading_cashflow,
+    is_open,
+    is_trade,
+)
 from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_utils import (
+    enum_values,
+    new_day_mask,
+    segmented_cummax,
+    segmented_cummin,
+    segmented_cumsum,
+    segmented_daily_cumsum,
+    segmented_day_carry,
+    segmented_last,
+    segmented_shift,
+    timestamp_to_day,
+)
 
 class AccountMetricDailyCalculator(BasicDealMetricCalculator):
     input_class = MT5Deal
     additional_data = [MT5DealDaily,AccountMetricDaily]
     output_metric = AccountMetricDaily
     groupby_field = [k for k, v in output_metric.model_fields.items() if "groupby" in v.metadata]
+    input_columns = ["Action", "Comment", "Commission", "Deal", "Entry", "Login", "Profit", "Storage", "Time",
+                     "TimeUTC", "Volume", "server"]
+    uses_yesterday_history = True
     
     @classmethod
     def calculate_row(cls, deal: pd.Series, additional_data:Dict[Type[MetricData],Any]) -> AccountMetricDaily:
-        comment = deal["Comment"] if isinstance(deal["Comment"], str) else deal["Comment"].decode()
-        action = deal["Action"] if isinstance(deal["Action"], EnDealAction) else EnDealAction(deal["Action"])
-        entry = deal["Entry"] if isinstance(deal["Entry"], EnDealEntry) else EnDealEntry(deal["Entry"])
+        comment = deal["Comment"]
+        action = enum_value(deal["Action"])
+        entry = enum_value(deal["Entry"])
         is_initialize = "initialize" in comment
         
         # TODO: double check the logic of initialize what happen if yesterday_history exists when initialize, what if the account is initialized today.
@@ -30,7 +54,7 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         prev = cls._get_current_metric(deal, additional_data)
             
         
-        metric= cls.output_metric()
+        metric= cls.new_row()
 
         metric.server = deal["server"]
         metric.login = deal["Login"]
@@ -42,7 +66,7 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         metric.max_balance_equity = max(yesterday_history["Balance"], yesterday_history["ProfitEquity"])
         metric.net_deposit = prev.net_deposit + (
             deal["Profit"]
-            if action == EnDealAction.DEAL_BALANCE and not is_initialize
+            if is_balance(action) and not is_initialize
             else 0.0
         )
         metric.yesterday_net_deposit = (
@@ -51,13 +75,7 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         metric.daily_net_deposit = metric.net_deposit - metric.yesterday_net_deposit
         metric.profit_loss = prev.profit_loss + (
             (deal["Profit"] + deal["Commission"] + deal["Storage"])
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
+            if not is_non_trading_cashflow(action)
             else 0.0
         )
         metric.yesterday_net_profit_loss = (
@@ -65,7 +83,7 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         )
         metric.daily_profit_loss = metric.profit_loss - metric.yesterday_net_profit_loss
         metric.last_open_trade_timestamp = (
-            deal["Time"] if entry == EnDealEntry.ENTRY_IN else prev.last_open_trade_timestamp
+            deal["Time"] if is_open(entry) else prev.last_open_trade_timestamp
         )
         metric.trading_days = prev.trading_days + (
             1 if pd.to_datetime(prev.last_open_trade_timestamp, unit="s") < pd.to_datetime(metric.last_open_trade_timestamp, unit="s") else 0
@@ -76,57 +94,41 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         metric.profitable_trading_days = metric.yesterday_profitable_trading_days + (1 if metric.daily_profit_loss > 0 else 0)
         metric.total_deposit = prev.total_deposit + (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_BALANCE]
+            if is_balance(action)
             and deal["Profit"] > 0
             and not is_initialize
             else 0.0
         )
         metric.total_withdrawal = prev.total_withdrawal + (
-            deal["Profit"] if action in [EnDealAction.DEAL_BALANCE] and deal["Profit"] < 0 else 0.0
+            deal["Profit"] if is_balance(action) and deal["Profit"] < 0 else 0.0
         )
-        metric.count_trades = prev.count_trades + (1 if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL] and entry in [EnDealEntry.ENTRY_IN] else 0)
-        metric.count_long_trades = prev.count_long_trades + (1 if action in [EnDealAction.DEAL_BUY] and entry in [EnDealEntry.ENTRY_IN] else 0)
+        metric.count_trades = prev.count_trades + (1 if is_trade(action) and is_open(entry) else 0)
+        metric.count_long_trades = prev.count_long_trades + (1 if is_buy(action) and is_open(entry) else 0)
         metric.count_profit_trades = prev.count_profit_trades + (
             1
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             and deal["Profit"] > 0
             else 0
         )
         metric.count_loss_trades = prev.count_loss_trades + (
             1
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             and deal["Profit"] < 0
             else 0
         )
         metric.gross_profit = prev.gross_profit + (
             deal["Profit"]
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if not is_non_trading_cashflow(action)
+            and is_close(entry)
             and deal["Profit"] > 0
             else 0.0
         )
         metric.gross_loss = prev.gross_loss + (
             deal["Profit"]
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if not is_non_trading_cashflow(action)
+            and is_close(entry)
             and deal["Profit"] < 0
             else 0.0
         )
@@ -134,48 +136,123 @@ class AccountMetricDailyCalculator(BasicDealMetricCalculator):
         metric.losses_ratio = metric.count_loss_trades / metric.count_trades if metric.count_trades > 0 else 0.0
         metric.total_volume = prev.total_volume + (
             deal["Volume"]
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             else 0.0
         )
         metric.best_trade = (
             deal["Profit"]
             if deal["Profit"] > prev.best_trade
-            and action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            and not is_non_trading_cashflow(action)
+            and is_close(entry)
             else prev.best_trade
         )
         metric.worst_trade = (
             deal["Profit"]
             if deal["Profit"] < prev.worst_trade
-            and action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            and not is_non_trading_cashflow(action)
+            and is_close(entry)
             else prev.worst_trade
         )
         metric.average_win = metric.gross_profit / metric.count_profit_trades if metric.count_profit_trades > 0 else 0.0
         metric.average_loss = metric.gross_loss / metric.count_loss_trades if metric.count_loss_trades > 0 else 0.0
         return metric, {}
 
+    @classmethod
+    def calculate_batch(cls, deals:pd.DataFrame, group_index:np.ndarray, current_metric:pd.DataFrame) -> pd.DataFrame:
+        def initial(field, dtype=float):
+            return current_metric[field].to_numpy(dtype=dtype)
+
+        comment = deals["Comment"].astype(str)
+        action = enum_values(deals["Action"])
+        entry = enum_values(deals["Entry"])
+        is_initialize = comment.str.contains("initialize", regex=False).to_numpy(dtype=bool)
+
+        is_balance = deal_enum.is_balance(action)
+        is_trade = deal_enum.is_trade(action)
+        is_cashflow = deal_enum.is_non_trading_cashflow(action)
+        is_in = deal_enum.is_open(entry)
+        is_out = deal_enum.is_close(entry)
+        is_closed_trade = is_trade & is_out
+        is_closed_position = ~is_cashflow & is_out
+
+        profit = deals["Profit"].to_numpy(dtype=float)
+        time = deals["Time"].to_numpy(dtype="int64")
+        ones = np.ones(len(deals), dtype="int64")
+
+        metric = {}
+        metric["server"] = deals["server"].to_numpy(dtype=object)
+        metric["login"] = deals["Login"].to_numpy()
+        metric["deal_id"] = deals["Deal"].to_numpy()
+        metric["timestamp_server"] = deals["Time"].to_numpy()
+        metric["timestamp_utc"] = deals["TimeUTC"].to_numpy()
+        metric["date"] = pd.to_datetime(time, unit="s").date
+        metric["balance"] = segmented_cumsum(profit, initial("balance"), group_index)
+        metric["max_balance_equity"] = cls.get_yesterday_max_balance_equity(deals, np.zeros(len(deals)))
+
+        # Day changes are found once per login; every yesterday_* field is carried across them
+        initial_day = pd.to_datetime(current_metric["date"]).to_numpy("datetime64[s]").astype("int64")
+        is_new_day = new_day_mask(timestamp_to_day(time), timestamp_to_day(initial_day), group_index)
+        metric["net_deposit"] = segmented_cumsum(profit, initial("net_deposit"), group_index,
+                                                 mask=is_balance & ~is_initialize)
+        metric["yesterday_net_deposit"] = segmented_day_carry(metric["net_deposit"], initial("net_deposit"),
+                                                              initial("yesterday_net_deposit"), is_new_day,
+                                                              group_index)
+        metric["daily_net_deposit"] = metric["net_deposit"] - metric["yesterday_net_deposit"]
+        net_profit = profit + deals["Commission"].to_numpy(dtype=float) + deals["Storage"].to_numpy(dtype=float)
+        metric["profit_loss"] = segmented_cumsum(net_profit, initial("profit_loss"), group_index, mask=~is_cashflow)
+        metric["yesterday_net_profit_loss"] = segmented_day_carry(metric["profit_loss"], initial("profit_loss"),
+                                                                  initial("yesterday_net_profit_loss"), is_new_day,
+                                                                  group_index)
+        metric["daily_profit_loss"] = metric["profit_loss"] - metric["yesterday_net_profit_loss"]
+
+        metric["last_open_trade_timestamp"] = segmented_last(time, initial("last_open_trade_timestamp", "int64"),
+                                                             group_index, mask=is_in)
+        last_open_trade_timestamp = metric["last_open_trade_timestamp"]
+        previous_open_trade_timestamp = segmented_shift(last_open_trade_timestamp,
+                                                        initial("last_open_trade_timestamp", "int64"), group_index)
+        metric["trading_days"] = segmented_cumsum(ones, initial("trading_days", "int64"), group_index,
+                                                  mask=previous_open_trade_timestamp < last_open_trade_timestamp)
+        metric["profitable_trading_days"], metric["yesterday_profitable_trading_days"] = segmented_daily_cumsum(
+            ones, initial("profitable_trading_days", "int64"), initial("yesterday_profitable_trading_days", "int64"),
+            is_new_day, group_index, mask=metric["daily_profit_loss"] > 0)
+
+        metric["total_deposit"] = segmented_cumsum(profit, initial("total_deposit"), group_index,
+                                                   mask=is_balance & (profit > 0) & ~is_initialize)
+        metric["total_withdrawal"] = segmented_cumsum(profit, initial("total_withdrawal"), group_index,
+                                                      mask=is_balance & (profit < 0))
+        metric["count_trades"] = segmented_cumsum(ones, initial("count_trades", "int64"), group_index,
+                                                  mask=is_trade & is_in)
+        metric["count_long_trades"] = segmented_cumsum(ones, initial("count_long_trades", "int64"), group_index,
+                                                       mask=deal_enum.is_buy(action) & is_in)
+        metric["count_profit_trades"] = segmented_cumsum(ones, initial("count_profit_trades", "int64"), group_index,
+                                                         mask=is_closed_trade & (profit > 0))
+        metric["count_loss_trades"] = segmented_cumsum(ones, initial("count_loss_trades", "int64"), group_index,
+                                                       mask=is_closed_trade & (profit < 0))
+        metric["gross_profit"] = segmented_cumsum(profit, initial("gross_profit"), group_index,
+                                                  mask=is_closed_position & (profit > 0))
+        metric["gross_loss"] = segmented_cumsum(profit, initial("gross_loss"), group_index,
+                                                mask=is_closed_position & (profit < 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["wins_ratio"] = np.where(metric["count_trades"] > 0,
+                                            metric["count_profit_trades"] / metric["count_trades"], 0.0)
+            metric["losses_ratio"] = np.where(metric["count_trades"] > 0,
+                                              metric["count_loss_trades"] / metric["count_trades"], 0.0)
+        metric["total_volume"] = segmented_cumsum(deals["Volume"].to_numpy(dtype=float), initial("total_volume"),
+                                                  group_index, mask=is_closed_trade)
+        metric["best_trade"] = segmented_cummax(profit, initial("best_trade"), group_index, mask=is_closed_position)
+        metric["worst_trade"] = segmented_cummin(profit, initial("worst_trade"), group_index, mask=is_closed_position)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["average_win"] = np.where(metric["count_profit_trades"] > 0,
+                                             metric["gross_profit"] / metric["count_profit_trades"], 0.0)
+            metric["average_loss"] = np.where(metric["count_loss_trades"] > 0,
+                                              metric["gross_loss"] / metric["count_loss_trades"], 0.0)
+
+        return cls.build_batch_frame(metric, len(deals))
+
     @classmethod
     def _get_history(cls, deal, comment, is_initialize, additional_data):
-        yesterday_history = cls.get_metric_runner().get_datastore(MT5DealDaily).get_row_by_timestamp({"Login":deal.login},
-                                                                                                pd.to_datetime(deal["Time"], unit="s").date() - datetime.timedelta(days=1),
-                                                                                                timestamp_column="Date")
+        yesterday_history = cls.get_yesterday_history_of_deal(deal, additional_data)
         # TODO: Find the correct logic to handle this case: deal is initialize today, so yesterday_history is None    
         # if (is_initialize or "Deposit" in comment) and yesterday_history is None:
         if yesterday_history is None:
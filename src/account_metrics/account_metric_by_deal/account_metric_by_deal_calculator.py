@@ -1,14 +1,28 @@
-import datetime
 from typing import Any, Dict, Type, Union
+import numpy as np
 import pandas as pd
 
 from .account_metric_by_deal_data_model import AccountMetricByDeal
 
 from account_metrics.metric_model import MetricData
-from account_metrics.mt_deal_enum import EnDealAction, EnDealEntry
+from account_metrics import mt_deal_enum as deal_enum
+from account_metrics.mt_deal_enum import (
+    enum_value,
+    is_balance,
+    is_buy,
+    is_close,
+    is_gross_excluded,
+    is_non_trading_cashflow,
+    is_open,
+    is_sell,
+    is_trade,
+)
 from account_metrics.mt5_deal import MT5Deal
 from account_metrics.mt5_deal_daily import MT5DealDaily
 from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_utils import (enum_values, new_day_mask, segmented_cummax, segmented_cummin,
+                                          segmented_cumsum, segmented_daily_cummax, segmented_daily_cumsum,
+                                          segmented_day_carry, segmented_last, timestamp_to_day)
 
 class AccountMetricByDealCalculator(BasicDealMetricCalculator):
 
@@ -16,28 +30,35 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
     additional_data = [MT5DealDaily,AccountMetricByDeal]
     output_metric = AccountMetricByDeal
     groupby_field = [k for k, v in output_metric.model_fields.items() if "groupby" in v.metadata]
+    input_columns = ["Action", "Comment", "Commission", "Deal", "Entry", "Login", "Profit", "Storage", "Time",
+                     "TimeUTC", "Volume", "server"]
+    uses_yesterday_history = True
     
     @classmethod
     def calculate_row(cls,deal:pd.Series, additional_data:Dict[Type[MetricData],Any]) ->AccountMetricByDeal:
-        comment = deal["Comment"] if isinstance(deal["Comment"], str) else deal["Comment"].decode()
-        action = deal["Action"] if isinstance(deal["Action"], EnDealAction) else EnDealAction(deal["Action"])
-        entry = deal["Entry"] if isinstance(deal["Entry"], EnDealEntry) else EnDealEntry(deal["Entry"])
+        comment = deal["Comment"]
+        action = enum_value(deal["Action"])
+        entry = enum_value(deal["Entry"])
         is_initialize = "initialize" in comment
         
         prev = cls._get_current_metric(deal, additional_data)
         
         #TODO: throw a defined error to catch and handle later
-        initial_deposit = deal["Profit"] if action == EnDealAction.DEAL_BALANCE and comment.startswith("initialize") else prev.initial_deposit
+        is_initial_deposit = is_balance(action) and comment.startswith("initialize")
+        initial_deposit = deal["Profit"] if is_initial_deposit else prev.initial_deposit
 
         
         yesterday_history = cls._get_history(deal, comment, is_initialize, initial_deposit, additional_data)
                     
-        metric = cls.output_metric()
+        metric = cls.new_row()
 
         metric.initial_deposit = initial_deposit
+        # program_id is the number after the 3-character prefix of the third word of an initialize comment. It is
+        # parsed as an int (the type of the field), a tag without a number leaves the previous program_id, as a comment
+        # without a tag does.
         metric.program_id = (
-            comment.split()[2][3:] 
-            if is_initialize and len(comment.split()) >= 3 and len(comment.split()[2]) >= 3
+            int(comment.split()[2][3:])
+            if is_initialize and len(comment.split()) >= 3 and comment.split()[2][3:].isdigit()
             else prev.program_id
         )
 
@@ -47,13 +68,7 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         metric.deal_id = deal["Deal"]
         metric.deal_profit = (
             deal["Profit"]
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
+            if not is_non_trading_cashflow(action)
             else 0
         )
         metric.timestamp_server = deal["Time"]
@@ -63,7 +78,7 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         metric.max_balance_equity = max(yesterday_history["Balance"], yesterday_history["ProfitEquity"])
         metric.net_deposit = prev.net_deposit + (
             deal["Profit"]
-            if action == EnDealAction.DEAL_BALANCE and not is_initialize
+            if is_balance(action) and not is_initialize
             else 0.0
         )
         metric.yesterday_net_deposit = (
@@ -73,13 +88,7 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         metric.net_profit = deal["Profit"] + deal["Commission"] + deal["Storage"]
         metric.profit_loss = prev.profit_loss + (
             metric.net_profit
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_CORRECTION,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
+            if not is_non_trading_cashflow(action)
             else 0
         )
         metric.profit_gain = metric.profit_loss / metric.initial_deposit * 100 if metric.initial_deposit > 0 else 0.0
@@ -89,8 +98,8 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         metric.daily_profit_loss = metric.profit_loss - metric.yesterday_net_profit_loss
         metric.last_open_trade_timestamp = (
             deal["Time"]
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry == EnDealEntry.ENTRY_IN
+            if is_trade(action)
+            and is_open(entry)
             else prev.last_open_trade_timestamp
         )
         metric.trading_days = prev.trading_days + (
@@ -130,66 +139,52 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         )
         metric.total_deposit = prev.total_deposit + (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_BALANCE]
+            if is_balance(action)
             and deal["Profit"] > 0
             and not is_initialize
             else 0.0
         )
         metric.total_withdrawal = prev.total_withdrawal + (
-            deal["Profit"] if action in [EnDealAction.DEAL_BALANCE] and deal["Profit"] < 0 else 0
+            deal["Profit"] if is_balance(action) and deal["Profit"] < 0 else 0
         )
-        metric.count_trades = prev.count_trades + (1 if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL] and entry in [EnDealEntry.ENTRY_IN] else 0)
-        metric.count_long_trades = prev.count_long_trades + (1 if action in [EnDealAction.DEAL_BUY] and entry in [EnDealEntry.ENTRY_IN] else 0)
-        metric.count_short_trades = prev.count_short_trades + (1 if action in [EnDealAction.DEAL_SELL] and entry in [EnDealEntry.ENTRY_IN] else 0)
+        metric.count_trades = prev.count_trades + (1 if is_trade(action) and is_open(entry) else 0)
+        metric.count_long_trades = prev.count_long_trades + (1 if is_buy(action) and is_open(entry) else 0)
+        metric.count_short_trades = prev.count_short_trades + (1 if is_sell(action) and is_open(entry) else 0)
         metric.profit_long_trades = prev.profit_long_trades + (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_BUY]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_buy(action)
+            and is_close(entry)
             else 0.0
         )
         metric.profit_short_trades = prev.profit_short_trades + (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_sell(action)
+            and is_close(entry)
             else 0.0
         )
         metric.count_profit_trades = prev.count_profit_trades + (
             1
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             and metric.net_profit >= 0
             else 0
         )
         metric.count_loss_trades = prev.count_loss_trades + (
             1
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             and metric.net_profit < 0
             else 0
         )
         metric.gross_profit = prev.gross_profit + (
             metric.net_profit
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
+            if not is_gross_excluded(action)
             and metric.net_profit > 0
             else 0.0
         )
         metric.gross_loss = prev.gross_loss + (
             metric.net_profit
-            if action
-            not in [
-                EnDealAction.DEAL_BALANCE,
-                EnDealAction.DEAL_CREDIT,
-                EnDealAction.DEAL_SO_COMPENSATION,
-            ]
+            if not is_gross_excluded(action)
             and metric.net_profit < 0
             else 0.0
         )
@@ -197,33 +192,22 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
         metric.losses_ratio = metric.count_loss_trades / metric.count_trades if metric.count_trades > 0 else 0.0
         metric.total_volume = prev.total_volume + (
             deal["Volume"]
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             else 0.0
         )
         metric.best_trade = (
             metric.net_profit
             if metric.net_profit > prev.best_trade
-            and action
-            in [
-                EnDealAction.DEAL_BUY,
-                EnDealAction.DEAL_SELL,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            and is_trade(action)
+            and is_close(entry)
             else prev.best_trade
         )
         metric.worst_trade = (
             metric.net_profit
             if metric.net_profit < prev.worst_trade
-            and action
-            in [
-                EnDealAction.DEAL_BUY,
-                EnDealAction.DEAL_SELL,
-            ]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            and is_trade(action)
+            and is_close(entry)
             else prev.worst_trade
         )
         metric.average_win = metric.gross_profit / metric.count_profit_trades if metric.count_profit_trades > 0 else 0.0
@@ -231,11 +215,135 @@ class AccountMetricByDealCalculator(BasicDealMetricCalculator):
 
         return metric,{}
 
+    @classmethod
+    def calculate_batch(cls, deals:pd.DataFrame, group_index:np.ndarray, current_metric:pd.DataFrame) -> pd.DataFrame:
+        def initial(field, dtype=float):
+            return current_metric[field].to_numpy(dtype=dtype)
+
+        comment = deals["Comment"].astype(str)
+        action = enum_values(deals["Action"])
+        entry = enum_values(deals["Entry"])
+        is_initialize = comment.str.contains("initialize", regex=False).to_numpy(dtype=bool)
+
+        is_balance = deal_enum.is_balance(action)
+        is_buy = deal_enum.is_buy(action)
+        is_sell = deal_enum.is_sell(action)
+        is_trade = deal_enum.is_trade(action)
+        is_cashflow = deal_enum.is_non_trading_cashflow(action)
+        is_gross_excluded = deal_enum.is_gross_excluded(action)
+        is_in = deal_enum.is_open(entry)
+        is_out = deal_enum.is_close(entry)
+        is_closed_trade = is_trade & is_out
+
+        profit = deals["Profit"].to_numpy(dtype=float)
+        time = deals["Time"].to_numpy(dtype="int64")
+        net_profit = profit + deals["Commission"].to_numpy(dtype=float) + deals["Storage"].to_numpy(dtype=float)
+        ones = np.ones(len(deals), dtype="int64")
+
+        metric = {}
+        metric["server"] = deals["server"].to_numpy(dtype=object)
+        metric["login"] = deals["Login"].to_numpy()
+        metric["deal_id"] = deals["Deal"].to_numpy()
+        metric["timestamp_server"] = deals["Time"].to_numpy()
+        metric["timestamp_utc"] = deals["TimeUTC"].to_numpy()
+        metric["date"] = pd.to_datetime(time, unit="s").date
+
+        is_initialize_comment = comment.str.startswith("initialize").to_numpy(dtype=bool)
+        metric["initial_deposit"] = segmented_last(profit, initial("initial_deposit"), group_index,
+                                                   mask=is_balance & is_initialize_comment)
+        program_id = comment.str.split().str[2].fillna("").astype(str).str[3:]
+        has_program_id = program_id.str.isdigit().to_numpy(dtype=bool)
+        program_id = pd.to_numeric(program_id.where(has_program_id, "0")).to_numpy(dtype="int64")
+        metric["program_id"] = segmented_last(program_id, initial("program_id", "int64"), group_index,
+                                              mask=is_initialize & has_program_id)
+        metric["deal_profit"] = np.where(is_cashflow, 0.0, profit)
+        metric["balance"] = segmented_cumsum(net_profit, initial("balance"), group_index)
+        metric["max_balance_equity"] = cls.get_yesterday_max_balance_equity(deals, metric["initial_deposit"])
+
+        initial_day = pd.to_datetime(current_metric["date"]).to_numpy("datetime64[s]").astype("int64")
+        is_new_day = new_day_mask(timestamp_to_day(time), timestamp_to_day(initial_day), group_index)
+        metric["net_deposit"] = segmented_cumsum(profit, initial("net_deposit"), group_index,
+                                                 mask=is_balance & ~is_initialize)
+        metric["yesterday_net_deposit"] = segmented_day_carry(metric["net_deposit"], initial("net_deposit"),
+                                                              initial("yesterday_net_deposit"), is_new_day,
+                                                              group_index)
+        metric["daily_net_deposit"] = metric["net_deposit"] - metric["yesterday_net_deposit"]
+        metric["net_profit"] = net_profit
+        metric["profit_loss"] = segmented_cumsum(net_profit, initial("profit_loss"), group_index, mask=~is_cashflow)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["profit_gain"] = np.where(metric["initial_deposit"] > 0,
+                                             metric["profit_loss"] / metric["initial_deposit"] * 100, 0.0)
+        metric["yesterday_net_profit_loss"] = segmented_day_carry(metric["profit_loss"], initial("profit_loss"),
+                                                                  initial("yesterday_net_profit_loss"), is_new_day,
+                                                                  group_index)
+        metric["daily_profit_loss"] = metric["profit_loss"] - metric["yesterday_net_profit_loss"]
+
+        metric["last_open_trade_timestamp"] = segmented_last(time, initial("last_open_trade_timestamp", "int64"),
+                                                             group_index, mask=is_trade & is_in)
+        is_new_trading_day = new_day_mask(timestamp_to_day(metric["last_open_trade_timestamp"]),
+                                          timestamp_to_day(initial("last_open_trade_timestamp", "int64")), group_index)
+        metric["trading_days"] = segmented_cumsum(ones, initial("trading_days", "int64"), group_index,
+                                                  mask=is_new_trading_day)
+
+        is_profitable_day = metric["daily_profit_loss"] > 0
+        metric["profitable_trading_days"], metric["yesterday_profitable_trading_days"] = segmented_daily_cumsum(
+            ones, initial("profitable_trading_days", "int64"), initial("yesterday_profitable_trading_days", "int64"),
+            is_new_day, group_index, mask=is_profitable_day)
+        sum_profit, metric["yesterday_sum_profit_on_profitable_trading_days"] = segmented_daily_cumsum(
+            metric["daily_profit_loss"], initial("sum_profit_on_profitable_trading_days"),
+            initial("yesterday_sum_profit_on_profitable_trading_days"), is_new_day, group_index,
+            mask=is_profitable_day)
+        max_profit, metric["yesterday_max_profit_on_profitable_trading_days"] = segmented_daily_cummax(
+            metric["daily_profit_loss"], initial("max_profit_on_profitable_trading_days"),
+            initial("yesterday_max_profit_on_profitable_trading_days"), is_new_day, group_index,
+            mask=is_profitable_day)
+        metric["sum_profit_on_profitable_trading_days"] = sum_profit
+        metric["max_profit_on_profitable_trading_days"] = max_profit
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["consistent_score"] = np.where(sum_profit > 0, (1 - (max_profit / sum_profit)) * 100, 0.0)
+
+        metric["total_deposit"] = segmented_cumsum(profit, initial("total_deposit"), group_index,
+                                                   mask=is_balance & (profit > 0) & ~is_initialize)
+        metric["total_withdrawal"] = segmented_cumsum(profit, initial("total_withdrawal"), group_index,
+                                                      mask=is_balance & (profit < 0))
+        metric["count_trades"] = segmented_cumsum(ones, initial("count_trades", "int64"), group_index,
+                                                  mask=is_trade & is_in)
+        metric["count_long_trades"] = segmented_cumsum(ones, initial("count_long_trades", "int64"), group_index,
+                                                       mask=is_buy & is_in)
+        metric["count_short_trades"] = segmented_cumsum(ones, initial("count_short_trades", "int64"), group_index,
+                                                        mask=is_sell & is_in)
+        metric["profit_long_trades"] = segmented_cumsum(profit, initial("profit_long_trades"), group_index,
+                                                        mask=is_buy & is_out)
+        metric["profit_short_trades"] = segmented_cumsum(profit, initial("profit_short_trades"), group_index,
+                                                         mask=is_sell & is_out)
+        metric["count_profit_trades"] = segmented_cumsum(ones, initial("count_profit_trades", "int64"), group_index,
+                                                         mask=is_closed_trade & (net_profit >= 0))
+        metric["count_loss_trades"] = segmented_cumsum(ones, initial("count_loss_trades", "int64"), group_index,
+                                                       mask=is_closed_trade & (net_profit < 0))
+        metric["gross_profit"] = segmented_cumsum(net_profit, initial("gross_profit"), group_index,
+                                                  mask=~is_gross_excluded & (net_profit > 0))
+        metric["gross_loss"] = segmented_cumsum(net_profit, initial("gross_loss"), group_index,
+                                                mask=~is_gross_excluded & (net_profit < 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["wins_ratio"] = np.where(metric["count_trades"] > 0,
+                                            metric["count_profit_trades"] / metric["count_trades"], 0.0)
+            metric["losses_ratio"] = np.where(metric["count_trades"] > 0,
+                                              metric["count_loss_trades"] / metric["count_trades"], 0.0)
+        metric["total_volume"] = segmented_cumsum(deals["Volume"].to_numpy(dtype=float), initial("total_volume"),
+                                                  group_index, mask=is_closed_trade)
+        metric["best_trade"] = segmented_cummax(net_profit, initial("best_trade"), group_index, mask=is_closed_trade)
+        metric["worst_trade"] = segmented_cummin(net_profit, initial("worst_trade"), group_index, mask=is_closed_trade)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metric["average_win"] = np.where(metric["count_profit_trades"] > 0,
+                                             metric["gross_profit"] / metric["count_profit_trades"], 0.0)
+            metric["average_loss"] = np.where(metric["count_loss_trades"] > 0,
+                                              metric["gross_loss"] / metric["count_loss_trades"], 0.0)
+
+        return cls.build_batch_frame(metric, len(deals))
+
     @classmethod
     def _get_history(cls, deal, comment, is_initialize, initial_deposit, additional_data):
-        yesterday_history = cls.get_metric_runner().get_datastore(MT5DealDaily).get_row_by_timestamp({"Login":deal.login},
-                                                                                                     pd.to_datetime(deal["Time"], unit="s").date() - datetime.timedelta(days=1),
-                                                                                                     timestamp_column="Date")
+        yesterday_history = cls.get_yesterday_history_of_deal(deal, additional_data)
         # TODO: define what to do if initialize today.
         # if (is_initialize or "Deposit" in comment) and yesterday_history is None:\
         if yesterday_history is None:
@@ -8,7 +8,7 @@ from .account_symbol_metric_by_deal import AccountSymbolMetricByDealCalculator,A
 from .position_metric_by_deal import PositionMetricByDealCalculator,PositionMetricByDeal
 from .mt5_deal import MT5Deal
 from .mt5_deal_daily import MT5DealDaily
-from .metric_utils import decode_string_binary_column
+from .metric_utils import decode_text, project_columns
 
 @staticmethod
 def identityFromDataframeCalculator(metric_class:MetricData, input_key: str) -> MetricCalculator:
@@ -22,11 +22,12 @@ def identityFromDataframeCalculator(metric_class:MetricData, input_key: str) ->
             if not cls.validate_data(input_data):
                 return pd.DataFrame()
             
-            # Get all pydantic fields of MT5Deal with string type annotation
+            # Pydantic fields with string type annotation are decoded, the other columns are shared with input_data
+            # (no copy)
             data = input_data[cls.key]
-            decode_string_binary_column(cls.output_metric, data)
-
-            return data
+            decoded = {field: decode_text(data[field]) for field, field_info in cls.output_metric.model_fields.items()
+                       if field_info.annotation is str and field in data.columns}
+            return project_columns(data, replace=decoded)
         
         @classmethod
         def validate_data(cls,input_data: Dict[str, pd.DataFrame]) -> bool:
@@ -1,13 +1,15 @@
 from typing import Dict, Tuple, Annotated, Type, Any, Union
+import numpy as np
 import pandas as pd
 
 
 from .account_symbol_metric_by_deal_data_model import AccountSymbolMetricByDeal
 
 from account_metrics.metric_model import MetricData
-from account_metrics.mt_deal_enum import EnDealAction, EnDealEntry
+from account_metrics.mt_deal_enum import enum_value, is_close, is_trade
 from account_metrics.mt5_deal.mt5_deal_data_model import MT5Deal
 from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_utils import enum_values, segmented_cumsum
 
 
 class AccountSymbolMetricByDealCalculator(BasicDealMetricCalculator):
@@ -16,24 +18,25 @@ class AccountSymbolMetricByDealCalculator(BasicDealMetricCalculator):
     additional_data = [AccountSymbolMetricByDeal]
     output_metric = AccountSymbolMetricByDeal
     groupby_field = [k for k, v in output_metric.model_fields.items() if "groupby" in v.metadata]
+    input_columns = ["Action", "Commission", "Deal", "Entry", "Login", "Profit", "Storage", "Symbol", "Time",
+                     "TimeUTC", "server"]
     
     @classmethod
     def calculate_row(cls,deal:pd.Series, additional_data:Dict[Type[MetricData],Any]) -> AccountSymbolMetricByDeal:
-        metric = cls.output_metric()
+        metric = cls.new_row()
         
         prev = cls._get_current_metric(deal, additional_data)
 
-        action = deal["Action"] if isinstance(deal["Action"], EnDealAction) else EnDealAction(deal["Action"])
-        entry = deal["Entry"] if isinstance(deal["Entry"], EnDealEntry) else EnDealEntry(deal["Entry"])
+        action = enum_value(deal["Action"])
+        entry = enum_value(deal["Entry"])
 
         metric.server = deal["server"]
         metric.login = deal["Login"]
         metric.deal_id = deal["Deal"]
         metric.deal_profit = (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             else 0.0
         )
         metric.timestamp_server = deal["Time"]
@@ -41,23 +44,49 @@ class AccountSymbolMetricByDealCalculator(BasicDealMetricCalculator):
         metric.symbol = deal["Symbol"]
         metric.total_profit = prev.total_profit + (
             deal["Profit"]
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             else 0.0
         )
         metric.total_commission = prev.total_commission + deal["Commission"]
         metric.total_storage = prev.total_storage + deal["Storage"]
         metric.total_trades = prev.total_trades + (
             1
-            if action in [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]
-            and entry
-            in [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY]
+            if is_trade(action)
+            and is_close(entry)
             else 0
         )
 
         return metric, {}
 
+    @classmethod
+    def calculate_batch(cls, deals:pd.DataFrame, group_index:np.ndarray, current_metric:pd.DataFrame) -> pd.DataFrame:
+        def initial(field, dtype=float):
+            return current_metric[field].to_numpy(dtype=dtype)
+
+        action = enum_values(deals["Action"])
+        entry = enum_values(deals["Entry"])
+        is_closed_trade = is_trade(action) & is_close(entry)
+        profit = deals["Profit"].to_numpy(dtype=float)
+
+        metric = {}
+        metric["server"] = deals["server"].to_numpy(dtype=object)
+        metric["login"] = deals["Login"].to_numpy()
+        metric["deal_id"] = deals["Deal"].to_numpy()
+        metric["deal_profit"] = np.where(is_closed_trade, profit, 0.0)
+        metric["timestamp_server"] = deals["Time"].to_numpy()
+        metric["timestamp_utc"] = deals["TimeUTC"].to_numpy()
+        metric["symbol"] = deals["Symbol"].to_numpy(dtype=object)
+        metric["total_profit"] = segmented_cumsum(profit, initial("total_profit"), group_index, mask=is_closed_trade)
+        metric["total_commission"] = segmented_cumsum(deals["Commission"].to_numpy(dtype=float),
+                                                      initial("total_commission"), group_index)
+        metric["total_storage"] = segmented_cumsum(deals["Storage"].to_numpy(dtype=float), initial("total_storage"),
+                                                   group_index)
+        metric["total_trades"] = segmented_cumsum(np.ones(len(deals), dtype="int64"), initial("total_trades", "int64"),
+                                                  group_index, mask=is_closed_trade)
+
+        return cls.build_batch_frame(metric, len(deals))
+
     @classmethod
     def _get_current_metric(cls, deal, additional_data):
         if 'current_metric' in additional_data:
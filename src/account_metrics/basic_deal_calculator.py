@@ -1,34 +1,379 @@
-from typing import Annotated, Dict, Any, Tuple, Type
-import pandas as pd
 import abc
+import datetime
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.metric_model import (
+    MetricCalculator,
+    MetricData,
+    as_metric_types,
+    columns_record_class,
+    metric_buffers,
+    metric_frame,
+)
+from account_metrics.metric_state import MetricState
+from account_metrics.metric_utils import (
+    decode_text,
+    is_group_start,
+    project_columns,
+    segmented_is_stale,
+    sort_by_group,
+)
+from account_metrics.mt5_deal_daily import MT5DealDaily
 
-from account_metrics.metric_model import MetricData,MetricCalculator
-from account_metrics.metric_utils import apply_groupby_mapping_of_metric_to_data
+
+def _calculate_shard(calculator, input_data:pd.DataFrame, vectorized:bool, state:MetricState,
+                     metric_runner:Any) -> Tuple[pd.DataFrame, int]:
+    return calculator.calculate(input_data, vectorized=vectorized, processes=1, state=state,
+                                metric_runner=metric_runner, return_dropped=True)
 
 class BasicDealMetricCalculator(MetricCalculator,abc.ABC):
-    
+    # Use calculate_batch (whole batch as arrays) instead of calculate_row (one deal at a time)
+    vectorized: bool = False
+    # Validate every row of the row engine against output_metric (debug mode, slow)
+    validate_rows: bool = False
+    # Worker processes used by calculate, groups being split between them by a hash of their Meta.groupby key
+    processes: int = 1
+    # Whether calculate_row reads the MT5DealDaily row of the day before each deal (see get_yesterday_history)
+    uses_yesterday_history: bool = False
+    # How many days before the previous day get_yesterday_history looks for an MT5DealDaily row (weekends, holidays)
+    history_lookback_days: int = 7
+
     @classmethod
-    def calculate(cls,input_data:pd.DataFrame) -> pd.DataFrame:
+    def calculate(cls,input_data:pd.DataFrame, vectorized:bool = None, processes:int = None, state:MetricState = None,
+                  metric_runner:Any = None, return_dropped:bool = False,
+                  executor:Executor = None) -> Union[pd.DataFrame, Tuple[pd.DataFrame, int]]:
+        # state: MetricState of the groupby keys already known by the caller (see get_current_metrics), the others are
+        # read from the datastore. metric_runner: metric runner of this call instead of the one of the class (see
+        # using_metric_runner).
+        # return_dropped: also return the number of deals dropped as already processed (replays, duplicates), see
+        # get_new_deals
+        # executor: process pool of the caller running the shards when processes > 1, see calculate_parallel
+        arguments = (input_data, vectorized, processes, state, metric_runner, executor)
+        with cls.using_metric_runner(metric_runner):
+            if cls.instrumentation is None:
+                result, dropped_deals = cls.calculate_deals(*arguments)
+            else:
+                with cls.timed("calculate"):
+                    result, dropped_deals = cls.calculate_deals(*arguments)
+                cls.record("calls_total")
+                cls.record("rows_in_total", 0 if input_data is None else len(input_data))
+                cls.record("rows_out_total", len(result))
+        return (result, dropped_deals) if return_dropped else result
+
+    @classmethod
+    def calculate_deals(cls,input_data:pd.DataFrame, vectorized:bool = None, processes:int = None,
+                        state:MetricState = None, metric_runner:Any = None,
+                        executor:Executor = None) -> Tuple[pd.DataFrame, int]:
+        # Calculated rows and number of dropped deals
         if (input_data is None or input_data.empty):
-            return pd.DataFrame(columns=cls.output_metric.model_fields.keys())
-        map_deals_by_groupby: Dict[Tuple[Annotated[int, "server"], Annotated[int, "login"]], pd.DataFrame] = apply_groupby_mapping_of_metric_to_data(cls.output_metric, input_data)
-
-        result: list[pd.Series] = []
-        keys = list(map_deals_by_groupby.keys())
-                
-        for i in range(len(keys)):
-            deals_of_login = map_deals_by_groupby[keys[i]]
-            current_metric_of_login = cls.get_metric_runner().get_datastore(cls.output_metric).get_latest_row({"login":keys[i][1]})
-            for index, deal in deals_of_login.iterrows():
-                if current_metric_of_login is not None and deal["Deal"] <= current_metric_of_login["deal_id"]:
-                    continue
-                calculated_metric, carry_data = cls.calculate_row(deal, {"current_metric":current_metric_of_login})
-                new_row = pd.Series(calculated_metric.model_dump())
-                result.append(new_row)
-                current_metric_of_login = new_row
-
-        return pd.DataFrame(result, columns=cls.output_metric.model_fields.keys())
+            return cls.output_metric.empty_frame(), 0
+        input_data = cls.decode_batch(cls.project_batch(input_data))
+        processes = processes if processes is not None else cls.processes
+        if processes > 1:
+            return cls.calculate_parallel(input_data, processes, vectorized, state, metric_runner, executor)
+        if vectorized if vectorized is not None else cls.vectorized:
+            return cls.calculate_vectorized(input_data, state=state, return_dropped=True)
+
+        deals, group_index = cls.sort_batch(input_data)
+        if deals.empty:
+            return cls.output_metric.empty_frame(), 0
+        deals, group_index, current_metrics, dropped_deals = cls.get_new_deals(deals, group_index, state)
+        if deals.empty:
+            return cls.output_metric.empty_frame(), dropped_deals
+        yesterday_history = None
+        if cls.uses_yesterday_history:
+            with cls.timed("history_fetch"):
+                history = cls.get_yesterday_history(deals)
+            yesterday_history = cls.yesterday_history_by_key(history)
+
+        # Rows are plain records written into preallocated typed columns, no pydantic model or pd.Series per deal
+        metric_record = cls.output_metric.record_class()
+        deal_record = columns_record_class(tuple(deals.columns))
+        buffers = metric_buffers(cls.output_metric, len(deals))
+        columns = [buffers[field] for field in metric_record.fields]
+        current_metric_values = current_metrics[list(metric_record.fields)].itertuples(index=False, name=None)
+        current_metric_records = [metric_record(values) for values in current_metric_values]
+        with cls.timed("row_compute"):
+            current_group = -1
+            deal_rows = deals.itertuples(index=False, name=None)
+            for row, (group, deal) in enumerate(zip(group_index.tolist(), deal_rows, strict=True)):
+                if group != current_group:
+                    current_group = group
+                    current_metric_of_login = current_metric_records[group]
+                additional_data = {"current_metric":current_metric_of_login, "yesterday_history":yesterday_history}
+                calculated_metric, carry_data = cls.calculate_row(deal_record(deal), additional_data)
+                if cls.validate_rows:
+                    cls.output_metric.model_validate(calculated_metric.model_dump())
+                for column, value in zip(columns, calculated_metric.values(), strict=True):
+                    column[row] = value
+                current_metric_of_login = calculated_metric
+
+        with cls.timed("frame_build"):
+            return metric_frame(cls.output_metric, buffers, len(deals)), dropped_deals
     
+    @classmethod
+    def new_row(cls):
+        # Output row for calculate_row to fill in, starting from the model defaults
+        return cls.output_metric.record_class()()
+
+    @classmethod
+    def calculate_vectorized(cls,input_data:pd.DataFrame, sorted_batch:Tuple[pd.DataFrame, np.ndarray] = None,
+                             state:MetricState = None,
+                             return_dropped:bool = False) -> Union[pd.DataFrame, Tuple[pd.DataFrame, int]]:
+        # Same output as the row loop in calculate: deals sorted by (groupby, Time, Deal), each group seeded from
+        # the latest stored row and already processed deals skipped. sorted_batch is the result of sort_batch when it
+        # is shared.
+        deals, group_index = sorted_batch if sorted_batch is not None else cls.sort_batch(input_data)
+        result, dropped_deals = cls.output_metric.empty_frame(), 0
+        if not deals.empty:
+            deals, group_index, current_metric, dropped_deals = cls.get_new_deals(deals, group_index, state)
+        if not deals.empty:
+            with cls.timed("row_compute"):
+                result = cls.calculate_batch(deals, group_index, current_metric)
+        return (result, dropped_deals) if return_dropped else result
+
+    @classmethod
+    def calculate_parallel(cls, input_data:pd.DataFrame, processes:int, vectorized:bool = None,
+                           state:MetricState = None, metric_runner:Any = None,
+                           executor:Executor = None) -> Tuple[pd.DataFrame, int]:
+        # Groups are independent: hash-partition them into processes shards, each calculated by a worker process.
+        # Shards, state and metric_runner are pickled to the workers; without metric_runner the workers use the metric
+        # runner of the class as it was when they were forked.
+        # executor is a pool owned by the caller and reused across calls (its workers must have been started from the
+        # main thread). Without one a pool is forked for the call: fork is POSIX only, and forking a process running
+        # other threads can deadlock its children, so off the main thread (e.g. in a CalculatorScheduler) the batch is
+        # calculated serially instead.
+        if executor is None and threading.current_thread() is not threading.main_thread():
+            return cls.calculate_deals(input_data, vectorized, 1, state, metric_runner)
+        group_hash = pd.util.hash_pandas_object(input_data[cls.output_metric.Meta.groupby], index=False).to_numpy()
+        shard = group_hash % processes
+        shards = [input_data.iloc[positions] for positions in (np.flatnonzero(shard == i) for i in range(processes))]
+        shards = [shard for shard in shards if len(shard)]
+        count = len(shards)
+        arguments = [[cls] * count, shards, [vectorized] * count, [state] * count, [metric_runner] * count]
+        if executor is not None:
+            results = list(executor.map(_calculate_shard, *arguments))
+        else:
+            with ProcessPoolExecutor(len(shards), mp_context=multiprocessing.get_context("fork")) as pool:
+                results = list(pool.map(_calculate_shard, *arguments))
+        dropped_deals = sum(dropped_deals for _, dropped_deals in results)
+
+        # Same order as a single process: groups in groupby order, deals of a group in calculation order
+        results = [result for result, _ in results if not result.empty]
+        if not results:
+            return cls.output_metric.empty_frame(), dropped_deals
+        # Categoricals of the shards have different categories and are concatenated as objects
+        result = pd.concat(results, ignore_index=True)
+        result = result.sort_values(cls.output_metric.Meta.groupby_update_format, kind="stable", ignore_index=True)
+        return as_metric_types(cls.output_metric, result), dropped_deals
+
+    @classmethod
+    def get_input_columns(cls) -> List[str]:
+        # input_columns plus the columns the engines read themselves: groupby key, (Time, Deal) order and the login of
+        # the history lookup
+        columns = [*cls.output_metric.Meta.groupby, "Deal", "Time", *(["login"] if cls.uses_yesterday_history else []),
+                   *(cls.input_columns or [])]
+        return list(dict.fromkeys(columns)) if cls.input_columns is not None else None
+
+    @classmethod
+    def project_batch(cls, input_data:pd.DataFrame) -> pd.DataFrame:
+        # View of input_data reduced to the input columns (no copy), so unused columns are neither decoded nor shipped
+        # to workers
+        columns = cls.get_input_columns()
+        if columns is None:
+            return input_data
+        return project_columns(input_data, [column for column in columns if column in input_data.columns])
+
+    @classmethod
+    def decode_batch(cls, input_data:pd.DataFrame) -> pd.DataFrame:
+        # input_data with the text columns of input_class still held as bytes decoded, once per batch before any
+        # calculation (calculate_row and calculate_batch get str). Returned as is when there is nothing to decode.
+        text_columns = {field: input_data[field] for field, field_info in cls.input_class.model_fields.items()
+                        if field_info.annotation is str and field in input_data.columns}
+        decoded = {field: decode_text(column) for field, column in text_columns.items()}
+        decoded = {field: column for field, column in decoded.items() if column is not text_columns[field]}
+        return input_data.assign(**decoded) if decoded else input_data
+
+    @classmethod
+    def sort_batch(cls, input_data:pd.DataFrame, time_order:np.ndarray = None) -> Tuple[pd.DataFrame, np.ndarray]:
+        # Deals sorted by (groupby, Time, Deal) and the group of each deal. time_order, the (Time, Deal) order of
+        # input_data, can be computed once and shared by calculators with different groupby.
+        with cls.timed("grouping"):
+            deals, group_index = sort_by_group(input_data, cls.output_metric.Meta.groupby, time_order)
+            return deals.reset_index(drop=True), group_index
+
+    @classmethod
+    def get_new_deals(cls, deals:pd.DataFrame, group_index:np.ndarray,
+                      state:MetricState = None) -> Tuple[pd.DataFrame, np.ndarray, pd.DataFrame, int]:
+        # Latest metric of every group of the sorted batch, the deals of the batch not processed yet and the number of
+        # dropped deals. A deal is dropped when it is not newer than the stored deal_id of its key or an earlier deal
+        # of the batch (consumer replays, duplicate deliveries), with one mask over the batch. group_index of the kept
+        # deals is the row of current_metric seeding them.
+        is_start = is_group_start(group_index)
+        group_keys = pd.DataFrame(deals[cls.output_metric.Meta.groupby].to_numpy()[is_start],
+                                  columns=cls.output_metric.Meta.groupby_update_format)
+        with cls.timed("state_fetch"):
+            current_metric = cls.get_current_metrics(group_keys.infer_objects(), state)
+        group_index = np.cumsum(is_start) - 1
+
+        deal_ids = deals["Deal"].to_numpy(dtype="int64")
+        is_stale = segmented_is_stale(deal_ids, current_metric["deal_id"].to_numpy(dtype="int64"), group_index)
+        dropped_deals = int(is_stale.sum())
+        cls.record("groups_total", len(current_metric))
+        cls.record("stale_deals_total", dropped_deals)
+        if dropped_deals:
+            deals = deals[~is_stale].reset_index(drop=True)
+            group_index = group_index[~is_stale]
+        return deals, group_index, current_metric, dropped_deals
+
+    @classmethod
+    def get_current_metrics(cls, group_keys:pd.DataFrame, state:MetricState = None) -> pd.DataFrame:
+        # Latest stored metric of every groupby key (columns as in Meta.groupby_update_format), one row per key in the
+        # same order. Keys without a stored metric start from the model defaults.
+        # Keys found in state (a MetricState) are not read from the datastore.
+        if state is not None and len(state):
+            position = state.lookup(group_keys)
+            is_known = position >= 0
+            current_metrics = state.rows(position[is_known])
+            if not is_known.all():
+                stored_metrics = cls.get_current_metrics(group_keys[~is_known].reset_index(drop=True))
+                current_metrics = pd.concat([current_metrics, stored_metrics], ignore_index=True)
+                order = np.argsort(np.r_[np.flatnonzero(is_known), np.flatnonzero(~is_known)])
+                current_metrics = current_metrics.iloc[order].reset_index(drop=True)
+            return as_metric_types(cls.output_metric, current_metrics)
+
+        datastore = cls.get_metric_runner().get_datastore(cls.output_metric)
+        default_metric = pd.DataFrame([cls.output_metric().model_dump()])
+        if not callable(getattr(datastore, "get_latest_rows", None)):
+            # Datastore without bulk lookup: one round trip per key
+            latest_rows = [datastore.get_latest_row(dict(zip(group_keys.columns, key, strict=True)))
+                           for key in group_keys.itertuples(index=False, name=None)]
+            latest_rows = [default_metric.iloc[0] if row is None else row for row in latest_rows]
+            if latest_rows:
+                current_metrics = pd.DataFrame(latest_rows).reindex(columns=default_metric.columns)
+            else:
+                current_metrics = default_metric.iloc[:0]
+            return as_metric_types(cls.output_metric, current_metrics.reset_index(drop=True))
+
+        latest_rows = datastore.get_latest_rows(group_keys)
+        key_columns = list(group_keys.columns)
+        if latest_rows is None or latest_rows.empty:
+            position = np.full(len(group_keys), -1)
+        else:
+            latest_rows = latest_rows.drop_duplicates(subset=key_columns, keep="last").reset_index(drop=True)
+            latest_keys = latest_rows[key_columns].astype(group_keys.dtypes.to_dict())
+            position = pd.MultiIndex.from_frame(latest_keys).get_indexer(pd.MultiIndex.from_frame(group_keys))
+            latest_rows = latest_rows.reindex(columns=default_metric.columns)
+            default_metric = pd.concat([latest_rows, default_metric], ignore_index=True)
+        position[position < 0] = len(default_metric) - 1
+        return as_metric_types(cls.output_metric, default_metric.iloc[position].reset_index(drop=True))
+
     @abc.abstractmethod
     def calculate_row(cls,deal:pd.Series) -> MetricData:
         raise NotImplementedError()
+
+    @classmethod
+    def calculate_batch(cls,deals:pd.DataFrame, group_index:np.ndarray, current_metric:pd.DataFrame) -> pd.DataFrame:
+        # deals are sorted and contiguous per group; group_index[i] is the row of current_metric that seeds
+        # deals.iloc[i]
+        raise NotImplementedError(f"{cls.__name__} has no vectorized engine")
+
+    @classmethod
+    def build_batch_frame(cls, columns:Dict[str, Any], length:int) -> pd.DataFrame:
+        # Fields not computed by calculate_batch keep their model default, as they do in calculate_row
+        with cls.timed("frame_build"):
+            return metric_frame(cls.output_metric, columns, length)
+
+    @classmethod
+    def yesterday_keys(cls, deals:pd.DataFrame) -> pd.DataFrame:
+        # (server, login, yesterday) of every deal, yesterday as a datetime64 day
+        yesterday = pd.to_datetime(deals["Time"].to_numpy(), unit="s").normalize() - pd.Timedelta(days=1)
+        return pd.DataFrame({"server": deals["server"].astype(str).to_numpy(dtype=object),
+                             "login": deals["login"].to_numpy(dtype="int64"), "yesterday": yesterday})
+
+    @classmethod
+    def get_yesterday_history(cls, deals:pd.DataFrame) -> pd.DataFrame:
+        # Balance and ProfitEquity of the latest MT5DealDaily row of the (server, login) of each deal dated from
+        # history_lookback_days before the day before the deal up to that day, NaN where there is none. One row per
+        # (server, login, yesterday) of the deals.
+        # The row of the day before is not always there (weekends, holidays): the latest row of the lookback window is
+        # used then, where the row engine used to read the row of the day before only. history_lookback_days = 0 gives
+        # that exact lookup back. Datastores with and without range scans give the same rows.
+        history_keys = cls.yesterday_keys(deals).drop_duplicates()
+        history_keys = history_keys.sort_values("yesterday", kind="stable").reset_index(drop=True)
+        datastore = cls.get_metric_runner().get_datastore(MT5DealDaily)
+        lookback = pd.Timedelta(days=cls.history_lookback_days)
+        if callable(getattr(datastore, "get_rows_by_timestamp_range", None)):
+            keys = {"server": history_keys["server"].unique().tolist(),
+                    "Login": history_keys["login"].unique().tolist()}
+            from_date = (history_keys["yesterday"].iloc[0] - lookback).date()
+            to_date = history_keys["yesterday"].iloc[-1].date()
+            history = datastore.get_rows_by_timestamp_range(keys, from_date, to_date, timestamp_column="Date")
+        else:
+            # Datastore without range scans: lookups of every day of the window, latest first, until a row is found
+            history = []
+            for server, login, yesterday in history_keys.itertuples(index=False, name=None):
+                for days in range(cls.history_lookback_days + 1):
+                    date = (yesterday - pd.Timedelta(days=days)).date()
+                    keys = {"server": server, "Login": login}
+                    row = datastore.get_row_by_timestamp(keys, date, timestamp_column="Date")
+                    if row is not None:
+                        history.append({"server": server, "Login": login, "Date": date,
+                                        "Balance": row["Balance"], "ProfitEquity": row["ProfitEquity"]})
+                        break
+            history = pd.DataFrame(history, columns=["server", "Login", "Date", "Balance", "ProfitEquity"])
+        history = pd.DataFrame({"server": history["server"].astype(str).to_numpy(dtype=object),
+                                "login": history["Login"].to_numpy(dtype="int64"),
+                                "Date": pd.to_datetime(history["Date"]).astype(history_keys["yesterday"].dtype),
+                                "Balance": history["Balance"].to_numpy(dtype=float),
+                                "ProfitEquity": history["ProfitEquity"].to_numpy(dtype=float)})
+        history_keys = pd.merge_asof(history_keys, history.sort_values("Date", kind="stable"), left_on="yesterday",
+                                     right_on="Date", by=["server", "login"], direction="backward", tolerance=lookback)
+        history_keys = history_keys.drop(columns="Date")
+        history_keys["yesterday"] = history_keys["yesterday"].dt.date
+        return history_keys
+
+    @staticmethod
+    def yesterday_history_by_key(history:pd.DataFrame) -> Dict[tuple, Dict[str, float]]:
+        # get_yesterday_history as {(server, login, yesterday): {"Balance", "ProfitEquity"} or None}
+        return {(server, login, yesterday):
+                None if np.isnan(balance) else {"Balance": balance, "ProfitEquity": profit_equity}
+                for server, login, yesterday, balance, profit_equity in history.itertuples(index=False, name=None)}
+
+    @classmethod
+    def get_yesterday_history_of_deal(cls, deal:pd.Series, additional_data:Dict[str,Any]):
+        # MT5DealDaily row of the day before the deal for calculate_row (see get_yesterday_history), None if there is
+        # none
+        yesterday_history = additional_data.get("yesterday_history")
+        if yesterday_history is None:
+            deals = pd.DataFrame({"server": [deal["server"]], "login": [deal["login"]], "Time": [deal["Time"]]})
+            yesterday_history = cls.yesterday_history_by_key(cls.get_yesterday_history(deals))
+        yesterday = pd.to_datetime(deal["Time"], unit="s").date() - datetime.timedelta(days=1)
+        return yesterday_history.get((str(deal["server"]), deal["login"], yesterday))
+
+    @classmethod
+    def attach_yesterday_history(cls, deals:pd.DataFrame) -> pd.DataFrame:
+        # deals with the Balance/ProfitEquity of get_yesterday_history as YesterdayBalance/YesterdayProfitEquity
+        # columns
+        with cls.timed("history_fetch"):
+            keys = cls.yesterday_keys(deals)
+            history = cls.get_yesterday_history(deals)
+            history["yesterday"] = pd.to_datetime(history["yesterday"]).astype(keys["yesterday"].dtype)
+            history = keys.merge(history, how="left", on=["server", "login", "yesterday"])
+        return deals.assign(YesterdayBalance=history["Balance"].to_numpy(),
+                            YesterdayProfitEquity=history["ProfitEquity"].to_numpy())
+
+    @classmethod
+    def get_yesterday_max_balance_equity(cls, deals:pd.DataFrame, default:np.ndarray) -> np.ndarray:
+        # max(Balance, ProfitEquity) of the MT5DealDaily row of the day before each deal, default where there is none
+        if "YesterdayBalance" not in deals.columns:
+            deals = cls.attach_yesterday_history(deals)
+        max_balance_equity = np.maximum(deals["YesterdayBalance"].to_numpy(dtype=float),
+                                        deals["YesterdayProfitEquity"].to_numpy(dtype=float))
+        return np.where(np.isnan(max_balance_equity), default, max_balance_equity)
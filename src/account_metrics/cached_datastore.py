@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Type
+
+import pandas as pd
+
+from account_metrics.metric_model import MetricData
+
+
+class CachedDatastore:
+    # Bounded LRU of the latest row of every key in front of a Datastore. get_latest_rows and get_latest_row are served
+    # from memory for cached keys (including keys known to have no row). put writes through to the datastore and
+    # refreshes the cached rows; the put of the datastore itself is routed through the cache as well, so writes made
+    # to it directly do not leave stale rows behind. Everything else is delegated to the wrapped datastore.
+    # Rows have the fields of metric_data, the metric of the datastore, and are keyed by key_columns
+    # (Meta.groupby_update_format by default). Calls from several threads are serialized by a lock held for the whole
+    # call, datastore round trip included, so a row read before a concurrent put cannot be cached after it.
+    def __init__(self, datastore:Any, metric_data:Type[MetricData], key_columns:List[str] = None,
+                 max_entries:int = 100_000, ttl:float = None, clock:Callable[[], float] = time.monotonic):
+        self.datastore = datastore
+        self.metric_data = metric_data
+        self.key_columns = list(key_columns if key_columns is not None else metric_data.Meta.groupby_update_format)
+        self.columns: List[str] = list(metric_data.model_fields)
+        self.max_entries = max_entries
+        # Seconds a cached row is trusted, None to keep it until evicted
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (time cached, row values or None when the datastore has no row for the key)
+        self.rows: OrderedDict[tuple, Tuple[float, tuple]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+        self.datastore_put = datastore.put
+        datastore.put = self.put
+
+    def __getattr__(self, name:str):
+        return getattr(self.datastore, name)
+
+    def get_latest_rows(self, keys:pd.DataFrame) -> pd.DataFrame:
+        if list(keys.columns) != self.key_columns:
+            return self.datastore.get_latest_rows(keys)
+        with self.lock:
+            now = self.clock()
+            found, missing = [], []
+            for key in keys.itertuples(index=False, name=None):
+                entry = self.cached_entry(key, now)
+                if entry is None:
+                    missing.append(key)
+                elif entry[1] is not None:
+                    found.append(entry[1])
+            if missing:
+                missing_keys = pd.DataFrame(missing, columns=self.key_columns).astype(keys.dtypes.to_dict())
+                if callable(getattr(self.datastore, "get_latest_rows", None)):
+                    stored = self.datastore.get_latest_rows(missing_keys)
+                else:
+                    stored = [self.datastore.get_latest_row(dict(zip(self.key_columns, key, strict=True)))
+                              for key in missing]
+                    stored = pd.DataFrame([row for row in stored if row is not None])
+                stored_rows = self.cache_rows(stored, now)
+                for key in missing:
+                    if key not in stored_rows:
+                        self.cache_row(key, None, now)
+                found.extend(stored_rows.values())
+        return pd.DataFrame.from_records(found, columns=self.columns)
+
+    def get_latest_row(self, keys:Dict[str, Any]) -> pd.Series:
+        if sorted(keys) != sorted(self.key_columns):
+            return self.datastore.get_latest_row(keys)
+        key = tuple(keys[column] for column in self.key_columns)
+        with self.lock:
+            now = self.clock()
+            entry = self.cached_entry(key, now)
+            if entry is None:
+                stored = self.datastore.get_latest_row(keys)
+                row = None if stored is None else tuple(stored.reindex(self.columns))
+                self.cache_row(key, row, now)
+                entry = (now, row)
+        return None if entry[1] is None else pd.Series(entry[1], index=self.columns)
+
+    def cached_entry(self, key:tuple, now:float) -> Tuple[float, tuple]:
+        # Cached entry of key, None on a miss (never cached, evicted or expired)
+        entry = self.rows.get(key)
+        if entry is not None and self.ttl is not None and now - entry[0] > self.ttl:
+            del self.rows[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.rows.move_to_end(key)
+        return entry
+
+    def put(self, data:Any):
+        with self.lock:
+            self.datastore_put(data)
+            if isinstance(data, pd.DataFrame):
+                self.cache_rows(data, self.clock())
+            else:
+                # Rows the cache cannot read: forget everything rather than serve stale rows
+                self.rows.clear()
+
+    def cache_rows(self, data:pd.DataFrame, now:float) -> Dict[tuple, tuple]:
+        # Caches the last row of every key in data, returns them by key
+        if data is None or data.empty:
+            return {}
+        latest = data.drop_duplicates(subset=self.key_columns, keep="last").reindex(columns=self.columns)
+        keys = latest[self.key_columns].itertuples(index=False, name=None)
+        latest_rows = dict(zip(keys, latest.itertuples(index=False, name=None), strict=True))
+        for key, row in latest_rows.items():
+            self.cache_row(key, row, now)
+        return latest_rows
+
+    def cache_row(self, key:tuple, row:tuple, now:float):
+        self.rows[key] = (now, row)
+        self.rows.move_to_end(key)
+        while len(self.rows) > self.max_entries:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.rows), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+class CachedMetricRunner:
+    # Metric runner whose datastores of cached_metrics are wrapped in a CachedDatastore keyed by
+    # Meta.groupby_update_format, e.g.
+    # AccountMetricByDealCalculator.set_metric_runner(CachedMetricRunner(runner, [AccountMetricByDeal]))
+    def __init__(self, metric_runner:Any, cached_metrics:Iterable[Type[MetricData]], max_entries:int = 100_000,
+                 ttl:float = None):
+        self.metric_runner = metric_runner
+        self.cached_metrics = list(cached_metrics)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.datastores: Dict[Type[MetricData], CachedDatastore] = {}
+
+    def __getattr__(self, name:str):
+        return getattr(self.metric_runner, name)
+
+    def get_datastore(self, metric_data:Type[MetricData]) -> Any:
+        if metric_data not in self.cached_metrics:
+            return self.metric_runner.get_datastore(metric_data)
+        if metric_data not in self.datastores:
+            self.datastores[metric_data] = CachedDatastore(self.metric_runner.get_datastore(metric_data), metric_data,
+                                                           max_entries=self.max_entries, ttl=self.ttl)
+        return self.datastores[metric_data]
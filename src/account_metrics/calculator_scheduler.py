@@ -0,0 +1,179 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Type
+
+import pandas as pd
+
+from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.memory_datastore import MemoryDatastore
+from account_metrics.metric_model import MetricCalculator, MetricData
+
+# (calculator, input, vectorized, metric runner) of the stage being run by a process pool. Forked workers inherit them
+# instead of receiving pickled copies (identity calculators are local classes and cannot be pickled).
+_stage = None
+
+def _run_stage_calculator(position:int) -> pd.DataFrame:
+    return run_calculator(*_stage[position])
+
+def run_calculator(calculator:Type[MetricCalculator], input_data:Any, vectorized:bool = None,
+                   metric_runner:Any = None) -> pd.DataFrame:
+    # metric_runner is used by this calculation only, the metric runner of the calculator class is left as is
+    if input_data is None:
+        return calculator.output_metric.empty_frame()
+    if issubclass(calculator, BasicDealMetricCalculator):
+        return calculator.calculate(input_data, vectorized=vectorized, metric_runner=metric_runner)
+    with calculator.using_metric_runner(metric_runner):
+        return calculator.calculate(input_data, None)
+
+class StagedDatastore:
+    # Datastore of a metric calculated earlier in the same run: rows of the run (in a MemoryDatastore) are read in
+    # front of the stored ones, as if they had been written, so dependents get them without a round trip through
+    # storage. put goes to the datastore.
+    def __init__(self, datastore:Any, metric_data:Type[MetricData], data:pd.DataFrame):
+        self.datastore = datastore
+        self.staged = MemoryDatastore(metric_data, data)
+
+    def __getattr__(self, name:str):
+        return getattr(self.datastore, name)
+
+    def get_latest_row(self, keys:Dict[str, Any]) -> pd.Series:
+        row = self.staged.get_latest_row(keys)
+        return row if row is not None else self.datastore.get_latest_row(keys)
+
+    def get_latest_rows(self, keys:pd.DataFrame) -> pd.DataFrame:
+        # Stored rows first, a key found in both keeps the staged row last
+        stored = None
+        if callable(getattr(self.datastore, "get_latest_rows", None)):
+            stored = self.datastore.get_latest_rows(keys)
+        return self._concat(stored, self.staged.get_latest_rows(keys))
+
+    def get_row_by_timestamp(self, keys:Dict[str, Any], timestamp:Any, timestamp_column:str) -> pd.Series:
+        row = self.staged.get_row_by_timestamp(keys, timestamp, timestamp_column)
+        return row if row is not None else self.datastore.get_row_by_timestamp(keys, timestamp, timestamp_column)
+
+    def get_rows_by_timestamp_range(self, keys:Dict[str, list], from_timestamp:Any, to_timestamp:Any,
+                                    timestamp_column:str) -> pd.DataFrame:
+        stored = None
+        if callable(getattr(self.datastore, "get_rows_by_timestamp_range", None)):
+            stored = self.datastore.get_rows_by_timestamp_range(keys, from_timestamp, to_timestamp, timestamp_column)
+        staged = self.staged.get_rows_by_timestamp_range(keys, from_timestamp, to_timestamp, timestamp_column)
+        return self._concat(stored, staged)
+
+    def put(self, data:Any):
+        self.datastore.put(data)
+
+    def _concat(self, stored:pd.DataFrame, staged:pd.DataFrame) -> pd.DataFrame:
+        if stored is None or stored.empty:
+            return staged
+        return pd.concat([stored, staged], ignore_index=True) if not staged.empty else stored
+
+class StagedMetricRunner:
+    # Metric runner whose datastores of the metrics in staged are StagedDatastore
+    def __init__(self, metric_runner:Any, staged:Dict[Type[MetricData], pd.DataFrame]):
+        self.metric_runner = metric_runner
+        self.staged = staged
+        self.datastores: Dict[Type[MetricData], StagedDatastore] = {}
+
+    def __getattr__(self, name:str):
+        return getattr(self.metric_runner, name)
+
+    def get_datastore(self, metric_data:Type[MetricData]) -> Any:
+        if metric_data not in self.staged:
+            return self.metric_runner.get_datastore(metric_data)
+        if metric_data not in self.datastores:
+            datastore = self.metric_runner.get_datastore(metric_data)
+            self.datastores[metric_data] = StagedDatastore(datastore, metric_data, self.staged[metric_data])
+        return self.datastores[metric_data]
+
+class CalculatorScheduler:
+    # Runs calculators in the order of the DAG of their declarations: a calculator depends on the calculators producing
+    # its input_class and its additional_data (its own output_metric excluded, it is read from its datastore).
+    # Calculators of a stage have no dependency between them and are run at the same time on a thread pool, or on a
+    # pool of forked processes with executor="process". Outputs are passed to dependents in memory: as input_data for
+    # input_class, through a StagedDatastore for additional_data. The metric runner of a calculation (metric_runner, by
+    # default the one set on the calculator) is passed to it, calculator classes are not modified, so other callers and
+    # schedulers can use them at the same time. With the thread executor the datastores must accept calls from several
+    # threads (MemoryDatastore, SQLiteDatastore).
+    # e.g. CalculatorScheduler(METRIC_CALCULATORS.values()).run({"Deal": deals, "History": history})
+    def __init__(self, calculators:Iterable[Type[MetricCalculator]], executor:str = "thread", max_workers:int = None,
+                 vectorized:bool = None, metric_runner:Any = None):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor {executor}")
+        self.calculators = list(calculators)
+        self.executor = executor
+        self.max_workers = max_workers
+        self.vectorized = vectorized
+        self.metric_runner = metric_runner
+        self.producers: Dict[Any, Type[MetricCalculator]] = {calculator.output_metric: calculator
+                                                             for calculator in self.calculators}
+        self.stages = self.build_stages()
+
+    def dependencies(self, calculator:Type[MetricCalculator]) -> List[Type[MetricCalculator]]:
+        metrics = [calculator.input_class, *(calculator.additional_data or [])]
+        return [self.producers[metric] for metric in dict.fromkeys(metrics)
+                if metric is not calculator.output_metric and metric in self.producers]
+
+    def build_stages(self) -> List[List[Type[MetricCalculator]]]:
+        # Stages of the topological order: every calculator is in the stage after the last of its dependencies
+        stages = []
+        done = set()
+        remaining = list(self.calculators)
+        while remaining:
+            stage = [calculator for calculator in remaining
+                     if all(dependency in done for dependency in self.dependencies(calculator))]
+            if not stage:
+                cycle = ", ".join(calculator.__name__ for calculator in remaining)
+                raise ValueError(f"Cyclic dependencies between {cycle}")
+            stages.append(stage)
+            done.update(stage)
+            remaining = [calculator for calculator in remaining if calculator not in done]
+        return stages
+
+    def run(self, inputs:Dict[Any, pd.DataFrame]) -> Dict[Type[MetricData], pd.DataFrame]:
+        # inputs: the input_data of calculators whose input is not calculated in the run, the frames of the identity
+        # calculators by key (e.g. "Deal") or input frames by metric. Returns the output of every calculator by
+        # output_metric; nothing is written.
+        outputs: Dict[Type[MetricData], pd.DataFrame] = {}
+        # Outputs read as additional_data by a later stage
+        consumed = {metric for calculator in self.calculators for metric in (calculator.additional_data or [])
+                    if metric is not calculator.output_metric}
+        for stage in self.stages:
+            staged = {metric: output for metric, output in outputs.items() if metric in consumed}
+            results = self.run_stage(stage, inputs, outputs, staged)
+            outputs.update(zip([calculator.output_metric for calculator in stage], results, strict=True))
+        return outputs
+
+    def metric_runner_of(self, calculator:Type[MetricCalculator], staged:Dict[Type[MetricData], pd.DataFrame]) -> Any:
+        metric_runner = self.metric_runner or calculator.metric_runner
+        return StagedMetricRunner(metric_runner, staged) if staged and metric_runner is not None else metric_runner
+
+    def run_stage(self, stage:List[Type[MetricCalculator]], inputs:Dict[Any, pd.DataFrame],
+                  outputs:Dict[Type[MetricData], pd.DataFrame],
+                  staged:Dict[Type[MetricData], pd.DataFrame]) -> List[pd.DataFrame]:
+        tasks = [(calculator, self.input_of(calculator, inputs, outputs), self.vectorized,
+                  self.metric_runner_of(calculator, staged))
+                 for calculator in stage]
+        if len(tasks) == 1:
+            return [run_calculator(*tasks[0])]
+        if self.executor == "thread":
+            with ThreadPoolExecutor(self.max_workers or len(tasks)) as pool:
+                return list(pool.map(run_calculator, *zip(*tasks, strict=True)))
+
+        global _stage
+        _stage = tasks
+        try:
+            mp_context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(self.max_workers or len(tasks), mp_context=mp_context) as pool:
+                return list(pool.map(_run_stage_calculator, range(len(tasks))))
+        finally:
+            _stage = None
+
+    def input_of(self, calculator:Type[MetricCalculator], inputs:Dict[Any, pd.DataFrame],
+                 outputs:Dict[Type[MetricData], pd.DataFrame]) -> Any:
+        # Output of the producer of input_class, else the input frame of input_class; identity calculators take inputs
+        # as is
+        if calculator.input_class in outputs:
+            return outputs[calculator.input_class]
+        if isinstance(calculator.input_class, type) and issubclass(calculator.input_class, MetricData):
+            return inputs.get(calculator.input_class)
+        return inputs
@@ -0,0 +1,175 @@
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Tuple, Type
+
+import pandas as pd
+
+from account_metrics.metric_model import MetricData
+from account_metrics.mt5_deal import MT5Deal
+
+# Superset/ClickHouse export column -> MT5Deal field
+SUPERSET_DEAL_COLUMNS: Dict[str, str] = {
+    "deal_id": "Deal",
+    "external_id": "ExternalID",
+    "login": "Login",
+    "dealer": "Dealer",
+    "order_id": "Order",
+    "action": "Action",
+    "entry": "Entry",
+    "digits": "Digits",
+    "digits_currency": "DigitsCurrency",
+    "contract_size": "ContractSize",
+    "symbol": "Symbol",
+    "volume": "Volume",
+    "profit": "Profit",
+    "storage": "Storage",
+    "commission": "Commission",
+    "rate_profit": "RateProfit",
+    "rate_margin": "RateMargin",
+    "expert_id": "ExpertID",
+    "position_id": "PositionID",
+    "comment": "Comment",
+    "profit_raw": "ProfitRaw",
+    "reason": "Reason",
+    "gateway": "Gateway",
+    "price_gateway": "PriceGateway",
+    "fee": "Fee",
+    "value": "Value",
+    "server": "server"
+}
+
+def schema_dtypes(metric:Type[MetricData], columns:Dict[str, str]) -> Dict[str, str]:
+    # Dtypes of the source columns mapped to a field of metric: int64, float64, object for str
+    dtypes = {}
+    for source, field in columns.items():
+        if field in metric.model_fields:
+            annotation = metric.model_fields[field].annotation
+            dtypes[source] = "int64" if annotation is int else "float64" if annotation is float else "object"
+    return dtypes
+
+def csv_schema(input_path:str, header_mapping:Dict[str, str] = None, metric:Type[MetricData] = MT5Deal) -> dict:
+    # How the columns of the CSV are read: source header, renaming through header_mapping, parser dtypes from the
+    # fields of metric and the text/int columns fixed up after parsing (see type_chunk)
+    header_mapping = header_mapping or {}
+    source_columns = list(pd.read_csv(input_path, nrows=0).columns)
+    columns = {column: header_mapping.get(column, column) for column in source_columns}
+    dtypes = schema_dtypes(metric, columns)
+    # Int columns are left to the parser (int64 when complete, float64 with empty cells), the nullable Int64 parser
+    # being much slower
+    return {"source_columns": source_columns, "columns": columns,
+            "read_dtypes": {source: dtype for source, dtype in dtypes.items() if dtype != "int64"},
+            "text_columns": [columns[source] for source, dtype in dtypes.items() if dtype == "object"],
+            "int_columns": [columns[source] for source, dtype in dtypes.items() if dtype == "int64"]}
+
+def type_chunk(chunk:pd.DataFrame, schema:dict) -> pd.DataFrame:
+    # Parsed chunk renamed and typed: empty text as "", int columns with empty cells as nullable Int64
+    chunk = chunk.rename(columns=schema["columns"], copy=False)
+    chunk[schema["text_columns"]] = chunk[schema["text_columns"]].fillna("")
+    incomplete = [column for column in schema["int_columns"] if chunk[column].dtype != "int64"]
+    if incomplete:
+        chunk[incomplete] = chunk[incomplete].astype("Int64")
+    return chunk
+
+def read_csv_chunks(input_path:str, header_mapping:Dict[str, str] = None, metric:Type[MetricData] = MT5Deal,
+                    chunksize:int = 100_000, limit:int = None) -> Iterator[pd.DataFrame]:
+    # Chunks of chunksize rows of the CSV with the columns renamed through header_mapping and typed from the fields of
+    # metric. Only one chunk is in memory at a time; limit stops after that many rows.
+    schema = csv_schema(input_path, header_mapping, metric)
+    for chunk in pd.read_csv(input_path, dtype=schema["read_dtypes"], chunksize=chunksize, nrows=limit):
+        yield type_chunk(chunk, schema)
+
+def read_csv_blocks(input_path:str, chunksize:int = 100_000, limit:int = None) -> Iterator[str]:
+    # Raw text of the records of the CSV after the header, chunksize records at a time, without parsing them: a line
+    # ending inside a quoted field (odd number of quotes so far) is continued by the next one. Blank lines are skipped
+    # as the parser does; limit stops after that many records.
+    with open(input_path, encoding="utf-8", newline="") as infile:
+        infile.readline()
+        block, records, total, quotes = [], 0, 0, 0
+        for line in infile:
+            if not quotes and not line.strip("\r\n"):
+                continue
+            block.append(line)
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            quotes = 0
+            records += 1
+            total += 1
+            if records == chunksize or total == limit:
+                yield "".join(block)
+                block, records = [], 0
+                if total == limit:
+                    return
+        if block:
+            yield "".join(block)
+
+def _convert_csv_block(block:str, schema:dict) -> Tuple[str, int]:
+    # One block of read_csv_blocks parsed, typed and formatted again as CSV, and its number of rows
+    chunk = pd.read_csv(io.StringIO(block), header=None, names=schema["source_columns"], dtype=schema["read_dtypes"])
+    return type_chunk(chunk, schema).to_csv(index=False, header=False), len(chunk)
+
+def convert_csv(input_path:str, output_path:str, header_mapping:Dict[str, str] = None,
+                metric:Type[MetricData] = MT5Deal, chunksize:int = 100_000, output_format:str = None,
+                processes:int = 1, limit:int = None) -> int:
+    # Streams input_path into output_path chunk by chunk as CSV or Parquet (output_format, by default from the
+    # extension of output_path). Returns the number of rows written. CSV output is converted one block of chunksize raw
+    # records at a time (see read_csv_blocks): with processes > 1 the blocks are parsed and formatted by a pool of
+    # workers, the parent only splitting the file into records, with at most 2 * processes blocks in flight. The output
+    # is the same whatever the number of processes.
+    output_format = output_format or ("parquet" if str(output_path).endswith(".parquet") else "csv")
+    if output_format == "parquet":
+        chunks = read_csv_chunks(input_path, header_mapping, metric, chunksize, limit)
+        return _write_parquet(chunks, output_path, metric)
+    if output_format != "csv":
+        raise ValueError(f"Unknown output format {output_format}")
+
+    schema = csv_schema(input_path, header_mapping, metric)
+    blocks = read_csv_blocks(input_path, chunksize, limit)
+    rows = 0
+    with open(output_path, mode="w", newline="") as outfile:
+        pd.DataFrame(columns=list(schema["columns"].values())).to_csv(outfile, index=False)
+        if processes <= 1:
+            for block in blocks:
+                rows += _write_block(outfile, _convert_csv_block(block, schema))
+            return rows
+
+        with ProcessPoolExecutor(processes) as pool:
+            in_flight = deque()
+            for block in blocks:
+                in_flight.append(pool.submit(_convert_csv_block, block, schema))
+                if len(in_flight) >= 2 * processes:
+                    rows += _write_block(outfile, in_flight.popleft().result())
+            while in_flight:
+                rows += _write_block(outfile, in_flight.popleft().result())
+    return rows
+
+def _write_block(outfile, converted:Tuple[str, int]) -> int:
+    text, rows = converted
+    outfile.write(text)
+    return rows
+
+def _write_parquet(chunks:Iterator[pd.DataFrame], output_path:str, metric:Type[MetricData]) -> int:
+    # Columns of metric get the Arrow type of the model (see parquet_loader.arrow_schema), the others the one inferred
+    # from the first chunk
+    from account_metrics.parquet_loader import _require_pyarrow, arrow_type
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                inferred = pa.Schema.from_pandas(chunk, preserve_index=False)
+                fields = metric.model_fields
+                schema = pa.schema([pa.field(field.name, arrow_type(field.name, fields[field.name].annotation))
+                                    if field.name in fields else field for field in inferred])
+                writer = pq.ParquetWriter(output_path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
@@ -0,0 +1,125 @@
+import os
+from typing import Dict, Iterable, List, Tuple, Type
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.metric_model import MetricData
+from account_metrics.metric_state import MetricState
+from account_metrics.metric_utils import is_group_start, sort_by_group
+from account_metrics.mt5_deal import MT5Deal
+
+
+class DealArchive:
+    # On-disk archive of MT5Deal rows for replays: one fixed-width .npy file per column (text as fixed-width unicode),
+    # memory-mapped read-only so that processes reading the same archive share the page cache. Rows are sorted by
+    # (server, login, Time, Deal) and index.npy holds the [start, end) rows of every (server, login), so reading an
+    # account only touches the pages of its rows.
+    key_columns = ["server", "login"]
+
+    def __init__(self, path:str):
+        self.path = path
+        index = np.load(os.path.join(path, "index.npy"))
+        self.offsets: Dict[Tuple[str, int], Tuple[int, int]] = {
+            (str(server), int(login)): (int(start), int(end)) for server, login, start, end in index
+        }
+        self.columns: List[str] = np.load(os.path.join(path, "columns.npy")).tolist()
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    @classmethod
+    def write(cls, path:str, deals:pd.DataFrame, metric:Type[MetricData] = MT5Deal) -> "DealArchive":
+        # Writes the fields of metric in deals (decoded text) as a new archive at path, replacing its columns
+        deals, group_index = sort_by_group(deals, cls.key_columns)
+        os.makedirs(os.path.join(path, "columns"), exist_ok=True)
+        columns = [column for column in metric.model_fields if column in deals.columns]
+        for column in columns:
+            values = deals[column].to_numpy()
+            if values.dtype == object or isinstance(deals[column].dtype, (pd.StringDtype, pd.CategoricalDtype)):
+                values = deals[column].astype(object).fillna("").to_numpy(dtype=str)
+            np.save(os.path.join(path, "columns", f"{column}.npy"), values)
+        np.save(os.path.join(path, "columns.npy"), np.array(columns, dtype=str))
+
+        start = np.flatnonzero(is_group_start(group_index)) if len(deals) else np.array([], dtype="int64")
+        servers = deals["server"].iloc[start].astype(str).to_numpy(dtype=str)
+        index_dtype = [("server", servers.dtype), ("login", "int64"), ("start", "int64"), ("end", "int64")]
+        index = np.empty(len(start), dtype=index_dtype)
+        index["server"] = servers
+        index["login"] = deals["login"].iloc[start].to_numpy(dtype="int64")
+        index["start"] = start
+        index["end"] = np.r_[start[1:], len(deals)]
+        np.save(os.path.join(path, "index.npy"), index)
+        return cls(path)
+
+    def column(self, name:str) -> np.ndarray:
+        # Memory-mapped column, opened on first use
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, "columns", f"{name}.npy"), mmap_mode="r")
+        return self.arrays[name]
+
+    def keys(self) -> List[Tuple[str, int]]:
+        return list(self.offsets)
+
+    def rows(self, keys:Iterable[Tuple[str, int]] = None) -> List[Tuple[int, int]]:
+        # [start, end) rows of keys in archive order, keys not in the archive being ignored
+        if keys is None:
+            return list(self.offsets.values())
+        return sorted(self.offsets[key] for key in keys if key in self.offsets)
+
+    def runs(self, keys:Iterable[Tuple[str, int]] = None) -> List[Tuple[int, int]]:
+        # rows of keys with adjacent accounts merged, i.e. the fewest contiguous [start, end) slices covering them
+        runs = []
+        for start, end in self.rows(keys):
+            if runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+        return runs
+
+    def read(self, keys:Iterable[Tuple[str, int]] = None, columns:List[str] = None) -> Dict[str, np.ndarray]:
+        # Columns of the deals of keys (all by default) sorted by (server, login, Time, Deal). The arrays of contiguous
+        # accounts (a single key, the whole archive) are views of the memory maps, the slices of scattered accounts are
+        # joined into new arrays.
+        columns = self.columns if columns is None else [column for column in columns if column in self.columns]
+        runs = self.runs(keys)
+        if len(runs) == 1:
+            return self.read_rows(*runs[0], columns)
+        if not runs:
+            return {column: self.column(column)[:0] for column in columns}
+        return {column: np.concatenate([self.column(column)[start:end] for start, end in runs]) for column in columns}
+
+    def read_rows(self, start:int, end:int, columns:List[str]) -> Dict[str, np.ndarray]:
+        # Views of the memory maps over [start, end)
+        return {column: self.column(column)[start:end] for column in columns}
+
+    @staticmethod
+    def to_frame(arrays:Dict[str, np.ndarray]) -> pd.DataFrame:
+        # numeric columns are not copied (one block per column), text columns become Python str
+        columns = {column: values.astype(object) if values.dtype.kind == "U" else values
+                   for column, values in arrays.items()}
+        return pd.DataFrame(columns, copy=False)
+
+    def frame(self, keys:Iterable[Tuple[str, int]] = None, columns:List[str] = None) -> pd.DataFrame:
+        # read as a DataFrame
+        return self.to_frame(self.read(keys, columns))
+
+    def replay(self, calculator, keys:Iterable[Tuple[str, int]] = None, state:MetricState = None) -> pd.DataFrame:
+        # Runs the vectorized engine of calculator over the archived deals of keys, reading only the columns it
+        # declares. Calculators grouped by (server, login) get the deals in their order already: every contiguous run
+        # of accounts goes to the engine as views of the memory maps, without sorting or gathering. The others sort the
+        # joined deals as usual.
+        columns = calculator.get_input_columns()
+        columns = self.columns if columns is None else [column for column in columns if column in self.columns]
+        if calculator.output_metric.Meta.groupby != self.key_columns:
+            deals = self.frame(keys, columns)
+            if deals.empty:
+                return calculator.output_metric.empty_frame()
+            return calculator.calculate_vectorized(deals, state=state)
+        results = []
+        for start, end in self.runs(keys):
+            deals = self.to_frame(self.read_rows(start, end, columns))
+            is_start = is_group_start(deals["login"].to_numpy()) | is_group_start(deals["server"].to_numpy())
+            group_index = np.cumsum(is_start) - 1
+            results.append(calculator.calculate_vectorized(deals, sorted_batch=(deals, group_index), state=state))
+        if not results:
+            return calculator.output_metric.empty_frame()
+        return pd.concat(results, ignore_index=True) if len(results) > 1 else results[0]
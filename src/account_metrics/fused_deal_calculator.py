@@ -0,0 +1,58 @@
+from typing import Any, Dict, List, Tuple, Type
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.account_metric_by_day import AccountMetricDailyCalculator
+from account_metrics.account_metric_by_deal import AccountMetricByDealCalculator
+from account_metrics.account_symbol_metric_by_deal import AccountSymbolMetricByDealCalculator
+from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_model import MetricData, input_columns_of
+from account_metrics.metric_utils import enum_values, project_columns
+from account_metrics.position_metric_by_deal import PositionMetricByDealCalculator
+
+
+class FusedDealMetricCalculator:
+    # Runs the vectorized engine of every deal-driven calculator on one MT5Deal batch. The batch is decoded, joined
+    # with the MT5DealDaily history and sorted by (Time, Deal) once; calculators with the same groupby share the
+    # grouped batch.
+    calculators: List[Type[BasicDealMetricCalculator]] = [AccountMetricByDealCalculator, AccountMetricDailyCalculator,
+                                                          AccountSymbolMetricByDealCalculator,
+                                                          PositionMetricByDealCalculator]
+
+    @classmethod
+    def calculate(cls, input_data:pd.DataFrame) -> Dict[Type[MetricData], pd.DataFrame]:
+        if input_data is None or input_data.empty:
+            return {calculator.output_metric: calculator.output_metric.empty_frame() for calculator in cls.calculators}
+
+        deals = cls.prepare_batch(input_data)
+        time_order = np.lexsort((deals["Deal"].to_numpy(), deals["Time"].to_numpy()))
+        sorted_batches: Dict[Tuple[str, ...], Tuple[pd.DataFrame, np.ndarray]] = {}
+        result = {}
+        for calculator in cls.calculators:
+            groupby = tuple(calculator.output_metric.Meta.groupby)
+            if groupby not in sorted_batches:
+                sorted_batches[groupby] = calculator.sort_batch(deals, time_order)
+            sorted_batch = sorted_batches[groupby]
+            result[calculator.output_metric] = calculator.calculate_vectorized(deals, sorted_batch=sorted_batch)
+        return result
+
+    @classmethod
+    def prepare_batch(cls, input_data:pd.DataFrame) -> pd.DataFrame:
+        # Work shared by all calculators: only the columns read by one of them, text columns decoded, Action/Entry as
+        # integers and the yesterday history of every deal
+        columns = input_columns_of(cls.calculators)
+        deals = input_data
+        if columns is not None:
+            deals = project_columns(input_data, [column for column in columns if column in input_data.columns])
+        deals = cls.calculators[0].decode_batch(deals)
+        deals = deals.assign(Action=enum_values(deals["Action"]), Entry=enum_values(deals["Entry"]))
+        history_calculators = [calculator for calculator in cls.calculators if calculator.uses_yesterday_history]
+        if history_calculators:
+            deals = history_calculators[0].attach_yesterday_history(deals)
+        return deals
+
+    @classmethod
+    def set_metric_runner(cls, metric_runner: Any):
+        for calculator in cls.calculators:
+            calculator.set_metric_runner(metric_runner)
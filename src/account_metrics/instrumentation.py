@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Dict, List, Tuple
+
+# Stage timer of calculators without instrumentation: a shared no-op context manager
+NO_TIMER = nullcontext()
+
+# Datastore methods timed by InstrumentedDatastore
+DATASTORE_METHODS = ("get_latest_row", "get_latest_rows", "get_row_by_timestamp", "get_rows_by_timestamp_range", "put")
+
+class InstrumentationRegistry:
+    # In-process counters of calculator calls, e.g. MetricCalculator.set_instrumentation(registry) to record every
+    # calculator:
+    #   calls_total, rows_in_total, rows_out_total, groups_total, stale_deals_total  {calculator}
+    #   stage_seconds_total, stage_calls_total                                       {calculator, stage}
+    #   datastore_calls_total, datastore_seconds_total                               {calculator, datastore, method}
+    # Stage times exclude the stages nested in them (e.g. frame_build in row_compute), so the stages of a calculate
+    # call add up to its time. Calls made in forked workers (processes > 1) are recorded in the workers, the parent
+    # only records the calculate call.
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> sorted label pairs -> value
+        self.values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        # Stack of the stage timers running in the thread
+        self.local = threading.local()
+
+    def inc(self, name:str, value:float = 1, **labels:str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counter = self.values.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def get(self, name:str, **labels:str) -> float:
+        return self.values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def timer(self, calculator:str, stage:str) -> "StageTimer":
+        return StageTimer(self, calculator, stage)
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self.lock:
+            return {name: [{"labels": dict(labels), "value": value} for labels, value in counter.items()]
+                    for name, counter in self.values.items()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix:str = "account_metrics") -> str:
+        # Prometheus text exposition format, every value being a counter
+        lines = []
+        for name, samples in self.snapshot().items():
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for sample in samples:
+                labels = ",".join(f'{label}="{prometheus_label_value(value)}"'
+                                  for label, value in sample["labels"].items())
+                lines.append(f"{prefix}_{name}{{{labels}}} {prometheus_value(sample['value'])}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+def prometheus_label_value(value:Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_value(value:float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class StageTimer:
+    # Adds the time of its block, minus the time of the stage timers nested in it, to stage_seconds_total
+    __slots__ = ("registry", "calculator", "stage", "start", "nested")
+
+    def __init__(self, registry:InstrumentationRegistry, calculator:str, stage:str):
+        self.registry = registry
+        self.calculator = calculator
+        self.stage = stage
+
+    def __enter__(self):
+        stack = self.registry.local.__dict__.setdefault("timers", [])
+        stack.append(self)
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = self.registry.local.timers
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.registry.inc("stage_seconds_total", elapsed - self.nested, calculator=self.calculator, stage=self.stage)
+        self.registry.inc("stage_calls_total", calculator=self.calculator, stage=self.stage)
+        return False
+
+class InstrumentedDatastore:
+    # Datastore counting and timing the calls of a calculator to DATASTORE_METHODS, everything else is delegated as is
+    def __init__(self, datastore:Any, registry:InstrumentationRegistry, calculator:str, datastore_name:str):
+        self.datastore = datastore
+        self.registry = registry
+        self.calculator = calculator
+        self.datastore_name = datastore_name
+
+    def __getattr__(self, name:str):
+        attribute = getattr(self.datastore, name)
+        if name not in DATASTORE_METHODS or not callable(attribute):
+            return attribute
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                labels = {"calculator": self.calculator, "datastore": self.datastore_name, "method": name}
+                self.registry.inc("datastore_seconds_total", time.perf_counter() - start, **labels)
+                self.registry.inc("datastore_calls_total", **labels)
+        return call
+
+class InstrumentedMetricRunner:
+    # Metric runner of an instrumented calculator, its datastores are InstrumentedDatastore
+    def __init__(self, metric_runner:Any, registry:InstrumentationRegistry, calculator:str):
+        self.metric_runner = metric_runner
+        self.registry = registry
+        self.calculator = calculator
+
+    def __getattr__(self, name:str):
+        return getattr(self.metric_runner, name)
+
+    def get_datastore(self, metric_data:Any) -> InstrumentedDatastore:
+        return InstrumentedDatastore(self.metric_runner.get_datastore(metric_data), self.registry, self.calculator,
+                                     metric_data.__name__)
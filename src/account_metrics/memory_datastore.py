@@ -0,0 +1,185 @@
+import threading
+from itertools import product
+from typing import Any, Dict, List, Tuple, Type
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.metric_model import MetricData, buffer_dtype, metric_frame
+
+
+class SortedRows:
+    # Row positions of one key sorted by timestamp, stable (rows of the same timestamp in insertion order), in growable
+    # arrays. Rows arriving in timestamp order are appended, older ones inserted at their searchsorted place.
+    def __init__(self, dtype:Any, capacity:int = 8):
+        self.timestamps = np.empty(capacity, dtype=dtype)
+        self.positions = np.empty(capacity, dtype="int64")
+        self.length = 0
+
+    def add(self, timestamps:np.ndarray, positions:np.ndarray):
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, positions = timestamps[order], positions[order]
+        length = self.length + len(positions)
+        if self.length and timestamps[0] < self.timestamps[self.length - 1]:
+            at = np.searchsorted(self.timestamps[:self.length], timestamps, side="right")
+            timestamps = np.insert(self.timestamps[:self.length], at, timestamps)
+            positions = np.insert(self.positions[:self.length], at, positions)
+            start = 0
+        else:
+            start = self.length
+        if length > len(self.positions):
+            capacity = max(2 * len(self.positions), length)
+            self.timestamps = np.resize(self.timestamps[:self.length], capacity)
+            self.positions = np.resize(self.positions[:self.length], capacity)
+        self.timestamps[start:length] = timestamps
+        self.positions[start:length] = positions
+        self.length = length
+
+    def sorted(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.timestamps[:self.length], self.positions[:self.length]
+
+class MemoryDatastore:
+    # In-memory Datastore of one metric for tests, benchmarks and single-node runs. Rows are appended to one growable
+    # NumPy buffer per field (capacity doubled when full, amortized O(1) per row). Lookups go through hash indexes from
+    # key values to row positions, one per set of key columns queried, and per-key positions sorted by timestamp
+    # (SortedRows), both kept up to date by put so that reads never sort. Indexes are built lazily by lookups, so calls
+    # are serialized by a lock to share the datastore between threads (e.g. CalculatorScheduler workers).
+    def __init__(self, metric_data:Type[MetricData], data:pd.DataFrame = None, capacity:int = 1024):
+        self.metric_data = metric_data
+        self.dtypes = {field: buffer_dtype(dtype) for field, dtype in metric_data.dtypes().items()}
+        self.defaults = {field: None if field_info.is_required() else field_info.default
+                         for field, field_info in metric_data.model_fields.items()}
+        self.buffers: Dict[str, np.ndarray] = {field: np.empty(capacity, dtype=dtype)
+                                               for field, dtype in self.dtypes.items()}
+        self.fields_by_dtype: Dict[str, List[str]] = {}
+        for field, dtype in self.dtypes.items():
+            self.fields_by_dtype.setdefault(dtype, []).append(field)
+        self.length = 0
+        self.lock = threading.RLock()
+        # key columns -> key values -> row positions in insertion order
+        self.indexes: Dict[Tuple[str, ...], Dict[tuple, List[int]]] = {}
+        # (key columns, timestamp column) -> key values -> positions sorted by timestamp
+        self.timestamp_indexes: Dict[Tuple[Tuple[str, ...], str], Dict[tuple, SortedRows]] = {}
+        if data is not None:
+            self.put(data)
+
+    def put(self, data:Any):
+        if data is None or len(data) == 0:
+            return
+        with self.lock:
+            self._put(data)
+
+    def _put(self, data:Any):
+        size = len(data)
+        if self.length + size > len(self.buffers[next(iter(self.buffers))]):
+            capacity = max(2 * len(self.buffers[next(iter(self.buffers))]), self.length + size)
+            for field, buffer in self.buffers.items():
+                self.buffers[field] = np.empty(capacity, dtype=buffer.dtype)
+                self.buffers[field][:self.length] = buffer[:self.length]
+        # One conversion per dtype rather than one Series per field
+        for dtype, fields in self.fields_by_dtype.items():
+            present = [field for field in fields if field in data.columns]
+            values = data[present].to_numpy(dtype=dtype) if present else None
+            for i, field in enumerate(present):
+                self.buffers[field][self.length:self.length + size] = values[:, i]
+            for field in fields:
+                if field not in data.columns:
+                    self.buffers[field][self.length:self.length + size] = self.defaults[field]
+        for key_columns, index in self.indexes.items():
+            added = self._index_rows(key_columns, index, self.length, self.length + size)
+            for (columns, timestamp_column), sorted_index in self.timestamp_indexes.items():
+                if columns == key_columns:
+                    self._sort_rows(sorted_index, timestamp_column, added)
+        self.length += size
+
+    @property
+    def data(self) -> pd.DataFrame:
+        with self.lock:
+            return self._frame(np.arange(self.length))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def get_latest_row(self, keys:Dict[str, Any]) -> pd.Series:
+        with self.lock:
+            positions = self._positions(keys)
+            return self._row(positions[-1]) if positions else None
+
+    def get_latest_rows(self, keys:pd.DataFrame) -> pd.DataFrame:
+        # Latest row of every key of keys (one column per key column) that has one
+        with self.lock:
+            index = self._index(tuple(keys.columns))
+            positions = [index[key][-1] for key in keys.itertuples(index=False, name=None) if key in index]
+            return self._frame(np.array(positions, dtype="int64"))
+
+    def get_row_by_timestamp(self, keys:Dict[str, Any], timestamp:Any, timestamp_column:str) -> pd.Series:
+        # Latest row of the key whose timestamp_column equals timestamp
+        with self.lock:
+            timestamps, positions = self._sorted_by_timestamp(keys, timestamp_column)
+            end = np.searchsorted(timestamps, timestamp, side="right")
+            if end == 0 or timestamps[end - 1] != timestamp:
+                return None
+            return self._row(positions[end - 1])
+
+    def get_rows_by_timestamp_range(self, keys:Dict[str, list], from_timestamp:Any, to_timestamp:Any,
+                                    timestamp_column:str) -> pd.DataFrame:
+        # Rows of every combination of the key values with from_timestamp <= timestamp_column <= to_timestamp, in
+        # insertion order
+        key_columns = tuple(keys.keys())
+        found = []
+        with self.lock:
+            for key in product(*keys.values()):
+                key = dict(zip(key_columns, key, strict=True))
+                timestamps, positions = self._sorted_by_timestamp(key, timestamp_column)
+                start = np.searchsorted(timestamps, from_timestamp, side="left")
+                end = np.searchsorted(timestamps, to_timestamp, side="right")
+                found.append(positions[start:end])
+            return self._frame(np.sort(np.concatenate(found)) if found else np.array([], dtype="int64"))
+
+    def _index(self, key_columns:Tuple[str, ...]) -> Dict[tuple, List[int]]:
+        if key_columns not in self.indexes:
+            self.indexes[key_columns] = {}
+            self._index_rows(key_columns, self.indexes[key_columns], 0, self.length)
+        return self.indexes[key_columns]
+
+    def _index_rows(self, key_columns:Tuple[str, ...], index:Dict[tuple, List[int]],
+                    start:int, end:int) -> Dict[tuple, List[int]]:
+        # Adds rows [start, end) to index, returns their positions by key
+        added = {}
+        keys = zip(*[self.buffers[column][start:end].tolist() for column in key_columns], strict=True)
+        for position, key in enumerate(keys, start):
+            added.setdefault(key, []).append(position)
+        for key, positions in added.items():
+            index.setdefault(key, []).extend(positions)
+        return added
+
+    def _sort_rows(self, sorted_index:Dict[tuple, SortedRows], timestamp_column:str, added:Dict[tuple, List[int]]):
+        timestamps = self.buffers[timestamp_column]
+        for key, positions in added.items():
+            positions = np.array(positions, dtype="int64")
+            if key not in sorted_index:
+                sorted_index[key] = SortedRows(timestamps.dtype)
+            sorted_index[key].add(timestamps[positions], positions)
+
+    def _positions(self, keys:Dict[str, Any]) -> List[int]:
+        return self._index(tuple(keys.keys())).get(tuple(keys.values()), [])
+
+    def _sorted_by_timestamp(self, keys:Dict[str, Any], timestamp_column:str) -> Tuple[np.ndarray, np.ndarray]:
+        # Timestamps of the rows of the key sorted ascending (stable, so the latest row of a timestamp is last) and
+        # their positions. The sorted index of (key columns, timestamp column) is built on first use, then maintained
+        # by put.
+        key_columns = tuple(keys.keys())
+        if (key_columns, timestamp_column) not in self.timestamp_indexes:
+            sorted_index = {}
+            self._sort_rows(sorted_index, timestamp_column, self._index(key_columns))
+            self.timestamp_indexes[(key_columns, timestamp_column)] = sorted_index
+        sorted_rows = self.timestamp_indexes[(key_columns, timestamp_column)].get(tuple(keys.values()))
+        if sorted_rows is None:
+            return self.buffers[timestamp_column][:0], np.array([], dtype="int64")
+        return sorted_rows.sorted()
+
+    def _row(self, position:int) -> pd.Series:
+        return pd.Series({field: buffer[position] for field, buffer in self.buffers.items()})
+
+    def _frame(self, positions:np.ndarray) -> pd.DataFrame:
+        return metric_frame(self.metric_data, {field: buffer[positions] for field, buffer in self.buffers.items()})
@@ -1,14 +1,30 @@
-from typing import Annotated, List, Any
 import abc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from operator import attrgetter
+from typing import Annotated, Any, Dict, Iterable, List, Tuple
+
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel
 
+from account_metrics.instrumentation import NO_TIMER, InstrumentedMetricRunner
+
+# Metric runner given to the calculation running in the current thread (see MetricCalculator.using_metric_runner), used
+# instead of the metric_runner of the calculator class
+_calculation_metric_runner: ContextVar = ContextVar("calculation_metric_runner", default=None)
+
 class MetricCalculator(abc.ABC):
     input_class:  Annotated[Any, "MetricData"] = None 
     output_metric: Annotated[Any, "MetricData"] = None 
     additional_data: List[Annotated[Any, "MetricData"]] = None
     groupby_field : List[Any] = None
+    # Fields of input_class read by calculate, None when it reads all of them (see get_input_columns)
+    input_columns: List[str] = None
     metric_runner: Annotated[Any, "MetricRunner"] = None
+    # InstrumentationRegistry recording the calls of the calculator (see set_instrumentation), None to record nothing
+    instrumentation: Annotated[Any, "InstrumentationRegistry"] = None
 
     
     @classmethod    
@@ -16,18 +32,166 @@ class MetricCalculator(abc.ABC):
     def calculate(cls, input_data: pd.DataFrame, current_metric:Any) -> pd.DataFrame:
         raise NotImplementedError()
     
+    @classmethod
+    def get_input_columns(cls) -> List[str]:
+        return None if cls.input_columns is None else list(cls.input_columns)
+
     @classmethod
     def set_metric_runner(cls, metric_runner: Any):
         cls.metric_runner = metric_runner
     @classmethod
     def get_metric_runner(cls):
-        if cls.metric_runner is None:
+        metric_runner = _calculation_metric_runner.get() or cls.metric_runner
+        if metric_runner is None:
             raise ValueError("Metric runner is not set")
-        return cls.metric_runner
+        if cls.instrumentation is not None:
+            return InstrumentedMetricRunner(metric_runner, cls.instrumentation, cls.__name__)
+        return metric_runner
+
+    @classmethod
+    @contextmanager
+    def using_metric_runner(cls, metric_runner: Any):
+        # get_metric_runner returns metric_runner in the block, in the current thread only (the class is left as is),
+        # when not None
+        if metric_runner is None:
+            yield
+            return
+        token = _calculation_metric_runner.set(metric_runner)
+        try:
+            yield
+        finally:
+            _calculation_metric_runner.reset(token)
+
+    @classmethod
+    def set_instrumentation(cls, registry: Any):
+        # Set on MetricCalculator to instrument every calculator, None to disable
+        cls.instrumentation = registry
+
+    @classmethod
+    def timed(cls, stage: str):
+        # Context manager adding the time of its block to the stage of the calculator, a shared no-op without
+        # instrumentation
+        return NO_TIMER if cls.instrumentation is None else cls.instrumentation.timer(cls.__name__, stage)
+
+    @classmethod
+    def record(cls, name: str, value: float = 1):
+        if cls.instrumentation is not None:
+            cls.instrumentation.inc(name, value, calculator=cls.__name__)
         
+def input_columns_of(calculators:Iterable[Any]) -> List[str]:
+    # Union of the input columns of calculators for loaders to read and decode only those, None when one of them reads
+    # all columns
+    columns = {}
+    for calculator in calculators:
+        calculator_columns = calculator.get_input_columns()
+        if calculator_columns is None:
+            return None
+        columns.update(dict.fromkeys(calculator_columns))
+    return list(columns)
+
 class MetricData(BaseModel, abc.ABC):
     # TODO: enforce all variables are assigned in data_model
     class Meta:
         sharding_columns = []
         groupby = []
-        does_stream_out = False
\ No newline at end of file
+        does_stream_out = False
+    @classmethod
+    def record_class(cls) -> type:
+        # MetricRecord with the fields and defaults of the model, see metric_record_class
+        return metric_record_class(cls)
+    @classmethod
+    def dtypes(cls) -> Dict[str, str]:
+        # Column dtypes of the model in a DataFrame, see metric_dtypes
+        return metric_dtypes(cls)
+    @classmethod
+    def empty_frame(cls) -> pd.DataFrame:
+        return metric_frame(cls, {}, 0)
+
+# Low-cardinality str fields stored as pandas categoricals
+CATEGORICAL_FIELDS = ("server", "symbol")
+
+@lru_cache(maxsize=None)
+def metric_dtypes(metric:type) -> Dict[str, str]:
+    # int -> int64, float -> float64, server/symbol -> category, anything else (str, datetime.date) is kept as
+    # Python objects
+    dtypes = {}
+    for field_name, field in metric.model_fields.items():
+        if field_name in CATEGORICAL_FIELDS:
+            dtypes[field_name] = "category"
+        elif field.annotation is int:
+            dtypes[field_name] = "int64"
+        elif field.annotation is float:
+            dtypes[field_name] = "float64"
+        else:
+            dtypes[field_name] = "object"
+    return dtypes
+
+def buffer_dtype(dtype:str) -> str:
+    # NumPy dtype of the buffer a column of dtype is written into
+    return "object" if dtype == "category" else dtype
+
+def metric_buffers(metric:type, length:int) -> Dict[str, np.ndarray]:
+    # Uninitialized typed buffers for length rows of metric, to be turned into a frame by metric_frame
+    return {field: np.empty(length, dtype=buffer_dtype(dtype)) for field, dtype in metric.dtypes().items()}
+
+def metric_frame(metric:type, columns:Dict[str, Any], length:int = None) -> pd.DataFrame:
+    # DataFrame of metric with the dtypes of metric_dtypes, fields in model order. Columns are truncated to length
+    # rows, missing fields are filled with their model default.
+    defaults = None
+    frame = {}
+    for field, dtype in metric.dtypes().items():
+        column = columns.get(field)
+        if column is None:
+            defaults = defaults if defaults is not None else metric().model_dump()
+            column = np.full(length or 0, defaults[field], dtype=buffer_dtype(dtype))
+        elif length is not None:
+            column = column[:length]
+        frame[field] = pd.Categorical(column) if dtype == "category" else np.asarray(column, dtype=dtype)
+    return pd.DataFrame(frame)
+
+def as_metric_types(metric:type, data:pd.DataFrame) -> pd.DataFrame:
+    # data with the fields of metric it has cast to metric_dtypes
+    dtypes = {field: dtype for field, dtype in metric.dtypes().items()
+              if field in data.columns and data[field].dtype != dtype}
+    return data.astype(dtypes) if dtypes else data
+
+class MetricRecord:
+    # Fixed-layout row without validation for hot loops: fields are plain __slots__ attributes, also readable
+    # as record["field"]
+    __slots__ = ()
+    fields: Tuple[str, ...] = ()
+    defaults: Tuple[Any, ...] = ()
+
+    def __init__(self, values:Iterable[Any] = None):
+        for field, value in zip(self.fields, self.defaults if values is None else values, strict=True):
+            setattr(self, field, value)
+
+    def __getitem__(self, field:str) -> Any:
+        return getattr(self, field)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{field}={getattr(self, field)!r}' for field in self.fields)})"
+
+    def values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def model_dump(self) -> Dict[str, Any]:
+        return dict(zip(self.fields, self.values(), strict=True))
+
+def record_class(name:str, fields:Iterable[str], defaults:Iterable[Any] = None) -> type:
+    fields = tuple(fields)
+    defaults = tuple(defaults) if defaults is not None else (None,) * len(fields)
+    record = type(name, (MetricRecord,), {"__slots__": fields, "fields": fields, "defaults": defaults})
+    if len(fields) > 1:
+        get_values = attrgetter(*fields)
+        record.values = lambda self: get_values(self)
+    return record
+
+@lru_cache(maxsize=None)
+def metric_record_class(metric:type) -> type:
+    return record_class(f"{metric.__name__}Record", metric.model_fields.keys(), metric().model_dump().values())
+
+@lru_cache(maxsize=None)
+def columns_record_class(columns:Tuple[str, ...]) -> type:
+    # Record over the columns of a frame, e.g. to iterate deals with itertuples instead of iterrows
+    return record_class("Row", columns)
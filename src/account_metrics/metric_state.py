@@ -0,0 +1,58 @@
+from typing import Dict, List, Type
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.metric_model import MetricData, buffer_dtype, metric_frame
+
+
+class GroupKeyIndex:
+    # Compact int64 code of every composite groupby key, e.g. (server, login) or (server, position_id), assigned
+    # densely in order of first appearance. Keys are hashed as full tuples, so the same login on two servers gets two
+    # codes.
+    def __init__(self, key_columns:List[str]):
+        self.key_columns = list(key_columns)
+        self.codes: Dict[tuple, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def get_codes(self, keys:pd.DataFrame, add:bool = False) -> np.ndarray:
+        # Code of every row of keys (key_columns), -1 for unknown keys unless add gives them the next codes
+        keys = zip(*[keys[column].tolist() for column in self.key_columns], strict=True)
+        if not add:
+            return np.fromiter((self.codes.get(key, -1) for key in keys), dtype="int64")
+        return np.fromiter((self.codes.setdefault(key, len(self.codes)) for key in keys), dtype="int64")
+
+class MetricState:
+    # Latest metric of every groupby key known to a long-running calculation, held in one growable buffer per field:
+    # the row of a key is its GroupKeyIndex code, so lookups are one hash per key and updates write the rows of a batch
+    # in place.
+    def __init__(self, metric:Type[MetricData], key_columns:List[str], capacity:int = 1024):
+        self.metric = metric
+        self.index = GroupKeyIndex(key_columns)
+        self.capacity = capacity
+        self.buffers: Dict[str, np.ndarray] = {field: np.empty(capacity, dtype=buffer_dtype(dtype))
+                                               for field, dtype in metric.dtypes().items()}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def lookup(self, keys:pd.DataFrame) -> np.ndarray:
+        # Row of every key of keys, -1 for keys without a metric
+        return self.index.get_codes(keys)
+
+    def rows(self, positions:np.ndarray) -> pd.DataFrame:
+        return metric_frame(self.metric, {field: buffer[positions] for field, buffer in self.buffers.items()})
+
+    def update(self, result:pd.DataFrame):
+        # Rows of a group come out in calculation order, the last one is the latest metric of the key
+        latest = result.drop_duplicates(subset=self.index.key_columns, keep="last")
+        positions = self.index.get_codes(latest, add=True)
+        if len(self.index) > self.capacity:
+            self.capacity = max(2 * self.capacity, len(self.index))
+            for field, buffer in self.buffers.items():
+                self.buffers[field] = np.empty(self.capacity, dtype=buffer.dtype)
+                self.buffers[field][:len(buffer)] = buffer
+        for field, buffer in self.buffers.items():
+            buffer[positions] = latest[field].to_numpy(dtype=buffer.dtype)
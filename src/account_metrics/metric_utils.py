@@ -1,11 +1,14 @@
+from enum import Enum
+from typing import Dict, Tuple, Type
+
+import numpy as np
 import pandas as pd
-from typing import Type, Dict
 
 from account_metrics.metric_model import MetricData
+
 #  ------------------------------------------------- Helper function for metrics --------------------------------------------
 
 # (MetricData.Meta.groupby) -> metric_row (1:1 mapping)
-@staticmethod
 def apply_groupby_mapping_to_metric(metric: Type[MetricData], current_metric: pd.DataFrame) -> Dict[tuple, pd.Series]: 
     map_groupby_to_current_metric:dict[tuple, pd.Series] = {}
 
@@ -16,21 +19,197 @@ def apply_groupby_mapping_to_metric(metric: Type[MetricData], current_metric: pd
         map_groupby_to_current_metric[key] = row
     return map_groupby_to_current_metric
 
-# TODO: check if we could better here
-# (MetricData.Meta.groupby) -> deal_rows (1:n mapping)
-@staticmethod
-def apply_groupby_mapping_of_metric_to_data(metric: Type[MetricData], data: pd.DataFrame) -> Dict[tuple, pd.Series]: 
-    map_groupby_to_current_metric:dict[tuple, pd.Series] = {}
-    deals_grouped = data.groupby(metric.Meta.groupby)
-    for g in deals_grouped:
-        map_groupby_to_current_metric[g[0]] = g[1].sort_values(["Time", "Deal"])
-    return map_groupby_to_current_metric
+# (MetricData.Meta.groupby) -> deal_rows (1:n mapping), deals of every group sorted by (Time, Deal)
+def apply_groupby_mapping_of_metric_to_data(metric: Type[MetricData], data: pd.DataFrame) -> Dict[tuple, pd.DataFrame]:
+    sorted_data, group_index = sort_by_group(data, metric.Meta.groupby)
+    start = np.flatnonzero(is_group_start(group_index)) if len(sorted_data) else np.array([], dtype=int)
+    end = np.r_[start[1:], len(sorted_data)]
+    keys = sorted_data[metric.Meta.groupby].iloc[start].itertuples(index=False, name=None)
+    return {key: sorted_data.iloc[group_start:group_end]
+            for key, group_start, group_end in zip(keys, start, end, strict=True)}
+
+def sort_by_group(data: pd.DataFrame, groupby: list, time_order: np.ndarray = None) -> Tuple[pd.DataFrame, np.ndarray]:
+    # data sorted once by (groupby, Time, Deal) and the group of every row; rows with a missing groupby key are
+    # dropped. time_order, the (Time, Deal) order of data, can be shared between several groupby. Already sorted data
+    # is not copied.
+    group_index = data.groupby(groupby, sort=True).ngroup().to_numpy()
+    time, deal = data["Time"].to_numpy(), data["Deal"].to_numpy()
+    is_time_sorted = (time[1:] > time[:-1]) | ((time[1:] == time[:-1]) & (deal[1:] >= deal[:-1]))
+    is_sorted = (group_index[1:] > group_index[:-1]) | ((group_index[1:] == group_index[:-1]) & is_time_sorted)
+    if is_sorted.all() and (len(group_index) == 0 or group_index[0] >= 0):
+        return data, group_index
+    if time_order is None:
+        time_order = np.lexsort((deal, time))
+    order = time_order[np.argsort(group_index[time_order], kind="stable")]
+    order = order[group_index[order] >= 0]
+    return data.iloc[order], group_index[order]
+
+def decode_string_binary_column(metric: MetricData, data: pd.DataFrame, dtype: str = None):
+    # Decodes in place the str fields of metric held as bytes, see decode_text
+    string_fields = [field for field, field_info in metric.model_fields.items()
+                     if field_info.annotation is str and field in data.columns]
 
-@staticmethod
-def decode_string_binary_column(metric: MetricData, data: pd.DataFrame):
-    string_fields = [field for field, field_info in metric.__annotations__.items() if field_info == str]
-    
     for field in string_fields:
-        if data[field].apply(lambda x: isinstance(x, bytes)).any():
-            data[field] = data[field].apply(lambda x: x.decode('utf-8') if isinstance(x, bytes) else x)
-        data[field] = data[field].astype(str)
\ No newline at end of file
+        data[field] = decode_text(data[field], dtype)
+
+def project_columns(data: pd.DataFrame, columns: list = None, rename: Dict[str, str] = None,
+                    replace: Dict[str, pd.Series] = None) -> pd.DataFrame:
+    # columns of data (all by default) renamed through rename, without copying: they share their buffers with data.
+    # replace holds new values of some of them (e.g. decoded text), the only columns allocated.
+    columns = data.columns if columns is None else columns
+    rename = rename or {}
+    replace = replace or {}
+    projected = {rename.get(column, column): replace[column] if column in replace else data[column]
+                 for column in columns}
+    return pd.DataFrame(projected, index=data.index, copy=False)
+
+def enum_values(column:pd.Series) -> np.ndarray:
+    # Action/Entry columns hold either the raw MT5 integers or EnDealAction/EnDealEntry members
+    if pd.api.types.is_integer_dtype(column.dtype):
+        return column.to_numpy(dtype="int64")
+    return column.map(lambda e: e.value if isinstance(e, Enum) else e).to_numpy(dtype="int64")
+
+def decode_text(column:pd.Series, dtype:str = None) -> pd.Series:
+    # Text columns may still hold the raw bytes read from MT5. Columns already holding str are returned as they are
+    # (one C-level type check), columns of bytes are decoded without per-value type checks. dtype ("string",
+    # "string[pyarrow]", "category", ...) converts the decoded column.
+    if column.dtype == object:
+        kind = pd.api.types.infer_dtype(column, skipna=False)
+        if kind == "bytes":
+            decoded = np.array([value.decode() for value in column.to_numpy()], dtype=object)
+            column = pd.Series(decoded, index=column.index, name=column.name)
+        elif kind not in ["string", "empty"]:
+            column = column.map(lambda c: c.decode() if isinstance(c, bytes) else c).astype(str)
+    return column.astype(dtype) if dtype is not None and column.dtype != dtype else column
+
+#  -------------------------------- Segmented scans over groups stored contiguously --------------------------------
+# All kernels take the batch sorted by group (group_index non-decreasing, see
+# BasicDealMetricCalculator.calculate_vectorized) and an initial state vector holding one value per group
+# (initial[group_index[i]] is the state before the first row of the group). They reproduce what calculate_row does
+# with `prev` one row at a time, including the order of floating point operations.
+
+def is_group_start(group_index:np.ndarray) -> np.ndarray:
+    return np.r_[True, group_index[1:] != group_index[:-1]]
+
+def group_start_position(group_index:np.ndarray) -> np.ndarray:
+    is_start = is_group_start(group_index)
+    return np.flatnonzero(is_start)[np.cumsum(is_start) - 1]
+
+def _identity(values:np.ndarray, how:str):
+    if how == "cumsum":
+        return 0
+    if np.issubdtype(values.dtype, np.integer):
+        return np.iinfo(values.dtype).min if how == "cummax" else np.iinfo(values.dtype).max
+    return -np.inf if how == "cummax" else np.inf
+
+_ACCUMULATE = {"cumsum": np.add, "cummax": np.maximum, "cummin": np.minimum}
+
+def _segmented_accumulate(values:np.ndarray, group_index:np.ndarray, how:str) -> np.ndarray:
+    # ufunc.accumulate restarted at every group start. Groups of similar length are laid out as rows of a 2D block
+    # and accumulated along the rows, so every group is summed strictly left to right (groupby().cumsum() compensates
+    # the sum and can differ from prev + value in the last bit).
+    start = np.flatnonzero(is_group_start(group_index)) if len(values) else np.array([], dtype=int)
+    length = np.diff(np.r_[start, len(values)])
+    bucket = np.ceil(np.log2(length)).astype(int) if len(values) else length
+    result = np.empty_like(values)
+    for b in np.unique(bucket):
+        in_bucket = bucket == b
+        position = start[in_bucket][:, None] + np.arange(length[in_bucket].max())
+        is_valid = position < (start + length)[in_bucket][:, None]
+        block = values[np.where(is_valid, position, 0)]
+        result[position[is_valid]] = _ACCUMULATE[how].accumulate(block, axis=1)[is_valid]
+    return result
+
+def _segmented_scan(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray, how:str,
+                    mask:np.ndarray = None) -> np.ndarray:
+    values = np.asarray(values)
+    values = np.where(mask, values, _identity(values, how)) if mask is not None else values.copy()
+    is_start = is_group_start(group_index)
+    initial = np.asarray(initial, dtype=values.dtype)[group_index[is_start]]
+    if how == "cumsum":
+        values[is_start] = initial + values[is_start]
+    else:
+        values[is_start] = (np.maximum if how == "cummax" else np.minimum)(initial, values[is_start])
+    return _segmented_accumulate(values, group_index, how)
+
+def segmented_cumsum(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray,
+                     mask:np.ndarray = None) -> np.ndarray:
+    # prev + (value if mask else 0)
+    return _segmented_scan(values, initial, group_index, "cumsum", mask)
+
+def segmented_cummax(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray,
+                     mask:np.ndarray = None) -> np.ndarray:
+    # value if mask and value > prev else prev
+    return _segmented_scan(values, initial, group_index, "cummax", mask)
+
+def segmented_cummin(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray,
+                     mask:np.ndarray = None) -> np.ndarray:
+    # value if mask and value < prev else prev
+    return _segmented_scan(values, initial, group_index, "cummin", mask)
+
+def segmented_last(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray,
+                   mask:np.ndarray = None) -> np.ndarray:
+    # value if mask else prev: the value of the last row where mask holds, initial before the first one in the group
+    values = np.asarray(values)
+    if mask is None:
+        return values.copy()
+    last = np.maximum.accumulate(np.where(mask, np.arange(len(values)), -1))
+    initial = np.asarray(initial, dtype=values.dtype)[group_index]
+    return np.where(last >= group_start_position(group_index), values[last], initial)
+
+def segmented_shift(values:np.ndarray, initial:np.ndarray, group_index:np.ndarray) -> np.ndarray:
+    # prev: the value of the previous row in the group, initial for the first row
+    values = np.asarray(values)
+    result = np.empty_like(values)
+    result[1:] = values[:-1]
+    is_start = is_group_start(group_index)
+    result[is_start] = np.asarray(initial, dtype=values.dtype)[group_index[is_start]]
+    return result
+
+def segmented_is_stale(values:np.ndarray, watermark:np.ndarray, group_index:np.ndarray) -> np.ndarray:
+    # value <= watermark of the group or an earlier value of the group, e.g. deals already processed
+    # (replays, duplicates)
+    values = np.asarray(values)
+    return values <= segmented_shift(segmented_cummax(values, watermark, group_index), watermark, group_index)
+
+def segmented_day_carry(values:np.ndarray, initial:np.ndarray, initial_yesterday:np.ndarray, is_new_day:np.ndarray,
+                        group_index:np.ndarray) -> np.ndarray:
+    # yesterday = prev.value if is_new_day else prev.yesterday, initial/initial_yesterday being the value/yesterday
+    # before the group
+    values = np.asarray(values)
+    start = group_start_position(group_index)
+    last = np.maximum.accumulate(np.where(is_new_day, np.arange(len(values)), -1))
+    initial = np.asarray(initial, dtype=values.dtype)[group_index]
+    before_new_day = np.where(last > start, values[np.maximum(last - 1, 0)], initial)
+    return np.where(last >= start, before_new_day, np.asarray(initial_yesterday, dtype=values.dtype)[group_index])
+
+def _segmented_daily_scan(values, initial, initial_yesterday, is_new_day, group_index, how, mask):
+    values = np.asarray(values)
+    values = np.where(mask, values, _identity(values, how)) if mask is not None else values
+    is_start = is_group_start(group_index)
+    carried = np.full_like(values, _identity(values, how))
+    carried[1:] = np.where(is_new_day[1:], values[:-1], carried[1:])
+    carried[is_start] = np.where(is_new_day[is_start], np.asarray(initial, dtype=values.dtype)[group_index[is_start]],
+                                 np.asarray(initial_yesterday, dtype=values.dtype)[group_index[is_start]])
+    yesterday = _segmented_accumulate(carried, group_index, how)
+    return (yesterday + values if how == "cumsum" else np.maximum(yesterday, values)), yesterday
+
+def segmented_daily_cumsum(values:np.ndarray, initial:np.ndarray, initial_yesterday:np.ndarray, is_new_day:np.ndarray,
+                           group_index:np.ndarray, mask:np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    # yesterday = prev.metric if is_new_day else prev.yesterday; metric = yesterday + (value if mask else 0)
+    # Returns (metric, yesterday)
+    return _segmented_daily_scan(values, initial, initial_yesterday, is_new_day, group_index, "cumsum", mask)
+
+def segmented_daily_cummax(values:np.ndarray, initial:np.ndarray, initial_yesterday:np.ndarray, is_new_day:np.ndarray,
+                           group_index:np.ndarray, mask:np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    # yesterday = prev.metric if is_new_day else prev.yesterday; metric = max(value, yesterday) if mask else yesterday
+    # Returns (metric, yesterday)
+    return _segmented_daily_scan(values, initial, initial_yesterday, is_new_day, group_index, "cummax", mask)
+
+def new_day_mask(day:np.ndarray, initial_day:np.ndarray, group_index:np.ndarray) -> np.ndarray:
+    # prev.date < date, initial_day being the day of the stored metric the group starts from
+    return segmented_shift(day, initial_day, group_index) < day
+
+def timestamp_to_day(timestamp:np.ndarray) -> np.ndarray:
+    # Days since epoch, same as pd.to_datetime(timestamp, unit="s").date()
+    return np.floor_divide(timestamp, 86400).astype("int64")
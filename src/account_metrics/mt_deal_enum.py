@@ -1,4 +1,5 @@
 from enum import Enum
+import numpy as np
 
 
 class EnDealAction(Enum):
@@ -34,3 +35,91 @@ class EnDealEntry(Enum):
     ENTRY_OUT_BY = 3
     ENTRY_FIRST = 0
     ENTRY_LAST = 3
+
+
+# Deal classification as bitmasks over the raw MT5 values: ACTION_CLASS[action] and ENTRY_CLASS[entry] hold the
+# flags of every EnDealAction/EnDealEntry value, so the classifiers below answer for a whole column of actions/entries
+# in one array operation; ACTION_FLAGS/ENTRY_FLAGS are the same tables as tuples for the per-deal path.
+ACTION_TRADE = 1
+ACTION_BALANCE = 2
+# Balance, credit, correction and stop-out compensation: money moved to or from the account, not trading profit
+ACTION_NON_TRADING_CASHFLOW = 4
+# Balance, credit and stop-out compensation: not counted in gross profit/loss
+ACTION_GROSS_EXCLUDED = 8
+ACTION_BUY = 16
+ACTION_SELL = 32
+ENTRY_OPEN = 1
+ENTRY_CLOSE = 2
+
+ACTION_CLASS = np.zeros(EnDealAction.DEAL_LAST.value + 1, dtype=np.uint8)
+ACTION_CLASS[[EnDealAction.DEAL_BUY.value, EnDealAction.DEAL_SELL.value]] |= ACTION_TRADE
+ACTION_CLASS[EnDealAction.DEAL_BUY.value] |= ACTION_BUY
+ACTION_CLASS[EnDealAction.DEAL_SELL.value] |= ACTION_SELL
+ACTION_CLASS[EnDealAction.DEAL_BALANCE.value] |= ACTION_BALANCE
+ACTION_CLASS[[EnDealAction.DEAL_BALANCE.value, EnDealAction.DEAL_CREDIT.value, EnDealAction.DEAL_CORRECTION.value,
+              EnDealAction.DEAL_SO_COMPENSATION.value]] |= ACTION_NON_TRADING_CASHFLOW
+ACTION_CLASS[[EnDealAction.DEAL_BALANCE.value, EnDealAction.DEAL_CREDIT.value,
+              EnDealAction.DEAL_SO_COMPENSATION.value]] |= ACTION_GROSS_EXCLUDED
+
+ENTRY_CLASS = np.zeros(EnDealEntry.ENTRY_LAST.value + 1, dtype=np.uint8)
+ENTRY_CLASS[EnDealEntry.ENTRY_IN.value] |= ENTRY_OPEN
+ENTRY_CLASS[[EnDealEntry.ENTRY_OUT.value, EnDealEntry.ENTRY_INOUT.value,
+             EnDealEntry.ENTRY_OUT_BY.value]] |= ENTRY_CLOSE
+
+ACTION_FLAGS = tuple(ACTION_CLASS.tolist())
+ENTRY_FLAGS = tuple(ENTRY_CLASS.tolist())
+
+def enum_value(value) -> int:
+    # Raw MT5 value of an Action/Entry field holding either the integer or the enum member
+    return value.value if isinstance(value, Enum) else int(value)
+
+def deal_class(classes:np.ndarray, values, enum:type) -> np.ndarray:
+    # classes[values] for an array of raw values; values out of the enum raise ValueError as EnDealAction(99) does,
+    # rather than wrapping (negative values) or raising IndexError
+    values = np.asarray(values)
+    if values.size and (values.min() < 0 or values.max() >= len(classes)):
+        invalid = values[(values < 0) | (values >= len(classes))] if values.ndim else values
+        raise ValueError(f"{invalid.flat[0]!r} is not a valid {enum.__name__}")
+    return classes[values]
+
+def scalar_class(flags:tuple, value, enum:type) -> int:
+    # flags[value] for a single raw value, kept in plain Python: the per-deal calculators classify one deal at a time
+    # and the NumPy round trip of deal_class costs several times the lookup itself
+    value = int(value)
+    if not 0 <= value < len(flags):
+        raise ValueError(f"{value!r} is not a valid {enum.__name__}")
+    return flags[value]
+
+def action_class(action):
+    if isinstance(action, (int, np.integer)):
+        return scalar_class(ACTION_FLAGS, action, EnDealAction)
+    return deal_class(ACTION_CLASS, action, EnDealAction)
+
+def entry_class(entry):
+    if isinstance(entry, (int, np.integer)):
+        return scalar_class(ENTRY_FLAGS, entry, EnDealEntry)
+    return deal_class(ENTRY_CLASS, entry, EnDealEntry)
+
+def is_trade(action):
+    return (action_class(action) & ACTION_TRADE) != 0
+
+def is_buy(action):
+    return (action_class(action) & ACTION_BUY) != 0
+
+def is_sell(action):
+    return (action_class(action) & ACTION_SELL) != 0
+
+def is_balance(action):
+    return (action_class(action) & ACTION_BALANCE) != 0
+
+def is_non_trading_cashflow(action):
+    return (action_class(action) & ACTION_NON_TRADING_CASHFLOW) != 0
+
+def is_gross_excluded(action):
+    return (action_class(action) & ACTION_GROSS_EXCLUDED) != 0
+
+def is_open(entry):
+    return (entry_class(entry) & ENTRY_OPEN) != 0
+
+def is_close(entry):
+    return (entry_class(entry) & ENTRY_CLOSE) != 0
@@ -0,0 +1,94 @@
+import datetime
+from typing import Any, Dict, Iterator, List, Tuple, Type
+
+import pandas as pd
+
+from account_metrics.metric_model import CATEGORICAL_FIELDS, MetricData, as_metric_types
+
+# pyarrow is optional: only the Parquet functions need it
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet support requires pyarrow, install it with the parquet extra: "
+                          "pip install 'account-metrics[parquet]'")
+
+def arrow_type(field_name:str, annotation:Any) -> "pa.DataType":
+    if field_name in CATEGORICAL_FIELDS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if annotation is int:
+        return pa.int64()
+    if annotation is float:
+        return pa.float64()
+    if annotation == datetime.date:
+        return pa.date32()
+    return pa.string()
+
+def arrow_schema(metric:Type[MetricData], columns:List[str] = None) -> "pa.Schema":
+    # Arrow schema of metric (of columns only when given), following metric_dtypes: server/symbol are
+    # dictionary encoded
+    _require_pyarrow()
+    fields = metric.model_fields
+    columns = list(fields) if columns is None else columns
+    return pa.schema([pa.field(column, arrow_type(column, fields[column].annotation)) for column in columns])
+
+def write_parquet(metric:Type[MetricData], data:pd.DataFrame, path:str, row_group_size:int = 100_000):
+    # Writes the fields of metric in data with the schema of the model, in row groups of row_group_size rows (the unit
+    # of predicate pushdown and streaming of read_parquet/iter_parquet)
+    _require_pyarrow()
+    columns = [column for column in metric.model_fields if column in data.columns]
+    table = pa.Table.from_pandas(data[columns], schema=arrow_schema(metric, columns), preserve_index=False)
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+def filter_expression(filters:Dict[str, Any]) -> "ds.Expression":
+    # {column: value}: a list/set matches any of its values, a (from, to) tuple an inclusive range (None for no bound),
+    # anything else equality. e.g. {"login": [1001, 1002], "server": "demo", "Time": (from_timestamp, to_timestamp)}
+    expression = None
+    for column, value in (filters or {}).items():
+        field = ds.field(column)
+        if isinstance(value, tuple):
+            condition = None
+            if value[0] is not None:
+                condition = field >= value[0]
+            if value[1] is not None:
+                condition = field <= value[1] if condition is None else condition & (field <= value[1])
+        elif isinstance(value, (list, set, frozenset)):
+            condition = field.isin(list(value))
+        else:
+            condition = field == value
+        if condition is not None:
+            expression = condition if expression is None else expression & condition
+    return expression
+
+def _dataset(metric:Type[MetricData], path:str, columns:List[str]) -> Tuple["ds.Dataset", List[str]]:
+    # Dataset of path and the columns to read, by default the fields of metric it has
+    _require_pyarrow()
+    dataset = ds.dataset(path, format="parquet")
+    if columns is None:
+        columns = [column for column in dataset.schema.names if column in metric.model_fields]
+    return dataset, columns
+
+def read_parquet(metric:Type[MetricData], path:str, columns:List[str] = None,
+                 filters:Dict[str, Any] = None) -> pd.DataFrame:
+    # Rows of a Parquet file (or directory of files) of metric matching filters (see filter_expression), typed as
+    # metric_dtypes. Row groups whose statistics exclude the filters are skipped without being read.
+    dataset, columns = _dataset(metric, path, columns)
+    return _to_frame(metric, dataset.to_table(columns=columns, filter=filter_expression(filters)))
+
+def iter_parquet(metric:Type[MetricData], path:str, columns:List[str] = None, filters:Dict[str, Any] = None,
+                 batch_size:int = 100_000) -> Iterator[pd.DataFrame]:
+    # Same as read_parquet, streamed in frames of at most batch_size rows so that only one of them is in memory
+    # at a time
+    dataset, columns = _dataset(metric, path, columns)
+    for batch in dataset.to_batches(columns=columns, filter=filter_expression(filters), batch_size=batch_size):
+        if batch.num_rows:
+            yield _to_frame(metric, pa.Table.from_batches([batch]))
+
+def _to_frame(metric:Type[MetricData], table:"pa.Table") -> pd.DataFrame:
+    # date32 columns come back as datetime.date objects, as in the frames of the calculators
+    return as_metric_types(metric, table.to_pandas(date_as_object=True))
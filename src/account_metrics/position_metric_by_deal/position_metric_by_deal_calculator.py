@@ -1,4 +1,5 @@
 from typing import Dict, Tuple, Annotated, Type, Any, Union
+import numpy as np
 import pandas as pd
 
 from account_metrics.metric_model import MetricData
@@ -6,9 +7,10 @@ from account_metrics.metric_model import MetricData
 
 from .position_metric_by_deal_data_model import PositionMetricByDeal
 
-from account_metrics.mt_deal_enum import EnDealEntry, EnDealAction
+from account_metrics.mt_deal_enum import enum_value, is_open
 from account_metrics.mt5_deal import MT5Deal
 from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_utils import enum_values, segmented_cumsum, segmented_last
 
 
 class PositionMetricByDealCalculator(BasicDealMetricCalculator):
@@ -16,23 +18,27 @@ class PositionMetricByDealCalculator(BasicDealMetricCalculator):
     additional_data = [PositionMetricByDeal]
     output_metric = PositionMetricByDeal
     groupby_field = [k for k, v in output_metric.model_fields.items() if "groupby" in v.metadata]
+    input_columns = ["Action", "Comment", "Commission", "Deal", "Digits", "DigitsCurrency", "Entry", "Login",
+                     "PositionID", "Price", "PricePosition", "PriceSL", "PriceTP", "Profit", "ProfitRaw", "RateMargin",
+                     "Storage", "Symbol", "Time", "TimeUTC", "Volume", "VolumeClosed", "VolumeClosedExt", "VolumeExt",
+                     "server"]
     
     # TODO: Check if positional_metric should be grouped by login. Otherwise, override calculate method
     @classmethod
     def calculate_row(cls, deal:pd.Series, additional_data:Dict[Type[MetricData],Any]) -> PositionMetricByDeal:
-        metric = cls.output_metric()
+        metric = cls.new_row()
         
         prev = cls._get_current_metric(deal, additional_data)
 
-        action = deal["Action"] if isinstance(deal["Action"], EnDealAction) else EnDealAction(deal["Action"])
-        entry = deal["Entry"] if isinstance(deal["Entry"], EnDealEntry) else EnDealEntry(deal["Entry"])
+        action = enum_value(deal["Action"])
+        entry = enum_value(deal["Entry"])
 
         metric.server = deal["server"]
-        metric.action = action.value if entry == EnDealEntry.ENTRY_IN else prev.action
-        metric.comment = deal["Comment"] if entry == EnDealEntry.ENTRY_IN else prev.comment
+        metric.action = action if is_open(entry) else prev.action
+        metric.comment = deal["Comment"] if is_open(entry) else prev.comment
         metric.commission = deal["Commission"] + prev.commission
         metric.deal_id = deal["Deal"]
-        metric.digits = deal["Digits"] if entry == EnDealEntry.ENTRY_IN else prev.digits
+        metric.digits = deal["Digits"] if is_open(entry) else prev.digits
         metric.digits_currency = deal["DigitsCurrency"]
         metric.login = deal["Login"]
         metric.position_id = deal["PositionID"]
@@ -47,20 +53,69 @@ class PositionMetricByDealCalculator(BasicDealMetricCalculator):
         metric.symbol = deal["Symbol"]
         metric.timestamp_utc = deal["TimeUTC"]
         metric.timestamp_server = deal["Time"]
-        metric.timestamp_open = deal["TimeUTC"] if entry == EnDealEntry.ENTRY_IN else prev.timestamp_open
+        metric.timestamp_open = deal["TimeUTC"] if is_open(entry) else prev.timestamp_open
         metric.timestamp_open_server = (
-            deal["Time"] if entry == EnDealEntry.ENTRY_IN else prev.timestamp_open_server
+            deal["Time"] if is_open(entry) else prev.timestamp_open_server
         )
-        metric.volume = deal["Volume"] if entry == EnDealEntry.ENTRY_IN else prev.volume
+        metric.volume = deal["Volume"] if is_open(entry) else prev.volume
         metric.volume_closed = deal["VolumeClosed"] + prev.volume_closed
         metric.volume_remaining = metric.volume - metric.volume_closed
-        metric.volume_ext = deal["VolumeExt"] if entry == EnDealEntry.ENTRY_IN else prev.volume_ext
+        metric.volume_ext = deal["VolumeExt"] if is_open(entry) else prev.volume_ext
         metric.volume_closed_ext = deal["VolumeClosedExt"] + prev.volume_closed_ext
         metric.volume_remaining_ext = metric.volume_ext - metric.volume_closed_ext
         metric.net_profit = metric.profit + metric.commission + metric.storage
 
         return metric, {}
 
+    @classmethod
+    def calculate_batch(cls, deals:pd.DataFrame, group_index:np.ndarray, current_metric:pd.DataFrame) -> pd.DataFrame:
+        def opened(column, field, dtype):
+            # Taken from the deal opening the position, kept for the deals closing it
+            return segmented_last(deals[column].to_numpy(dtype=dtype), current_metric[field].to_numpy(dtype=dtype),
+                                  group_index, mask=is_in)
+
+        def running_sum(column, field, dtype):
+            return segmented_cumsum(deals[column].to_numpy(dtype=dtype), current_metric[field].to_numpy(dtype=dtype),
+                                    group_index)
+
+        action = enum_values(deals["Action"])
+        is_in = is_open(enum_values(deals["Entry"]))
+
+        metric = {}
+        metric["server"] = deals["server"].to_numpy(dtype=object)
+        metric["action"] = segmented_last(action, current_metric["action"].to_numpy(dtype="int64"), group_index,
+                                          mask=is_in)
+        metric["comment"] = segmented_last(deals["Comment"].to_numpy(dtype=object),
+                                           current_metric["comment"].to_numpy(dtype=object), group_index, mask=is_in)
+        metric["commission"] = running_sum("Commission", "commission", float)
+        metric["deal_id"] = deals["Deal"].to_numpy()
+        metric["digits"] = opened("Digits", "digits", "int64")
+        metric["digits_currency"] = deals["DigitsCurrency"].to_numpy()
+        metric["login"] = deals["Login"].to_numpy()
+        metric["position_id"] = deals["PositionID"].to_numpy()
+        metric["price"] = deals["Price"].to_numpy()
+        metric["price_position"] = deals["PricePosition"].to_numpy()
+        metric["price_sl"] = deals["PriceSL"].to_numpy()
+        metric["price_tp"] = deals["PriceTP"].to_numpy()
+        metric["profit"] = running_sum("Profit", "profit", float)
+        metric["profit_raw"] = running_sum("ProfitRaw", "profit_raw", float)
+        metric["rate_margin"] = deals["RateMargin"].to_numpy()
+        metric["storage"] = running_sum("Storage", "storage", float)
+        metric["symbol"] = deals["Symbol"].to_numpy(dtype=object)
+        metric["timestamp_utc"] = deals["TimeUTC"].to_numpy()
+        metric["timestamp_server"] = deals["Time"].to_numpy()
+        metric["timestamp_open"] = opened("TimeUTC", "timestamp_open", "int64")
+        metric["timestamp_open_server"] = opened("Time", "timestamp_open_server", "int64")
+        metric["volume"] = opened("Volume", "volume", "int64")
+        metric["volume_closed"] = running_sum("VolumeClosed", "volume_closed", "int64")
+        metric["volume_remaining"] = metric["volume"] - metric["volume_closed"]
+        metric["volume_ext"] = opened("VolumeExt", "volume_ext", "int64")
+        metric["volume_closed_ext"] = running_sum("VolumeClosedExt", "volume_closed_ext", "int64")
+        metric["volume_remaining_ext"] = metric["volume_ext"] - metric["volume_closed_ext"]
+        metric["net_profit"] = metric["profit"] + metric["commission"] + metric["storage"]
+
+        return cls.build_batch_frame(metric, len(deals))
+
     @classmethod
     def _get_current_metric(cls, deal, additional_data):
         if 'current_metric' in additional_data:
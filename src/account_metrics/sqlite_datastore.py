@@ -0,0 +1,202 @@
+import datetime
+import sqlite3
+import threading
+from itertools import product
+from typing import Any, Dict, List, Type
+
+import pandas as pd
+from pydantic.alias_generators import to_snake
+
+from account_metrics.metric_model import MetricData, metric_frame
+
+
+def sql_type(annotation:Any) -> str:
+    return "INTEGER" if annotation is int else "REAL" if annotation is float else "TEXT"
+
+def quote(name:str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+# Column numbering the writes of the rows: an upsert keeps the rowid of the row it updates but takes the next sequence,
+# so the latest row of a key is the one with the highest sequence
+SEQUENCE_COLUMN = quote("_write_sequence")
+
+def sql_column_names(fields:List[str]) -> Dict[str, str]:
+    # SQL column of every field. SQLite column names are case-insensitive, so a field differing from an earlier one
+    # only by case (MT5Deal has Login and login) gets a numbered suffix.
+    names = {}
+    used = set()
+    for field in fields:
+        name, suffix = field, 1
+        while name.lower() in used:
+            name, suffix = f"{field}_{suffix}", suffix + 1
+        names[field] = name
+        used.add(name.lower())
+    return names
+
+class SQLiteDatastore:
+    # Persistent Datastore of one metric in a table of a SQLite database (WAL journal, so readers do not block the
+    # writer). The primary key of the table is Meta.key_columns and put upserts on it, like the latest version of a row
+    # in the ClickHouse tables. Rows are ordered by the sequence of their last write (SEQUENCE_COLUMN), indexed by
+    # Meta.groupby_update_format key for the latest row lookups, which are done for all keys at once through a
+    # temporary table. Dates are stored as ISO text so that they compare and sort as dates. Fields are stored in the
+    # columns of sql_column_names. The connection is shared by the threads using the datastore (e.g.
+    # CalculatorScheduler workers), a lock serializing its statements.
+    def __init__(self, metric_data:Type[MetricData], path:str = ":memory:", data:pd.DataFrame = None,
+                 table:str = None):
+        self.metric_data = metric_data
+        self.table = table or to_snake(metric_data.__name__)
+        self.fields = metric_data.model_fields
+        self.columns = list(self.fields)
+        self.sql_columns = {field: quote(name) for field, name in sql_column_names(self.columns).items()}
+        self.date_columns = {field for field, field_info in self.fields.items()
+                             if field_info.annotation is datetime.date}
+        self.defaults = {field: None if field_info.is_required() else field_info.default
+                         for field, field_info in self.fields.items()}
+        self.key_columns: List[str] = list(getattr(metric_data.Meta, "key_columns", []))
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA temp_store=MEMORY")
+        self._create_table()
+        self.insert_sql = self._insert_sql()
+        self.next_sequence = self.connection.execute(
+            f"SELECT coalesce(max({SEQUENCE_COLUMN}), 0) + 1 FROM {quote(self.table)}").fetchone()[0]
+        if data is not None:
+            self.put(data)
+
+    def _create_table(self):
+        columns = [f"{self.sql_columns[field]} {sql_type(field_info.annotation)}"
+                   for field, field_info in self.fields.items()]
+        columns.append(f"{SEQUENCE_COLUMN} INTEGER NOT NULL")
+        if self.key_columns:
+            columns.append(f"PRIMARY KEY ({self._column_list(self.key_columns)})")
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {quote(self.table)} ({', '.join(columns)})")
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {quote(self.table + '_write_sequence')} "
+                                    f"ON {quote(self.table)} ({SEQUENCE_COLUMN})")
+            groupby = list(getattr(self.metric_data.Meta, "groupby_update_format", self.metric_data.Meta.groupby))
+            if groupby and all(column in self.fields for column in groupby):
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {quote(self.table + '_' + '_'.join(groupby))} "
+                                        f"ON {quote(self.table)} ({self._column_list(groupby)}, {SEQUENCE_COLUMN})")
+
+    def _column_list(self, fields:List[str], alias:str = "") -> str:
+        return ", ".join(alias + self.sql_columns[field] for field in fields)
+
+    def _insert_sql(self) -> str:
+        sql = (f"INSERT INTO {quote(self.table)} ({self._column_list(self.columns)}, {SEQUENCE_COLUMN}) "
+               f"VALUES ({', '.join('?' * (len(self.columns) + 1))})")
+        if not self.key_columns:
+            return sql
+        updated = [self.sql_columns[column] for column in self.columns if column not in self.key_columns]
+        updated.append(SEQUENCE_COLUMN)
+        return (sql + f" ON CONFLICT ({self._column_list(self.key_columns)}) DO UPDATE SET "
+                + ", ".join(f"{column} = excluded.{column}" for column in updated))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def put(self, data:Any):
+        # Bulk upsert of the rows of data in one transaction, missing fields taking their model default
+        if data is None or len(data) == 0:
+            return
+        columns = [self._sql_column(data, field) for field in self.columns]
+        with self.lock, self.connection:
+            sequence = range(self.next_sequence, self.next_sequence + len(data))
+            self.connection.executemany(self.insert_sql, zip(*columns, sequence, strict=True))
+            self.next_sequence += len(data)
+
+    def _sql_column(self, data:pd.DataFrame, field:str) -> list:
+        # Python values of a column of data to bind
+        if field not in data.columns:
+            default = self.defaults[field]
+            return [default.isoformat() if isinstance(default, datetime.date) else default] * len(data)
+        column = data[field]
+        if field in self.date_columns:
+            return pd.to_datetime(column).dt.strftime("%Y-%m-%d").astype(object).where(column.notna(), None).tolist()
+        if column.dtype == object or isinstance(column.dtype, (pd.StringDtype, pd.CategoricalDtype)):
+            values = column.astype(object)
+            return values.where(values.notna(), None).tolist() if values.hasnans else values.tolist()
+        return column.to_numpy().tolist()
+
+    def _sql_value(self, field:str, value:Any) -> Any:
+        if field in self.date_columns and value is not None:
+            return pd.Timestamp(value).strftime("%Y-%m-%d")
+        return value.item() if hasattr(value, "item") else value
+
+    def _load_keys(self, key_columns:List[str], keys:Any) -> str:
+        # (Re)creates a temporary table with the rows of keys, returns the join condition with the metric table
+        columns = ", ".join(f"{self.sql_columns[column]} {sql_type(self.fields[column].annotation)}"
+                            for column in key_columns)
+        rows = ([self._sql_value(column, value) for column, value in zip(key_columns, key, strict=True)]
+                for key in keys)
+        with self.lock, self.connection:
+            self.connection.execute("DROP TABLE IF EXISTS temp.lookup_keys")
+            self.connection.execute(f"CREATE TEMP TABLE lookup_keys ({columns})")
+            self.connection.executemany(f"INSERT INTO temp.lookup_keys VALUES ({', '.join('?' * len(key_columns))})",
+                                        rows)
+        return " AND ".join(f"t.{self.sql_columns[column]} = k.{self.sql_columns[column]}" for column in key_columns)
+
+    def _select(self, where:str = "", parameters:tuple = (), suffix:str = "") -> pd.DataFrame:
+        sql = f"SELECT {self._column_list(self.columns, 't.')} FROM {quote(self.table)} t {where} {suffix}"
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return self._frame(rows)
+
+    def _frame(self, rows:List[tuple]) -> pd.DataFrame:
+        values = map(list, zip(*rows, strict=True)) if rows else [[] for _ in self.columns]
+        columns = dict(zip(self.columns, values, strict=True))
+        for column in self.date_columns:
+            columns[column] = [None if value is None else datetime.date.fromisoformat(value)
+                               for value in columns[column]]
+        return metric_frame(self.metric_data, columns)
+
+    def _row(self, where:str, parameters:tuple) -> pd.Series:
+        rows = self._select(where, parameters, f"ORDER BY t.{SEQUENCE_COLUMN} DESC LIMIT 1")
+        return rows.iloc[0] if len(rows) else None
+
+    def _where(self, keys:Dict[str, Any]) -> str:
+        return "WHERE " + " AND ".join(f"t.{self.sql_columns[column]} = ?" for column in keys) if keys else ""
+
+    def _parameters(self, keys:Dict[str, Any]) -> tuple:
+        return tuple(self._sql_value(column, value) for column, value in keys.items())
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return self._select(suffix=f"ORDER BY t.{SEQUENCE_COLUMN}")
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute(f"SELECT count(*) FROM {quote(self.table)}").fetchone()[0]
+
+    def get_latest_row(self, keys:Dict[str, Any]) -> pd.Series:
+        return self._row(self._where(keys), self._parameters(keys))
+
+    def get_latest_rows(self, keys:pd.DataFrame) -> pd.DataFrame:
+        # Latest row of every key of keys (one column per key column) that has one
+        key_columns = list(keys.columns)
+        # The temporary table of the keys is held until it is read
+        with self.lock:
+            join = self._load_keys(key_columns, keys.itertuples(index=False, name=None))
+            latest = (f"SELECT max(t.{SEQUENCE_COLUMN}) FROM temp.lookup_keys k JOIN {quote(self.table)} t ON {join} "
+                      f"GROUP BY {self._column_list(key_columns, 'k.')}")
+            return self._select(f"WHERE t.{SEQUENCE_COLUMN} IN ({latest})", suffix=f"ORDER BY t.{SEQUENCE_COLUMN}")
+
+    def get_row_by_timestamp(self, keys:Dict[str, Any], timestamp:Any, timestamp_column:str) -> pd.Series:
+        # Latest row of the key whose timestamp_column equals timestamp
+        keys = {**keys, timestamp_column: timestamp}
+        return self._row(self._where(keys), self._parameters(keys))
+
+    def get_rows_by_timestamp_range(self, keys:Dict[str, list], from_timestamp:Any, to_timestamp:Any,
+                                    timestamp_column:str) -> pd.DataFrame:
+        # Rows of every combination of the key values with from_timestamp <= timestamp_column <= to_timestamp, in write
+        # order
+        key_columns = list(keys.keys())
+        parameters = (self._sql_value(timestamp_column, from_timestamp),
+                      self._sql_value(timestamp_column, to_timestamp))
+        with self.lock:
+            join = self._load_keys(key_columns, product(*keys.values()))
+            return self._select(f"JOIN temp.lookup_keys k ON {join} "
+                                f"WHERE t.{self.sql_columns[timestamp_column]} BETWEEN ? AND ?",
+                                parameters, f"ORDER BY t.{SEQUENCE_COLUMN}")
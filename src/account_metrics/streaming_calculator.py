@@ -0,0 +1,53 @@
+from typing import Iterable, Iterator, List, Type
+
+import pandas as pd
+
+from account_metrics.basic_deal_calculator import BasicDealMetricCalculator
+from account_metrics.metric_state import MetricState
+
+
+class StreamingDealMetricCalculator:
+    # Long-lived calculator for a stream of MT5Deal micro-batches, e.g. one per Kafka consumer
+    # (Meta.kafka_num_consumers). The latest metric of every groupby key is kept in memory between batches, so the
+    # datastore is only read for keys seen for the first time. Calculated rows are written to the datastore at
+    # checkpoints.
+    def __init__(self, calculator:Type[BasicDealMetricCalculator], vectorized:bool = True,
+                 checkpoint_every:int = None):
+        self.calculator = calculator
+        self.vectorized = vectorized
+        # Number of fed batches between automatic checkpoints, None to checkpoint only when asked
+        # (and at the end of feed_stream)
+        self.checkpoint_every = checkpoint_every
+        self.key_columns: List[str] = calculator.output_metric.Meta.groupby_update_format
+        self.state = MetricState(calculator.output_metric, self.key_columns)
+        self.pending: List[pd.DataFrame] = []
+        self.batches_since_checkpoint = 0
+        # Deals dropped as already processed since the start of the stream (redeliveries after a consumer restart)
+        self.dropped_deals = 0
+
+    def feed(self, batch:pd.DataFrame) -> pd.DataFrame:
+        result, dropped_deals = self.calculator.calculate(batch, vectorized=self.vectorized, state=self.state,
+                                                          return_dropped=True)
+        self.dropped_deals += dropped_deals
+        if not result.empty:
+            self.update_state(result)
+            self.pending.append(result)
+        self.batches_since_checkpoint += 1
+        if self.checkpoint_every and self.batches_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+        return result
+
+    def feed_stream(self, batches:Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for batch in batches:
+            yield self.feed(batch)
+        self.checkpoint()
+
+    def checkpoint(self):
+        if self.pending:
+            datastore = self.calculator.get_metric_runner().get_datastore(self.calculator.output_metric)
+            datastore.put(pd.concat(self.pending, ignore_index=True))
+            self.pending = []
+        self.batches_since_checkpoint = 0
+
+    def update_state(self, result:pd.DataFrame):
+        self.state.update(result)
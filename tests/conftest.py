@@ -69,6 +69,18 @@ def strip_quotes_from_string_columns(df:pd.DataFrame):
         df[col] = df[col].astype('string')  
     return df
     
+def get_deal(from_timestamp:datetime.date = None,to_timestamp:datetime.date = None):
+    return get_metric_from_csv(MT5Deal,TEST_DATAFRAME_PATH[MT5Deal])
+
+def get_history(from_timestamp:datetime.date = None,to_timestamp:datetime.date = None):
+    history = get_metric_from_csv(MT5DealDaily, TEST_DATAFRAME_PATH[MT5DealDaily])
+    history["Date"] = pd.to_datetime(history["Date"]).dt.date
+    if from_timestamp:
+        history = history[(history["timestamp_utc"] >= from_timestamp)]
+    if to_timestamp:
+        history = history[(history["timestamp_utc"] <= to_timestamp)]
+    return history
+
 @pytest.fixture
 def get_test_name(request):
     return request.node.name
@@ -79,12 +91,18 @@ class MockDatastore(Datastore):
         self.metric_data = metric_data
 
     def get_latest_row(self,keys:Dict[str,Any]) -> pd.Series:
-        login = keys["login"]
-        id_column = "login" if self.metric_data != PositionMetricByDeal else "position_id"
-        result = self.data[self.data[id_column] == login]
+        result = self.data[(self.data[list(keys.keys())] == pd.Series(keys)).all(axis=1)]
         if result.empty:
             return pd.Series(self.metric_data().model_dump())
         return result.iloc[-1]
+
+    def get_latest_rows(self,keys:pd.DataFrame) -> pd.DataFrame:
+        if self.data.empty:
+            return self.data
+        latest = self.data.drop_duplicates(subset=list(keys.columns), keep="last")
+        latest_keys = latest[list(keys.columns)].astype(keys.dtypes.to_dict())
+        is_requested = pd.MultiIndex.from_frame(latest_keys).isin(pd.MultiIndex.from_frame(keys))
+        return latest[is_requested]
     
     def get_row_by_timestamp(self,keys:Dict[str,Any],timestamp:datetime.date,timestamp_column:str) -> pd.Series:
         filter_condition = (self.data[list(keys.keys())] == pd.Series(keys)).all(axis=1) & (self.data[timestamp_column] == timestamp)
@@ -93,13 +111,51 @@ class MockDatastore(Datastore):
             default_row = {**keys, "Balance": 0.0, "ProfitEquity": 0.0}
             return pd.Series(default_row)
         return result.iloc[-1]
-    
+
+    def get_rows_by_timestamp_range(self,keys:Dict[str,list],from_timestamp:datetime.date,to_timestamp:datetime.date,
+                                    timestamp_column:str) -> pd.DataFrame:
+        filter_condition = self.data[list(keys.keys())].isin(keys).all(axis=1)
+        timestamp = self.data[timestamp_column]
+        filter_condition &= (timestamp >= from_timestamp) & (timestamp <= to_timestamp)
+        return self.data[filter_condition]
+
     def put(self,data:Any):
         self.data = pd.concat([self.data,data],ignore_index=True)
         
+class SingleRowMockDatastore(MockDatastore):
+    # Datastore without the bulk get_latest_rows lookup
+    get_latest_rows = None
+        
+class ExactLookupMockDatastore(MockDatastore):
+    # Datastore without range scans whose get_row_by_timestamp returns None for a missing row
+    get_rows_by_timestamp_range = None
+
+    def get_row_by_timestamp(self,keys:Dict[str,Any],timestamp:datetime.date,timestamp_column:str) -> pd.Series:
+        is_key = (self.data[list(keys.keys())] == pd.Series(keys)).all(axis=1)
+        result = self.data[is_key & (self.data[timestamp_column] == timestamp)]
+        return None if result.empty else result.iloc[-1]
+
 class MockMetricRunner:
     def __init__(self,datastores:Dict[Type[MetricData],Datastore]):
         self.datastores = datastores
         
     def get_datastore(self,metric_data:Type[MetricData]) -> MockDatastore:
-        return self.datastores[metric_data]
\ No newline at end of file
+        return self.datastores[metric_data]
+
+@pytest.fixture
+def make_metric_runner():
+    # Metric runner with the deal history and empty datastores of the given metrics
+    def make_metric_runner(*metrics, history:pd.DataFrame = None, datastore_class:Type[Datastore] = MockDatastore):
+        history = get_history() if history is None else history
+        datastores = {metric: datastore_class(metric, data=pd.DataFrame(columns=metric.model_fields.keys()))
+                      for metric in metrics}
+        return MockMetricRunner({**datastores, MT5DealDaily: datastore_class(MT5DealDaily, data=history)})
+    return make_metric_runner
+
+@pytest.fixture
+def calculator_runner(make_metric_runner):
+    # Sets a fresh metric runner for the output metric of the calculator
+    def calculator_runner(calculator, **kwargs) -> MockMetricRunner:
+        calculator.set_metric_runner(make_metric_runner(calculator.output_metric, **kwargs))
+        return calculator.get_metric_runner()
+    return calculator_runner
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from account_metrics.account_metric_by_deal import AccountMetricByDeal, AccountMetricByDealCalculator
+from account_metrics.cached_datastore import CachedDatastore, CachedMetricRunner
+from account_metrics.mt5_deal_daily import MT5DealDaily
+from tests.conftest import MockDatastore, get_deal
+
+KEY_COLUMNS = ["server", "login"]
+
+def get_metric_rows():
+    return pd.DataFrame({"server": ["demo", "demo", "demo", "live"], "login": [1, 2, 1, 1],
+                         "balance": [10.0, 20.0, 11.0, 30.0]})
+
+def get_keys(*logins):
+    return pd.DataFrame({"server": ["demo"] * len(logins), "login": list(logins)})
+
+def test_cached_datastore_hits_and_write_through():
+    backend = MockDatastore(AccountMetricByDeal, get_metric_rows())
+    datastore = CachedDatastore(backend, AccountMetricByDeal, KEY_COLUMNS)
+    # Rows have the columns of the metric whatever the first frame seen
+    assert list(datastore.get_latest_rows(get_keys(3)).columns) == list(AccountMetricByDeal.model_fields)
+    assert datastore.get_latest_rows(get_keys(1, 3))["balance"].tolist() == [11.0]
+    assert datastore.stats() == {"size": 2, "hits": 1, "misses": 2, "evictions": 0, "expirations": 0}
+
+    # Login 3 is cached as having no row, login 2 is read from the datastore
+    assert datastore.get_latest_rows(get_keys(1, 2, 3))["balance"].tolist() == [11.0, 20.0]
+    assert (datastore.hits, datastore.misses) == (3, 3)
+
+    # put goes to the datastore and refreshes the cache
+    datastore.put(pd.DataFrame({"server": ["demo", "demo"], "login": [3, 1], "balance": [5.0, 12.0]}))
+    assert len(datastore.datastore.data) == 6
+    assert datastore.get_latest_rows(get_keys(3, 1))["balance"].tolist() == [5.0, 12.0]
+    assert (datastore.hits, datastore.misses) == (5, 3)
+
+def test_cached_datastore_latest_row_and_direct_writes():
+    backend = MockDatastore(AccountMetricByDeal, get_metric_rows())
+    datastore = CachedDatastore(backend, AccountMetricByDeal, KEY_COLUMNS)
+    assert datastore.get_latest_row({"server": "demo", "login": 1})["balance"] == 11.0
+    assert datastore.get_latest_row({"login": 1, "server": "demo"})["balance"] == 11.0
+    assert datastore.get_latest_rows(get_keys(1))["balance"].tolist() == [11.0]
+    assert (datastore.hits, datastore.misses) == (2, 1)
+
+    # A write made to the datastore itself refreshes the cache too
+    backend.put(pd.DataFrame({"server": ["demo"], "login": [1], "balance": [13.0]}))
+    assert len(backend.data) == 5
+    assert datastore.get_latest_row({"server": "demo", "login": 1})["balance"] == 13.0
+    assert datastore.get_latest_rows(get_keys(1))["balance"].tolist() == [13.0]
+    assert (datastore.hits, datastore.misses) == (4, 1)
+
+def test_cached_datastore_concurrent_access():
+    backend = MockDatastore(AccountMetricByDeal, get_metric_rows())
+    datastore = CachedDatastore(backend, AccountMetricByDeal, KEY_COLUMNS, max_entries=4)
+    logins = list(range(1, 9))
+
+    def read_and_write(login):
+        # Every thread writes increasing balances of its login and reads them back among the others,
+        # evicting as it goes
+        for balance in range(20):
+            datastore.put(pd.DataFrame({"server": ["demo"], "login": [login], "balance": [float(balance)]}))
+            assert datastore.get_latest_row({"server": "demo", "login": login})["balance"] == balance
+            rows = datastore.get_latest_rows(get_keys(*logins))
+            assert rows.loc[rows["login"] == login, "balance"].tolist() == [balance]
+
+    with ThreadPoolExecutor(len(logins)) as threads:
+        list(threads.map(read_and_write, logins))
+    stats = datastore.stats()
+    assert stats["size"] <= 4 and stats["hits"] + stats["misses"] == len(logins) * 20 * (1 + len(logins))
+    assert datastore.get_latest_rows(get_keys(*logins))["balance"].tolist() == [19.0] * len(logins)
+
+def test_cached_datastore_eviction_and_ttl():
+    now = [0.0]
+    backend = MockDatastore(AccountMetricByDeal, get_metric_rows())
+    datastore = CachedDatastore(backend, AccountMetricByDeal, KEY_COLUMNS, max_entries=2, ttl=10, clock=lambda: now[0])
+    datastore.get_latest_rows(get_keys(1, 2))
+    datastore.get_latest_rows(get_keys(1))
+    datastore.get_latest_rows(get_keys(3))
+    # Login 2 was the least recently used
+    assert list(datastore.rows.keys()) == [("demo", 1), ("demo", 3)] and datastore.evictions == 1
+
+    now[0] = 11.0
+    datastore.get_latest_rows(get_keys(1))
+    assert (datastore.expirations, datastore.misses) == (1, 4)
+
+def test_cached_metric_runner(make_metric_runner):
+    deal = get_deal()
+    first_retrieve_deal = deal[deal["timestamp_utc"] < deal["timestamp_utc"].iloc[len(deal)//2-1]]
+    calculated_dfs = []
+    for cached in [False, True]:
+        metric_runner = make_metric_runner(AccountMetricByDeal)
+        cached_runner = CachedMetricRunner(metric_runner, [AccountMetricByDeal]) if cached else metric_runner
+        AccountMetricByDealCalculator.set_metric_runner(cached_runner)
+        datastore = AccountMetricByDealCalculator.get_metric_runner().get_datastore(AccountMetricByDeal)
+        datastore.put(AccountMetricByDealCalculator.calculate(first_retrieve_deal, vectorized=True))
+        calculated_dfs.append(AccountMetricByDealCalculator.calculate(deal, vectorized=True))
+
+    assert isinstance(datastore, CachedDatastore)
+    history_datastore = metric_runner.get_datastore(MT5DealDaily)
+    assert AccountMetricByDealCalculator.get_metric_runner().get_datastore(MT5DealDaily) is history_datastore
+    # Logins of the first batch were cached by the write-through put
+    assert datastore.hits == first_retrieve_deal["login"].nunique()
+    # Misses: every login of the first batch, then the logins not seen before
+    assert datastore.misses == deal["login"].nunique()
+    pd.testing.assert_frame_equal(calculated_dfs[1], calculated_dfs[0], check_dtype=True)
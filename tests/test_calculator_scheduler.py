@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from account_metrics.account_metric_by_deal import AccountMetricByDeal, AccountMetricByDealCalculator
+from account_metrics.account_metrics import METRIC_CALCULATORS
+from account_metrics.calculator_scheduler import CalculatorScheduler
+from account_metrics.memory_datastore import MemoryDatastore
+from account_metrics.metric_model import MetricCalculator
+from account_metrics.mt5_deal import MT5Deal
+from account_metrics.mt5_deal_daily import MT5DealDaily
+from account_metrics.sqlite_datastore import SQLiteDatastore
+from tests.conftest import MockMetricRunner, get_deal, get_history
+
+
+def get_expected(make_metric_runner, deal:pd.DataFrame, history:pd.DataFrame) -> dict:
+    # Outputs of the deal calculators run one by one
+    expected = {}
+    for metric, calculator in METRIC_CALCULATORS.items():
+        if metric not in (MT5Deal, MT5DealDaily):
+            calculator.set_metric_runner(make_metric_runner(*METRIC_CALCULATORS, history=history))
+            expected[metric] = calculator.calculate(deal, vectorized=True)
+    return expected
+
+def test_calculator_stages():
+    scheduler = CalculatorScheduler(METRIC_CALCULATORS.values())
+    assert [[calculator.output_metric for calculator in stage] for stage in scheduler.stages] == \
+        [[MT5Deal, MT5DealDaily], [metric for metric in METRIC_CALCULATORS if metric not in (MT5Deal, MT5DealDaily)]]
+    # The previous output of a calculator is not a dependency
+    dependencies = [METRIC_CALCULATORS[MT5Deal], METRIC_CALCULATORS[MT5DealDaily]]
+    assert scheduler.dependencies(AccountMetricByDealCalculator) == dependencies
+
+    class FirstCalculator(MetricCalculator):
+        input_class = MT5Deal
+        output_metric = MT5DealDaily
+    class SecondCalculator(MetricCalculator):
+        input_class = MT5DealDaily
+        output_metric = MT5Deal
+    with pytest.raises(ValueError, match="Cyclic"):
+        CalculatorScheduler([FirstCalculator, SecondCalculator])
+
+def test_calculator_scheduler_run(make_metric_runner):
+    deal, history = get_deal(), get_history()
+    expected = get_expected(make_metric_runner, deal, history)
+
+    for executor in ["thread", "process"]:
+        for calculator in METRIC_CALCULATORS.values():
+            # The MT5DealDaily rows are only in the input of the run,
+            # they reach the deal calculators without being stored
+            calculator.set_metric_runner(make_metric_runner(*METRIC_CALCULATORS, history=history.iloc[:0]))
+        metric_runner = AccountMetricByDealCalculator.get_metric_runner()
+        scheduler = CalculatorScheduler(METRIC_CALCULATORS.values(), executor=executor, vectorized=True)
+        outputs = scheduler.run({"Deal": deal, "History": history})
+
+        assert AccountMetricByDealCalculator.get_metric_runner() is metric_runner
+        assert metric_runner.get_datastore(MT5DealDaily).data.empty
+        assert metric_runner.get_datastore(AccountMetricByDeal).data.empty
+        assert outputs[MT5Deal]["Deal"].tolist() == deal["Deal"].tolist()
+        assert len(outputs[MT5DealDaily]) == len(history)
+        for metric, expected_df in expected.items():
+            pd.testing.assert_frame_equal(outputs[metric], expected_df, check_dtype=True)
+
+@pytest.mark.parametrize("datastore", [MemoryDatastore, SQLiteDatastore])
+def test_calculator_scheduler_datastores(datastore, make_metric_runner):
+    deal, history = get_deal(), get_history()
+    expected = get_expected(make_metric_runner, deal, history)
+    # Calculations reading the datastores of the calculator classes would fail
+    calculator_runners = {calculator: MockMetricRunner({}) for calculator in METRIC_CALCULATORS.values()}
+    for calculator, runner in calculator_runners.items():
+        calculator.set_metric_runner(runner)
+
+    # One datastore per metric shared by the calculators running in the threads of a stage
+    metric_runner = MockMetricRunner({metric: datastore(metric) for metric in METRIC_CALCULATORS})
+    scheduler = CalculatorScheduler(METRIC_CALCULATORS.values(), vectorized=True, metric_runner=metric_runner)
+    outputs = scheduler.run({"Deal": deal, "History": history})
+
+    # The runner is passed to the calculations, the calculator classes keep theirs
+    assert all(calculator.get_metric_runner() is runner for calculator, runner in calculator_runners.items())
+    assert len(metric_runner.get_datastore(MT5DealDaily)) == 0
+    for metric, expected_df in expected.items():
+        pd.testing.assert_frame_equal(outputs[metric], expected_df, check_dtype=True)
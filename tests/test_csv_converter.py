@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+from account_metrics.csv_converter import SUPERSET_DEAL_COLUMNS, convert_csv, read_csv_chunks
+from account_metrics.mt5_deal import MT5Deal
+from tests.conftest import TEST_DATAFRAME_PATH
+
+
+def get_deal():
+    # The export has no lower case login/deal_id columns
+    return pd.read_csv(TEST_DATAFRAME_PATH[MT5Deal]).drop(columns=["login", "deal_id"])
+
+@pytest.fixture
+def superset_csv(tmp_path):
+    # MT5Deal test data with the column names of a Superset export
+    deal = get_deal().rename(columns={field: column for column, field in SUPERSET_DEAL_COLUMNS.items()})
+    path = tmp_path / "superset_deals.csv"
+    deal.to_csv(path, index=False)
+    return path
+
+def test_read_csv_chunks(superset_csv):
+    chunks = list(read_csv_chunks(superset_csv, SUPERSET_DEAL_COLUMNS, chunksize=7))
+    assert [len(chunk) for chunk in chunks[:-1]] == [7] * (len(chunks) - 1)
+    deal = pd.concat(chunks, ignore_index=True)
+    assert set(SUPERSET_DEAL_COLUMNS.values()) <= set(deal.columns)
+    assert deal["Deal"].dtype == "int64" and deal["Profit"].dtype == "float64" and deal["Comment"].dtype == object
+    assert not deal["Comment"].isna().any()
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_convert_csv(superset_csv, tmp_path, processes):
+    output_path = tmp_path / "deals.csv"
+    rows = convert_csv(superset_csv, output_path, SUPERSET_DEAL_COLUMNS, chunksize=7, processes=processes)
+    expected = get_deal()
+    assert rows == len(expected)
+    pd.testing.assert_frame_equal(pd.read_csv(output_path)[list(expected.columns)], expected, check_dtype=False)
+
+    rows = convert_csv(superset_csv, output_path, SUPERSET_DEAL_COLUMNS, chunksize=7, processes=processes, limit=10)
+    assert rows == 10
+    assert len(pd.read_csv(output_path)) == 10
+
+def test_convert_csv_to_parquet(superset_csv, tmp_path):
+    pytest.importorskip("pyarrow")
+    output_path = tmp_path / "deals.parquet"
+    rows = convert_csv(superset_csv, output_path, SUPERSET_DEAL_COLUMNS, chunksize=7)
+    expected = get_deal()
+    # Empty text cells are read back as empty strings
+    text_columns = [column for column in expected.columns if MT5Deal.model_fields[column].annotation is str]
+    expected[text_columns] = expected[text_columns].fillna("").astype(str)
+    assert rows == len(expected)
+    pd.testing.assert_frame_equal(pd.read_parquet(output_path)[list(expected.columns)], expected, check_dtype=False,
+                                  check_categorical=False)
+
+def test_convert_csv_in_parallel_is_identical(superset_csv, tmp_path):
+    # Quoted fields spanning lines and blank lines do not move the chunk boundaries of the workers
+    deal = pd.read_csv(superset_csv)
+    deal["comment"] = deal["comment"].astype(object)
+    deal.loc[3, "comment"] = 'line\nbreak, "quoted"'
+    deal.loc[8, "comment"] = '"\n\n"'
+    input_path = tmp_path / "multiline_deals.csv"
+    deal.to_csv(input_path, index=False)
+    with open(input_path, "a") as infile:
+        infile.write("\n")
+
+    serial_path, parallel_path = tmp_path / "serial.csv", tmp_path / "parallel.csv"
+    assert convert_csv(input_path, serial_path, SUPERSET_DEAL_COLUMNS, chunksize=5) == len(deal)
+    assert convert_csv(input_path, parallel_path, SUPERSET_DEAL_COLUMNS, chunksize=5, processes=3) == len(deal)
+    assert parallel_path.read_bytes() == serial_path.read_bytes()
+    assert pd.read_csv(serial_path)["Comment"].iloc[[3, 8]].tolist() == ['line\nbreak, "quoted"', '"\n\n"']
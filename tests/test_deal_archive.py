@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+from account_metrics.account_metric_by_deal import AccountMetricByDealCalculator
+from account_metrics.deal_archive import DealArchive
+from account_metrics.mt5_deal import MT5Deal
+from account_metrics.position_metric_by_deal import PositionMetricByDealCalculator
+from tests.conftest import get_deal
+
+
+def test_deal_archive_read(tmp_path):
+    deal = get_deal()
+    DealArchive.write(tmp_path / "archive", deal)
+    archive = DealArchive(tmp_path / "archive")
+    assert archive.columns == [column for column in MT5Deal.model_fields if column in deal.columns]
+    assert sorted(archive.keys()) == sorted(set(deal[["server", "login"]].itertuples(index=False, name=None)))
+
+    key = archive.keys()[1]
+    is_key = (deal["server"] == key[0]) & (deal["login"] == key[1])
+    expected = deal[is_key].sort_values(["Time", "Deal"], kind="stable")
+    account = archive.read([key], ["Deal", "Profit", "Comment"])
+    # A single account is a slice of the memory maps
+    assert isinstance(account["Profit"].base, np.memmap) or isinstance(account["Profit"], np.memmap)
+    assert account["Deal"].tolist() == expected["Deal"].tolist()
+    assert account["Comment"].tolist() == expected["Comment"].tolist()
+
+    frame = archive.frame(archive.keys()[:3] + [("unknown", 0)], ["server", "login", "Deal", "Profit"])
+    sorted_deal = deal.sort_values(["server", "login", "Time", "Deal"], kind="stable")
+    assert frame["Deal"].tolist() == sorted_deal["Deal"].iloc[:len(frame)].tolist()
+    assert frame["server"].dtype == object
+
+def test_deal_archive_replay(tmp_path, calculator_runner):
+    deal = get_deal()
+    archive = DealArchive.write(tmp_path / "archive", deal)
+    keys = archive.keys()[::2]
+    for calculator in [AccountMetricByDealCalculator, PositionMetricByDealCalculator]:
+        calculator_runner(calculator)
+        replayed_deal = deal[pd.MultiIndex.from_frame(deal[["server", "login"]]).isin(keys)]
+        expected_df = calculator.calculate(replayed_deal, vectorized=True)
+        pd.testing.assert_frame_equal(archive.replay(calculator, keys), expected_df, check_dtype=True)
+        expected_df = calculator.calculate(deal, vectorized=True)
+        pd.testing.assert_frame_equal(archive.replay(calculator), expected_df, check_dtype=True)
+
+def test_deal_archive_replay_reads_memory_maps(tmp_path, monkeypatch, calculator_runner):
+    archive = DealArchive.write(tmp_path / "archive", get_deal())
+    calculator = AccountMetricByDealCalculator
+    calculator_runner(calculator)
+    batches = []
+    calculate_batch = calculator.calculate_batch
+    def record_batch(deals, group_index, current_metric):
+        batches.append(deals)
+        return calculate_batch(deals, group_index, current_metric)
+    monkeypatch.setattr(calculator, "calculate_batch", record_batch)
+
+    # The whole archive is one run and every other account a run of its own;
+    # the engine reads the memory maps in place
+    archive.replay(calculator)
+    archive.replay(calculator, archive.keys()[::2])
+    assert len(batches) == 1 + len(archive.keys()[::2])
+    for deals in batches:
+        for column in ["Deal", "Time", "Profit"]:
+            assert np.shares_memory(deals[column].to_numpy(), archive.column(column))
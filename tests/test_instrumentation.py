@@ -0,0 +1,43 @@
+import json
+
+from account_metrics.account_metric_by_deal import AccountMetricByDeal, AccountMetricByDealCalculator
+from account_metrics.instrumentation import InstrumentationRegistry
+from account_metrics.metric_model import MetricCalculator
+from tests.conftest import get_deal
+
+CALCULATOR = {"calculator": "AccountMetricByDealCalculator"}
+
+def test_calculator_instrumentation(make_metric_runner):
+    deal = get_deal()
+    metric_runner = make_metric_runner(AccountMetricByDeal)
+    AccountMetricByDealCalculator.set_metric_runner(metric_runner)
+    assert AccountMetricByDealCalculator.get_metric_runner() is metric_runner
+
+    registry = InstrumentationRegistry()
+    MetricCalculator.set_instrumentation(registry)
+    try:
+        calculated_df = AccountMetricByDealCalculator.calculate(deal)
+        AccountMetricByDealCalculator.get_metric_runner().get_datastore(AccountMetricByDeal).put(calculated_df)
+        # Replayed deals are skipped as stale
+        AccountMetricByDealCalculator.calculate(deal, vectorized=True)
+    finally:
+        MetricCalculator.set_instrumentation(None)
+
+    assert registry.get("calls_total", **CALCULATOR) == 2
+    assert registry.get("rows_in_total", **CALCULATOR) == 2 * len(deal)
+    assert registry.get("rows_out_total", **CALCULATOR) == len(calculated_df)
+    assert registry.get("groups_total", **CALCULATOR) == 2 * deal["login"].nunique()
+    assert registry.get("stale_deals_total", **CALCULATOR) == len(deal)
+    stages = {sample["labels"]["stage"] for sample in registry.snapshot()["stage_seconds_total"]}
+    assert stages == {"calculate", "grouping", "state_fetch", "history_fetch", "row_compute", "frame_build"}
+    assert all(sample["value"] >= 0 for sample in registry.snapshot()["stage_seconds_total"])
+    for method, calls in [("get_latest_rows", 2), ("get_rows_by_timestamp_range", 1), ("put", 1)]:
+        datastore = "MT5DealDaily" if method == "get_rows_by_timestamp_range" else "AccountMetricByDeal"
+        assert registry.get("datastore_calls_total", datastore=datastore, method=method, **CALCULATOR) == calls
+
+    prometheus = registry.to_prometheus()
+    assert "# TYPE account_metrics_calls_total counter\n" in prometheus
+    assert 'account_metrics_calls_total{calculator="AccountMetricByDealCalculator"} 2\n' in prometheus
+    assert json.loads(registry.to_json()) == registry.snapshot()
+    registry.reset()
+    assert registry.to_prometheus() == ""
@@ -0,0 +1,75 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from account_metrics.account_metric_by_deal import AccountMetricByDealCalculator
+from account_metrics.memory_datastore import MemoryDatastore
+from account_metrics.mt5_deal_daily import MT5DealDaily
+from account_metrics.position_metric_by_deal import PositionMetricByDealCalculator
+from tests.conftest import MockDatastore, get_deal, get_history
+
+
+def test_memory_datastore_lookups():
+    history = get_history()
+    datastore = MemoryDatastore(MT5DealDaily, capacity=4)
+    for i in range(0, len(history), 3):
+        datastore.put(history.iloc[i:i+3])
+    assert len(datastore) == len(history) and datastore.data["Balance"].tolist() == history["Balance"].tolist()
+
+    login, date = history[["Login", "Date"]].iloc[-1]
+    expected = history[history["Login"] == login]
+    assert datastore.get_latest_row({"Login": login})["Balance"] == expected["Balance"].iloc[-1]
+    assert datastore.get_latest_row({"Login": -1}) is None
+    expected_balance = expected[expected["Date"] == date]["Balance"].iloc[-1]
+    assert datastore.get_row_by_timestamp({"Login": login}, date, "Date")["Balance"] == expected_balance
+    assert datastore.get_row_by_timestamp({"Login": login}, datetime.date(1970, 1, 1), "Date") is None
+
+    from_date = history["Date"].min() + datetime.timedelta(days=1)
+    to_date = history["Date"].max() - datetime.timedelta(days=1)
+    logins = history["Login"].unique()[:2].tolist()
+    rows = datastore.get_rows_by_timestamp_range({"Login": logins}, from_date, to_date, "Date")
+    expected = history[history["Login"].isin(logins) & (history["Date"] >= from_date) & (history["Date"] <= to_date)]
+    assert rows["Balance"].tolist() == expected["Balance"].tolist()
+
+    # Indexes are kept up to date by put
+    datastore.put(pd.DataFrame({"Login": [login], "Date": [date], "Balance": [-1.0]}))
+    assert datastore.get_latest_row({"Login": login})["Balance"] == -1.0
+    assert datastore.get_row_by_timestamp({"Login": login}, date, "Date")["Balance"] == -1.0
+    keys = pd.DataFrame({"Login": [login, -1]})
+    assert datastore.get_latest_rows(keys)["Balance"].tolist() == [-1.0]
+
+def test_memory_datastore_keeps_timestamps_sorted():
+    # Rows put in any order after the sorted index is built are merged into it, never re-sorted on read
+    history = get_history()
+    shuffled = history.sample(frac=1, random_state=0).reset_index(drop=True)
+    datastore = MemoryDatastore(MT5DealDaily, shuffled.iloc[:5])
+    login = shuffled["Login"].iloc[0]
+    datastore.get_rows_by_timestamp_range({"Login": [login]}, history["Date"].min(), history["Date"].max(), "Date")
+    for i in range(5, len(shuffled), 4):
+        datastore.put(shuffled.iloc[i:i+4])
+    datastore.put(shuffled.iloc[:3])
+
+    data = datastore.data
+    sorted_rows = datastore.timestamp_indexes[(("Login",), "Date")]
+    for key, rows in sorted_rows.items():
+        timestamps, positions = rows.sorted()
+        expected = data.index[data["Login"] == key[0]].to_numpy()
+        expected = expected[np.argsort(data["Date"].to_numpy()[expected], kind="stable")]
+        assert positions.tolist() == expected.tolist() and list(timestamps) == data["Date"].iloc[expected].tolist()
+    date = shuffled["Date"].iloc[0]
+    expected = data[(data["Login"] == login) & (data["Date"] == date)]["Balance"].iloc[-1]
+    assert datastore.get_row_by_timestamp({"Login": login}, date, "Date")["Balance"] == expected
+
+def test_memory_datastore_calculation(calculator_runner):
+    deal = get_deal()
+    first_retrieve_deal = deal[deal["timestamp_utc"] < deal["timestamp_utc"].iloc[len(deal)//2-1]]
+    for calculator in [AccountMetricByDealCalculator, PositionMetricByDealCalculator]:
+        calculated_dfs = []
+        for datastore_class in [MockDatastore, MemoryDatastore]:
+            metric_runner = calculator_runner(calculator, datastore_class=datastore_class)
+            metric_runner.get_datastore(calculator.output_metric).put(calculator.calculate(first_retrieve_deal))
+            calculated_dfs.append(calculator.calculate(deal))
+            calculated_dfs.append(calculator.calculate(deal, vectorized=True))
+        for calculated_df in calculated_dfs[1:]:
+            pd.testing.assert_frame_equal(calculated_df, calculated_dfs[0], check_dtype=True)
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from account_metrics.metric_utils import (
+    apply_groupby_mapping_of_metric_to_data,
+    decode_string_binary_column,
+    decode_text,
+    new_day_mask,
+    segmented_cummax,
+    segmented_cummin,
+    segmented_cumsum,
+    segmented_daily_cummax,
+    segmented_daily_cumsum,
+    segmented_day_carry,
+    segmented_is_stale,
+    segmented_last,
+    segmented_shift,
+    sort_by_group,
+)
+from account_metrics.mt5_deal import MT5Deal
+from account_metrics.mt_deal_enum import (
+    EnDealAction,
+    EnDealEntry,
+    enum_value,
+    is_balance,
+    is_buy,
+    is_close,
+    is_gross_excluded,
+    is_non_trading_cashflow,
+    is_open,
+    is_sell,
+    is_trade,
+)
+from account_metrics.position_metric_by_deal import PositionMetricByDeal
+
+# Two groups of deals; group 1 skips group index 1 as happens when all deals of a group were already processed
+GROUP_INDEX = np.array([0, 0, 0, 0, 2, 2, 2])
+VALUES = np.array([1.5, -2.0, 4.0, 0.5, 3.0, -1.0, 2.5])
+MASK = np.array([True, False, True, True, False, True, True])
+INITIAL = np.array([10.0, np.nan, -5.0])
+DAY = np.array([1, 1, 2, 4, 3, 3, 5])
+INITIAL_DAY = np.array([1, 0, 2])
+
+def scan_by_row(step, initial):
+    # Reference: the calculate_row way, carrying prev from row to row
+    result = []
+    for i in range(len(GROUP_INDEX)):
+        prev = initial[GROUP_INDEX[i]] if i == 0 or GROUP_INDEX[i] != GROUP_INDEX[i-1] else result[-1]
+        result.append(step(prev, i))
+    return np.array(result)
+
+def test_segmented_cumsum():
+    expected = scan_by_row(lambda prev, i: prev + (VALUES[i] if MASK[i] else 0.0), INITIAL)
+    np.testing.assert_array_equal(segmented_cumsum(VALUES, INITIAL, GROUP_INDEX, mask=MASK), expected)
+    expected = scan_by_row(lambda prev, i: prev + 1, np.array([3, 0, 7]))
+    ones = np.ones(len(VALUES), dtype="int64")
+    np.testing.assert_array_equal(segmented_cumsum(ones, np.array([3, 0, 7]), GROUP_INDEX), expected)
+
+def test_segmented_cummax_cummin():
+    zeros = np.array([0.0, 0.0, 0.0])
+    expected = scan_by_row(lambda prev, i: VALUES[i] if MASK[i] and VALUES[i] > prev else prev, zeros)
+    np.testing.assert_array_equal(segmented_cummax(VALUES, zeros, GROUP_INDEX, mask=MASK), expected)
+    expected = scan_by_row(lambda prev, i: VALUES[i] if MASK[i] and VALUES[i] < prev else prev, zeros)
+    np.testing.assert_array_equal(segmented_cummin(VALUES, zeros, GROUP_INDEX, mask=MASK), expected)
+
+def test_segmented_last_and_shift():
+    expected = scan_by_row(lambda prev, i: VALUES[i] if not MASK[i] else prev, INITIAL)
+    np.testing.assert_array_equal(segmented_last(VALUES, INITIAL, GROUP_INDEX, mask=~MASK), expected)
+    comments = np.array(["a", "b", "c", "d", "e", "f", "g"], dtype=object)
+    initial_comments = np.array(["x", "y", "z"], dtype=object)
+    expected = scan_by_row(lambda prev, i: comments[i] if MASK[i] else prev, initial_comments)
+    np.testing.assert_array_equal(segmented_last(comments, initial_comments, GROUP_INDEX, mask=MASK), expected)
+    np.testing.assert_array_equal(segmented_shift(DAY, INITIAL_DAY, GROUP_INDEX), [1, 1, 1, 2, 2, 3, 3])
+    np.testing.assert_array_equal(new_day_mask(DAY, INITIAL_DAY, GROUP_INDEX),
+                                  [False, False, True, True, True, False, True])
+
+def test_segmented_day_carry():
+    is_new_day = new_day_mask(DAY, INITIAL_DAY, GROUP_INDEX)
+    running = segmented_cumsum(VALUES, INITIAL, GROUP_INDEX)
+    initial_yesterday = np.array([7.0, np.nan, -8.0])
+
+    # yesterday = prev.value if prev.date < date else prev.yesterday
+    expected, prev_value = [], None
+    for i in range(len(GROUP_INDEX)):
+        if i == 0 or GROUP_INDEX[i] != GROUP_INDEX[i-1]:
+            prev_value, prev_yesterday = INITIAL[GROUP_INDEX[i]], initial_yesterday[GROUP_INDEX[i]]
+        expected.append(prev_value if is_new_day[i] else prev_yesterday)
+        prev_value, prev_yesterday = running[i], expected[-1]
+    carried = segmented_day_carry(running, INITIAL, initial_yesterday, is_new_day, GROUP_INDEX)
+    np.testing.assert_array_equal(carried, expected)
+
+def test_segmented_daily_cumsum_cummax():
+    is_new_day = new_day_mask(DAY, INITIAL_DAY, GROUP_INDEX)
+    initial_yesterday = np.array([7.0, np.nan, -8.0])
+    def daily_sum(yesterday, i):
+        return yesterday + VALUES[i] if MASK[i] else yesterday
+
+    def daily_max(yesterday, i):
+        return max(VALUES[i], yesterday) if MASK[i] else yesterday
+
+    for kernel, step in [(segmented_daily_cumsum, daily_sum), (segmented_daily_cummax, daily_max)]:
+        expected_metric, expected_yesterday = [], []
+        for i in range(len(GROUP_INDEX)):
+            if i == 0 or GROUP_INDEX[i] != GROUP_INDEX[i-1]:
+                prev_metric, prev_yesterday = INITIAL[GROUP_INDEX[i]], initial_yesterday[GROUP_INDEX[i]]
+            expected_yesterday.append(prev_metric if is_new_day[i] else prev_yesterday)
+            expected_metric.append(step(expected_yesterday[-1], i))
+            prev_metric, prev_yesterday = expected_metric[-1], expected_yesterday[-1]
+        metric, yesterday = kernel(VALUES, INITIAL, initial_yesterday, is_new_day, GROUP_INDEX, mask=MASK)
+        np.testing.assert_array_equal(metric, expected_metric)
+        np.testing.assert_array_equal(yesterday, expected_yesterday)
+
+def test_segmented_is_stale():
+    deal_ids = np.array([5, 7, 6, 7, 3, 4, 4])
+    # Watermark 5 for group 0 and 3 for group 2, then every deal must be newer than the ones before it in the group
+    np.testing.assert_array_equal(segmented_is_stale(deal_ids, np.array([5, 0, 3]), GROUP_INDEX),
+                                  [True, False, True, True, True, False, True])
+
+def test_segmented_cumsum_adds_in_row_order():
+    # 1e16 + 1.0 rounds back to 1e16 one row at a time; a compensated sum would end at 1.0
+    values = np.array([1.0, -1e16, 0.0, 1.0, 2.0])
+    group_index = np.array([0, 0, 0, 1, 1])
+    np.testing.assert_array_equal(segmented_cumsum(values, np.array([1e16, 0.0]), group_index),
+                                  [1e16, 0.0, 0.0, 1.0, 3.0])
+
+def test_apply_groupby_mapping_of_metric_to_data():
+    deal = pd.read_csv("tests/test_data/mt5_deal.csv").sample(frac=1, random_state=0)
+    expected = {key: group.sort_values(["Time", "Deal"])
+                for key, group in deal.groupby(PositionMetricByDeal.Meta.groupby)}
+    mapping = apply_groupby_mapping_of_metric_to_data(PositionMetricByDeal, deal)
+    assert list(mapping.keys()) == list(expected.keys())
+    for key, group in expected.items():
+        pd.testing.assert_frame_equal(mapping[key], group)
+
+    # Already sorted input is used as is
+    sorted_deal, group_index = sort_by_group(deal, PositionMetricByDeal.Meta.groupby)
+    assert sort_by_group(sorted_deal, PositionMetricByDeal.Meta.groupby)[0] is sorted_deal
+    np.testing.assert_array_equal(group_index, np.sort(group_index))
+
+def test_deal_classifiers():
+    actions = np.array([action.value for action in EnDealAction])
+    entries = np.array([entry.value for entry in EnDealEntry])
+    classified = {is_trade: (actions, [EnDealAction.DEAL_BUY, EnDealAction.DEAL_SELL]),
+                  is_buy: (actions, [EnDealAction.DEAL_BUY]),
+                  is_sell: (actions, [EnDealAction.DEAL_SELL]),
+                  is_balance: (actions, [EnDealAction.DEAL_BALANCE]),
+                  is_non_trading_cashflow: (actions, [EnDealAction.DEAL_BALANCE, EnDealAction.DEAL_CREDIT,
+                                                      EnDealAction.DEAL_CORRECTION,
+                                                      EnDealAction.DEAL_SO_COMPENSATION]),
+                  is_gross_excluded: (actions, [EnDealAction.DEAL_BALANCE, EnDealAction.DEAL_CREDIT,
+                                                EnDealAction.DEAL_SO_COMPENSATION]),
+                  is_open: (entries, [EnDealEntry.ENTRY_IN]),
+                  is_close: (entries, [EnDealEntry.ENTRY_OUT, EnDealEntry.ENTRY_INOUT, EnDealEntry.ENTRY_OUT_BY])}
+    for classifier, (values, members) in classified.items():
+        expected = np.isin(values, [member.value for member in members])
+        np.testing.assert_array_equal(classifier(values), expected)
+        # Single deals take the plain Python path and get a plain bool back
+        assert [classifier(value) for value in values.tolist()] == expected.tolist()
+        assert all(type(classifier(value)) is bool for value in values[:2])
+    assert enum_value(EnDealAction.DEAL_SELL) == 1 and enum_value(np.int64(2)) == 2
+    # Out of range values are rejected like EnDealAction(99), not wrapped around the lookup table
+    for classifier, value in [(is_trade, 99), (is_balance, -1), (is_close, 4), (is_sell, np.int64(21)),
+                             (is_open, np.array([0, -2]))]:
+        with pytest.raises(ValueError, match="is not a valid"):
+            classifier(value)
+
+def test_decode_text():
+    text = pd.Series(["initialize", "deposit"])
+    assert decode_text(text) is text
+    pd.testing.assert_series_equal(decode_text(pd.Series([b"initialize", b"deposit"])), text)
+    assert decode_text(pd.Series(["initialize", b"deposit", None])).tolist() == ["initialize", "deposit", "None"]
+    assert decode_text(pd.Series([b"EURUSD", b"EURUSD"]), "category").dtype == "category"
+
+    data = pd.DataFrame({"Comment": [b"initialize"], "Symbol": ["EURUSD"], "Login": [1]})
+    decode_string_binary_column(MT5Deal, data)
+    assert data.to_dict("list") == {"Comment": ["initialize"], "Symbol": ["EURUSD"], "Login": [1]}
@@ -1,30 +1,47 @@
 import datetime
+import inspect
 import logging
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from unittest.mock import patch
+
+import numpy as np
 import pandas as pd
 
+from account_metrics import basic_deal_calculator
+from account_metrics.account_metric_by_day import AccountMetricDaily, AccountMetricDailyCalculator
+from account_metrics.account_metric_by_deal import AccountMetricByDeal, AccountMetricByDealCalculator
+from account_metrics.account_metrics import METRIC_CALCULATORS
+from account_metrics.account_symbol_metric_by_deal import (
+    AccountSymbolMetricByDeal,
+    AccountSymbolMetricByDealCalculator,
+)
+from account_metrics.fused_deal_calculator import FusedDealMetricCalculator
+from account_metrics.metric_model import as_metric_types, input_columns_of
 from account_metrics.mt5_deal import MT5Deal
+from account_metrics.mt5_deal.mt5_deal_data_calculator import MT5DealCalculator
 from account_metrics.mt5_deal_daily import MT5DealDaily
-from account_metrics.account_metric_by_day import AccountMetricDailyCalculator, AccountMetricDaily
-from account_metrics.account_metric_by_deal import AccountMetricByDealCalculator, AccountMetricByDeal
-from account_metrics.account_symbol_metric_by_deal import AccountSymbolMetricByDealCalculator, AccountSymbolMetricByDeal
-from account_metrics.position_metric_by_deal import PositionMetricByDealCalculator, PositionMetricByDeal
-from tests.conftest import MockDatastore, MockMetricRunner, extract_type_mapping, setup_string_column_type, strip_quotes_from_string_columns, TEST_DATAFRAME_PATH, get_metric_from_csv
-
-def get_deal(from_timestamp:datetime.date = None,to_timestamp:datetime.date = None):
-    return get_metric_from_csv(MT5Deal,TEST_DATAFRAME_PATH[MT5Deal])
-
-def get_history(from_timestamp:datetime.date = None,to_timestamp:datetime.date = None):
-    history = get_metric_from_csv(MT5DealDaily, TEST_DATAFRAME_PATH[MT5DealDaily])
-    history["Date"] = pd.to_datetime(history["Date"]).dt.date
-    if from_timestamp:
-        history = history[(history["timestamp_utc"] >= from_timestamp)]
-    if to_timestamp:
-        history = history[(history["timestamp_utc"] <= to_timestamp)]
-    return history 
+from account_metrics.position_metric_by_deal import PositionMetricByDeal, PositionMetricByDealCalculator
+from account_metrics.streaming_calculator import StreamingDealMetricCalculator
+from tests.conftest import (
+    TEST_DATAFRAME_PATH,
+    ExactLookupMockDatastore,
+    MockDatastore,
+    MockMetricRunner,
+    SingleRowMockDatastore,
+    extract_type_mapping,
+    get_deal,
+    get_history,
+    setup_string_column_type,
+    strip_quotes_from_string_columns,
+)
 
 logger = logging.getLogger(__name__)
 
+DEAL_CALCULATORS = [AccountMetricByDealCalculator, AccountMetricDailyCalculator, AccountSymbolMetricByDealCalculator,
+                    PositionMetricByDealCalculator]
+
 ################################################################## TESTS ##################################################################################
 def test_account_metric_by_day_calculation():
     AccountMetricDailyCalculator.set_metric_runner(MockMetricRunner(
@@ -111,6 +128,49 @@ def test_account_metric_by_day_calculation_2():
 
     pd.testing.assert_frame_equal(second_calculated_df[expected_second_df.columns], expected_second_df, check_dtype=True)
     
+def test_account_metric_by_day_vectorized_calculation():
+    AccountMetricDailyCalculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, get_history()),
+            AccountMetricDaily: MockDatastore(AccountMetricDaily, pd.DataFrame(columns=AccountMetricDaily.model_fields.keys()))
+        }
+    ))
+    deal = get_deal()
+    start_time = datetime.datetime.now()
+    calculated_df = AccountMetricDailyCalculator.calculate(deal, vectorized=True)
+    end_time = datetime.datetime.now()
+    elapsed_time = end_time - start_time
+    print("Elapsed time for AccountMetricDailyCalculator.calculate(vectorized=True): "
+          f"{elapsed_time.total_seconds()} seconds")
+    calculated_df = setup_string_column_type(calculated_df,AccountMetricDaily)
+
+    # Load the expected data from CSV
+    expected_df = pd.read_csv(TEST_DATAFRAME_PATH[AccountMetricDaily],dtype=extract_type_mapping(AccountMetricDaily))
+
+    # Adopt type and adjust expected different columns
+    expected_df['date'] = pd.to_datetime(expected_df['date']).dt.date
+    expected_df.rename(columns={"timestamp":"timestamp_utc"},inplace=True)
+
+    # Compare dataframes
+    pd.testing.assert_frame_equal(calculated_df[expected_df.columns],expected_df,check_dtype=True)
+
+def test_account_metric_by_day_vectorized_calculation_2(calculator_runner):
+    deal = get_deal()
+    first_retrieve_time = deal["timestamp_utc"].iloc[len(deal)//2-1]
+    first_retrieve_deal = deal[deal["timestamp_utc"] < first_retrieve_time]
+
+    # Both engines resume from their own first batch; the second batch replays already processed deals
+    calculated_dfs = []
+    for vectorized in [False, True]:
+        calculator_runner(AccountMetricDailyCalculator)
+        first_calculated_df = AccountMetricDailyCalculator.calculate(first_retrieve_deal, vectorized=vectorized)
+        AccountMetricDailyCalculator.get_metric_runner().get_datastore(AccountMetricDaily).put(first_calculated_df)
+        second_calculated_df = AccountMetricDailyCalculator.calculate(deal, vectorized=vectorized)
+        calculated_dfs.append((first_calculated_df, second_calculated_df))
+
+    pd.testing.assert_frame_equal(calculated_dfs[0][0], calculated_dfs[1][0], check_dtype=True)
+    pd.testing.assert_frame_equal(calculated_dfs[0][1], calculated_dfs[1][1], check_dtype=True)
+    
 def test_account_metric_by_deal_calculation():
     AccountMetricByDealCalculator.set_metric_runner(MockMetricRunner(
         {
@@ -197,6 +257,50 @@ def test_account_metric_by_deal_calculation_2():
 
     pd.testing.assert_frame_equal(second_calculated_df[expected_second_df.columns], expected_second_df, check_dtype=True)
 
+def test_account_metric_by_deal_vectorized_calculation():
+    AccountMetricByDealCalculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, get_history()),
+             AccountMetricByDeal:  MockDatastore(AccountMetricByDeal, pd.DataFrame(columns=AccountMetricByDeal.model_fields.keys()))
+        }
+    ))
+    deal = get_deal()
+    start_time = datetime.datetime.now()
+    calculated_df = AccountMetricByDealCalculator.calculate(deal, vectorized=True)
+    end_time = datetime.datetime.now()
+    elapsed_time = end_time - start_time
+    print("Elapsed time for AccountMetricByDealCalculator.calculate(vectorized=True): "
+          f"{elapsed_time.total_seconds()} seconds")
+    calculated_df = setup_string_column_type(calculated_df,AccountMetricByDeal)
+
+    # Load the expected data from CSV
+    expected_df = pd.read_csv(TEST_DATAFRAME_PATH[AccountMetricByDeal], dtype=extract_type_mapping(AccountMetricByDeal))
+
+    # Adopt type and adjust expected different columns
+    expected_df = strip_quotes_from_string_columns(expected_df)
+    expected_df['date'] = pd.to_datetime(expected_df['date']).dt.date
+    expected_df.rename(columns={"timestamp":"timestamp_utc"},inplace=True)
+
+    # Compare dataframes
+    pd.testing.assert_frame_equal(calculated_df[expected_df.columns],expected_df,check_dtype=True)
+
+def test_account_metric_by_deal_vectorized_calculation_2(calculator_runner):
+    deal = get_deal()
+    first_retrieve_time = deal["timestamp_utc"].iloc[len(deal)//2-1]
+    first_retrieve_deal = deal[deal["timestamp_utc"] < first_retrieve_time]
+
+    # Both engines resume from their own first batch; the second batch replays already processed deals
+    calculated_dfs = []
+    for vectorized in [False, True]:
+        calculator_runner(AccountMetricByDealCalculator)
+        first_calculated_df = AccountMetricByDealCalculator.calculate(first_retrieve_deal, vectorized=vectorized)
+        AccountMetricByDealCalculator.get_metric_runner().get_datastore(AccountMetricByDeal).put(first_calculated_df)
+        second_calculated_df = AccountMetricByDealCalculator.calculate(deal, vectorized=vectorized)
+        calculated_dfs.append((first_calculated_df, second_calculated_df))
+
+    pd.testing.assert_frame_equal(calculated_dfs[0][0], calculated_dfs[1][0], check_dtype=True)
+    pd.testing.assert_frame_equal(calculated_dfs[0][1], calculated_dfs[1][1], check_dtype=True)
+
 def test_account_symbol_metric_by_deal_calculation():
     AccountSymbolMetricByDealCalculator.set_metric_runner(MockMetricRunner(
         {
@@ -283,6 +387,27 @@ def test_account_symbol_metric_by_deal_calculation_2():
 
     pd.testing.assert_frame_equal(second_calculated_df[expected_second_df.columns], expected_second_df, check_dtype=True)
 
+def test_account_symbol_metric_by_deal_vectorized_calculation():
+    AccountSymbolMetricByDealCalculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, get_history()),
+             AccountSymbolMetricByDeal:  MockDatastore(AccountSymbolMetricByDeal, pd.DataFrame(columns=AccountSymbolMetricByDeal.model_fields.keys()))
+        }
+    ))
+
+    calculated_df = AccountSymbolMetricByDealCalculator.calculate(get_deal(), vectorized=True)
+    calculated_df = setup_string_column_type(calculated_df,AccountSymbolMetricByDeal)
+
+    # Load the expected data from CSV
+    expected_df = pd.read_csv('tests/test_data/account_symbol_metric_by_deal.csv', dtype=extract_type_mapping(AccountSymbolMetricByDeal))
+
+    # Adopt type and adjust expected different columns
+    expected_df = strip_quotes_from_string_columns(expected_df)
+    expected_df.rename(columns={"timestamp":"timestamp_utc"},inplace=True)
+
+    # Compare dataframes
+    pd.testing.assert_frame_equal(calculated_df[expected_df.columns],expected_df,check_dtype=True)
+
 def test_position_metric_by_deal_calculation():
     PositionMetricByDealCalculator.set_metric_runner(MockMetricRunner(
         {
@@ -373,3 +498,299 @@ def test_position_metric_by_deal_calculation_2():
     second_calculated_df.reset_index(drop=True, inplace=True)
 
     pd.testing.assert_frame_equal(second_calculated_df[expected_second_df.columns], expected_second_df, check_dtype=True)
+
+def test_position_metric_by_deal_vectorized_calculation():
+    PositionMetricByDealCalculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, get_history()),
+             PositionMetricByDeal:  MockDatastore(PositionMetricByDeal, pd.DataFrame(columns=PositionMetricByDeal.model_fields.keys()))
+        }
+    ))
+
+    calculated_df = PositionMetricByDealCalculator.calculate(get_deal(), vectorized=True)
+    calculated_df = setup_string_column_type(calculated_df,PositionMetricByDeal)
+
+    # Load the expected data from CSV
+    expected_df = pd.read_csv(TEST_DATAFRAME_PATH[PositionMetricByDeal], dtype=extract_type_mapping(PositionMetricByDeal))
+
+    # Adopt type and adjust expected different columns
+    expected_df = strip_quotes_from_string_columns(expected_df)
+    expected_df.rename(columns={"timestamp":"timestamp_utc"},inplace=True)
+
+    # Rearragne columns order and compare dataframes
+    pd.testing.assert_frame_equal(calculated_df[expected_df.columns],expected_df,check_dtype=True)
+
+def test_current_metrics_bulk_lookup(calculator_runner):
+    deal = get_deal()
+    first_retrieve_time = deal["timestamp_utc"].iloc[len(deal)//2-1]
+    first_retrieve_deal = deal[deal["timestamp_utc"] < first_retrieve_time]
+
+    calculated_dfs = []
+    for datastore_class in [MockDatastore, SingleRowMockDatastore]:
+        metric_runner = calculator_runner(AccountMetricByDealCalculator, datastore_class=datastore_class)
+        datastore = metric_runner.get_datastore(AccountMetricByDeal)
+        datastore.put(AccountMetricByDealCalculator.calculate(first_retrieve_deal))
+
+        # The bulk lookup replaces one get_latest_row round trip per login
+        with patch.object(datastore_class, "get_latest_row", wraps=datastore.get_latest_row) as get_latest_row:
+            calculated_dfs.append(AccountMetricByDealCalculator.calculate(deal))
+            calculated_dfs.append(AccountMetricByDealCalculator.calculate(deal, vectorized=True))
+        assert get_latest_row.call_count == (0 if datastore_class is MockDatastore else 2 * deal["login"].nunique())
+
+    for calculated_df in calculated_dfs[1:]:
+        pd.testing.assert_frame_equal(calculated_dfs[0], calculated_df, check_dtype=True)
+
+def test_yesterday_history_falls_back_to_earlier_day(calculator_runner):
+    deal = get_deal()
+    # Without the 2024-08-04 row, deals of 2024-08-05 take Balance/ProfitEquity of the last earlier day
+    history = get_history()
+    missing_day = (history["Login"] == 500387) & (history["Date"] == datetime.date(2024, 8, 4))
+    earlier_day = history[(history["Login"] == 500387) & (history["Date"] == datetime.date(2024, 8, 3))].iloc[-1]
+    deal_date = pd.to_datetime(deal["Time"], unit="s").dt.date
+    is_next_day = (deal["login"] == 500387) & (deal_date == datetime.date(2024, 8, 5))
+    assert missing_day.any() and is_next_day.any()
+
+    for calculator in [AccountMetricByDealCalculator, AccountMetricDailyCalculator]:
+        calculator_runner(calculator, history=history[~missing_day])
+        calculated_df = calculator.calculate(deal)
+        next_day_metric = calculated_df[calculated_df["deal_id"].isin(deal["Deal"][is_next_day])]
+        max_balance_equity = max(earlier_day["Balance"], earlier_day["ProfitEquity"])
+        assert not next_day_metric.empty and (next_day_metric["max_balance_equity"] == max_balance_equity).all()
+        pd.testing.assert_frame_equal(calculator.calculate(deal, vectorized=True), calculated_df, check_dtype=True)
+
+def test_fused_deal_metric_calculation(make_metric_runner):
+    deal = get_deal()
+    first_retrieve_time = deal["timestamp_utc"].iloc[len(deal)//2-1]
+
+    metric_runner = make_metric_runner(*[calculator.output_metric for calculator in DEAL_CALCULATORS])
+    FusedDealMetricCalculator.set_metric_runner(metric_runner)
+    first_deal = deal[deal["timestamp_utc"] < first_retrieve_time]
+    for metric, calculated_df in FusedDealMetricCalculator.calculate(first_deal).items():
+        metric_runner.get_datastore(metric).put(calculated_df)
+
+    # Same output as running every calculator on its own, seeded from the same stored metrics
+    fused_dfs = FusedDealMetricCalculator.calculate(deal)
+    assert list(fused_dfs.keys()) == [calculator.output_metric for calculator in DEAL_CALCULATORS]
+    for calculator in DEAL_CALCULATORS:
+        fused_df = fused_dfs[calculator.output_metric]
+        pd.testing.assert_frame_equal(fused_df, calculator.calculate(deal, vectorized=True), check_dtype=True)
+        pd.testing.assert_frame_equal(fused_df, calculator.calculate(deal), check_dtype=True)
+
+def test_parallel_calculation(calculator_runner):
+    deal = get_deal()
+    for calculator in DEAL_CALCULATORS:
+        calculator_runner(calculator)
+        for vectorized in [False, True]:
+            pd.testing.assert_frame_equal(calculator.calculate(deal, vectorized=vectorized, processes=3),
+                                          calculator.calculate(deal, vectorized=vectorized), check_dtype=True)
+
+def test_parallel_calculation_executor(monkeypatch):
+    deal = get_deal()
+    calculator = AccountMetricByDealCalculator
+    calculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, get_history()),
+            AccountMetricByDeal: MockDatastore(AccountMetricByDeal, AccountMetricByDeal.empty_frame())
+        }
+    ))
+    expected = calculator.calculate(deal, vectorized=True)
+    # The pool of the caller is reused by every call
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("fork")) as pool:
+        for _ in range(2):
+            result = calculator.calculate(deal, vectorized=True, processes=3, executor=pool)
+            pd.testing.assert_frame_equal(result, expected)
+
+    # Off the main thread no pool is forked, the batch is calculated serially
+    def fork_pool(*args, **kwargs):
+        raise AssertionError("pool forked off the main thread")
+    monkeypatch.setattr(basic_deal_calculator, "ProcessPoolExecutor", fork_pool)
+    with ThreadPoolExecutor(1) as threads:
+        result = threads.submit(calculator.calculate, deal, vectorized=True, processes=3).result()
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_yesterday_history_without_range_scans():
+    deal = get_deal()
+    # Days without a daily row are carried from the latest row of the lookback window, rows of another server with the
+    # same logins are ignored
+    history = get_history()
+    history = history.drop(history.index[::3])
+    history = pd.concat([history, history.assign(server="other", Balance=-1.0, ProfitEquity=-1.0)], ignore_index=True)
+    results = []
+    for datastore in [MockDatastore(MT5DealDaily, history), ExactLookupMockDatastore(MT5DealDaily, history)]:
+        AccountMetricDailyCalculator.set_metric_runner(MockMetricRunner(
+            {
+                MT5DealDaily: datastore,
+                AccountMetricDaily: MockDatastore(AccountMetricDaily, AccountMetricDaily.empty_frame())
+            }
+        ))
+        yesterday_history = AccountMetricDailyCalculator.get_yesterday_history(deal)
+        calculated = [AccountMetricDailyCalculator.calculate(deal, vectorized=flag) for flag in [False, True]]
+        results.append([yesterday_history, *calculated])
+    for range_scan_result, lookup_result in zip(*results, strict=True):
+        pd.testing.assert_frame_equal(range_scan_result, lookup_result, check_dtype=True)
+
+    yesterday_history = results[0][0]
+    assert not (yesterday_history["Balance"] == -1.0).any()
+    exact_dates = set(zip(history["Login"], history["Date"], strict=True))
+    yesterday_keys = zip(yesterday_history["login"], yesterday_history["yesterday"], strict=True)
+    is_exact = [(login, yesterday) in exact_dates for login, yesterday in yesterday_keys]
+    assert yesterday_history["Balance"].notna().sum() > sum(is_exact)
+
+def test_streaming_calculation(calculator_runner):
+    deal = get_deal()
+    batches = [deal.iloc[i:i+10] for i in range(0, len(deal), 10)]
+    for calculator in DEAL_CALCULATORS:
+        for vectorized in [False, True]:
+            calculator_runner(calculator)
+            expected_df = calculator.calculate(deal, vectorized=vectorized)
+            datastore = calculator.get_metric_runner().get_datastore(calculator.output_metric)
+            stream = StreamingDealMetricCalculator(calculator, vectorized=vectorized)
+
+            # Only keys seen for the first time are read from the datastore, rows are written at checkpoints
+            with patch.object(datastore, "get_latest_rows", wraps=datastore.get_latest_rows) as get_latest_rows:
+                calculated_dfs = list(stream.feed_stream(batches[:-1]))
+                calculated_dfs.append(stream.feed(batches[-1]))
+                assert len(datastore.data) == sum(len(df) for df in calculated_dfs[:-1])
+                stream.checkpoint()
+            new_keys = sum(len(get_latest_rows.call_args_list[i].args[0]) for i in range(get_latest_rows.call_count))
+            assert new_keys == deal.drop_duplicates(subset=calculator.output_metric.Meta.groupby).shape[0]
+
+            # Categories differ between batches, concat falls back to objects
+            calculated_df = as_metric_types(calculator.output_metric, pd.concat(calculated_dfs, ignore_index=True))
+            key_columns = calculator.output_metric.Meta.groupby_update_format
+            calculated_df = calculated_df.sort_values(key_columns, kind="stable", ignore_index=True)
+            pd.testing.assert_frame_equal(calculated_df, expected_df, check_dtype=False)
+            assert len(datastore.data) == len(expected_df)
+
+def test_validated_row_calculation(calculator_runner):
+    record = AccountMetricByDeal.record_class()()
+    assert record.model_dump() == AccountMetricByDeal().model_dump()
+    record.balance = 10.0
+    assert record["balance"] == 10.0 and record.values()[record.fields.index("balance")] == 10.0
+
+    deal = get_deal()
+    for calculator in DEAL_CALCULATORS:
+        calculator_runner(calculator)
+        expected_df = calculator.calculate(deal)
+        # Every row validates against the output model
+        with patch.object(calculator, "validate_rows", True):
+            pd.testing.assert_frame_equal(calculator.calculate(deal), expected_df, check_dtype=True)
+
+def test_output_dtypes(calculator_runner):
+    deal = get_deal()
+    assert AccountSymbolMetricByDeal.dtypes()["symbol"] == "category"
+    assert AccountMetricByDeal.dtypes()["date"] == "object"
+    for calculator in DEAL_CALCULATORS:
+        calculator_runner(calculator)
+        dtypes = calculator.output_metric.dtypes()
+        for calculated_df in [calculator.calculate(deal), calculator.calculate(deal, vectorized=True),
+                              calculator.calculate(deal.iloc[:0])]:
+            assert list(calculated_df.columns) == list(dtypes.keys())
+            assert calculated_df.dtypes.to_dict() == dtypes
+
+def test_program_id_tags(calculator_runner):
+    deal = get_deal()
+    login = deal["Login"].iloc[1]
+    rows = deal.index[deal["Login"] == login]
+    # Numeric tag on the initialize deal, then a later initialize comment with a non-numeric tag
+    deal["Comment"] = deal["Comment"].astype(object)
+    deal.loc[rows[0], "Comment"] = "initialize deposit PRG123"
+    deal.loc[rows[len(rows) // 2], "Comment"] = "initialize deposit PRGabc"
+    for vectorized in [False, True]:
+        calculator_runner(AccountMetricByDealCalculator)
+        calculated_df = AccountMetricByDealCalculator.calculate(deal, vectorized=vectorized)
+        program_id = calculated_df.loc[calculated_df["login"] == login, "program_id"]
+        assert program_id.dtype == "int64" and set(program_id.tolist()) == {123}
+
+def test_replayed_deals_are_dropped(calculator_runner):
+    deal = get_deal()
+    first_retrieve_deal = deal[deal["timestamp_utc"] < deal["timestamp_utc"].iloc[len(deal)//2-1]]
+    # Redelivery of the first half after a restart plus a duplicate of every deal of the second half
+    replayed_deal = pd.concat([deal, deal.drop(first_retrieve_deal.index)], ignore_index=True)
+    calculator = AccountMetricByDealCalculator
+    for vectorized in [False, True]:
+        metric_runner = calculator_runner(calculator)
+        metric_runner.get_datastore(AccountMetricByDeal).put(calculator.calculate(first_retrieve_deal,
+                                                                                  vectorized=vectorized))
+        expected_df, dropped_deals = calculator.calculate(deal, vectorized=vectorized, return_dropped=True)
+        assert dropped_deals == len(first_retrieve_deal)
+
+        calculated_df, dropped_deals = calculator.calculate(replayed_deal, vectorized=vectorized, return_dropped=True)
+        pd.testing.assert_frame_equal(calculated_df, expected_df, check_dtype=True)
+        assert dropped_deals == len(replayed_deal) - len(expected_df)
+        _, dropped_deals = calculator.calculate(replayed_deal, vectorized=vectorized, processes=2, return_dropped=True)
+        assert dropped_deals == len(replayed_deal) - len(expected_df)
+
+def test_binary_text_columns_are_decoded_once(calculator_runner):
+    deal = get_deal()
+    binary_deal = deal.assign(Comment=deal["Comment"].astype(object).map(str.encode),
+                              Symbol=deal["Symbol"].astype(object).map(str.encode))
+    for calculator in DEAL_CALCULATORS:
+        calculator_runner(calculator)
+        for vectorized in [False, True]:
+            pd.testing.assert_frame_equal(calculator.calculate(binary_deal, vectorized=vectorized),
+                                          calculator.calculate(deal, vectorized=vectorized), check_dtype=True)
+
+def test_identity_calculators_share_input_buffers():
+    deal = get_deal()
+    binary_deal = deal.assign(Comment=deal["Comment"].astype(object).map(str.encode))
+    calculated_df = METRIC_CALCULATORS[MT5Deal].calculate({"Deal": binary_deal}, None)
+    # Only the decoded column is new, the input is left untouched
+    assert isinstance(binary_deal["Comment"].iloc[0], bytes)
+    pd.testing.assert_frame_equal(calculated_df, deal, check_dtype=False)
+    assert np.shares_memory(calculated_df["Profit"].to_numpy(), binary_deal["Profit"].to_numpy())
+
+    renamed_df = MT5DealCalculator.calculate(deal)
+    assert "Login" not in renamed_df.columns and renamed_df["profit"].tolist() == deal["Profit"].tolist()
+    assert np.shares_memory(renamed_df["profit"].to_numpy(), deal["Profit"].to_numpy())
+
+def test_declared_input_columns(calculator_runner):
+    deal = get_deal()
+    for calculator in DEAL_CALCULATORS:
+        # Every column read as deal["..."] / deals["..."] / deal.... in the calculator module is declared, and nothing
+        # else
+        source = inspect.getsource(inspect.getmodule(calculator))
+        read_columns = set(re.findall(r'\bdeals?\["(\w+)"\]', source)) | set(re.findall(r"\bdeal\.([A-Z]\w*)", source))
+        assert read_columns == set(calculator.input_columns), calculator.__name__
+        assert set(calculator.get_input_columns()) <= set(MT5Deal.model_fields)
+
+        calculator_runner(calculator)
+        for vectorized in [False, True]:
+            pd.testing.assert_frame_equal(calculator.calculate(deal[calculator.get_input_columns()],
+                                                               vectorized=vectorized),
+                                          calculator.calculate(deal, vectorized=vectorized), check_dtype=True)
+
+    columns = input_columns_of(DEAL_CALCULATORS)
+    assert "MarketBid" not in columns
+    assert set(columns) == set().union(*[calculator.get_input_columns() for calculator in DEAL_CALCULATORS])
+
+def test_groupby_keys_are_isolated_across_servers(calculator_runner):
+    # The same logins and positions on a second server start from their own (empty) state, not from the stored demo
+    # metrics
+    deal = get_deal()
+    first_retrieve_deal = deal[deal["timestamp_utc"] < deal["timestamp_utc"].iloc[len(deal)//2-1]]
+    live_deal = deal.assign(server="live")
+    # Categories depend on the rows of the frame
+    def without_categories(df):
+        return df.astype({column: object for column in df.select_dtypes("category").columns}).reset_index(drop=True)
+    for calculator in [AccountMetricByDealCalculator, PositionMetricByDealCalculator]:
+        metric = calculator.output_metric
+        expected_dfs = {}
+        for server, deals, stored_deals in [("demo", deal, first_retrieve_deal), ("live", live_deal, None)]:
+            metric_runner = calculator_runner(calculator)
+            if stored_deals is not None:
+                metric_runner.get_datastore(metric).put(calculator.calculate(stored_deals))
+            expected_dfs[server] = without_categories(calculator.calculate(deals, vectorized=True))
+
+        for datastore_class in [MockDatastore, SingleRowMockDatastore]:
+            for vectorized in [False, True]:
+                metric_runner = calculator_runner(calculator, datastore_class=datastore_class)
+                metric_runner.get_datastore(metric).put(calculator.calculate(first_retrieve_deal))
+                stream = StreamingDealMetricCalculator(calculator, vectorized=vectorized)
+                batch = pd.concat([deal, live_deal], ignore_index=True)
+                calculated_df = pd.concat(list(stream.feed_stream([batch])), ignore_index=True)
+                latest_keys = calculated_df.drop_duplicates(subset=metric.Meta.groupby_update_format)
+                assert len(stream.state) == len(latest_keys)
+                for server, expected_df in expected_dfs.items():
+                    server_df = without_categories(calculated_df[calculated_df["server"] == server])
+                    pd.testing.assert_frame_equal(server_df, expected_df, check_dtype=True)
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from account_metrics.account_metric_by_deal import AccountMetricByDeal, AccountMetricByDealCalculator
+from account_metrics.mt5_deal import MT5Deal
+from account_metrics.mt5_deal_daily import MT5DealDaily
+from account_metrics.parquet_loader import arrow_schema, iter_parquet, read_parquet, write_parquet
+from tests.conftest import MockDatastore, MockMetricRunner
+from tests.test_metrics import get_deal, get_history
+
+
+def test_arrow_schema():
+    schema = arrow_schema(AccountMetricByDeal)
+    assert schema.names == list(AccountMetricByDeal.model_fields)
+    assert str(schema.field("login").type) == "int64" and str(schema.field("date").type) == "date32[day]"
+    assert str(schema.field("server").type) == "dictionary<values=string, indices=int32, ordered=0>"
+
+def test_parquet_round_trip(tmp_path):
+    deal = get_deal()
+    write_parquet(MT5Deal, deal, tmp_path / "deal.parquet", row_group_size=10)
+    pd.testing.assert_frame_equal(read_parquet(MT5Deal, tmp_path / "deal.parquet"),
+                                  deal[[column for column in MT5Deal.model_fields if column in deal.columns]],
+                                  check_dtype=False, check_categorical=False)
+
+    history = get_history()
+    write_parquet(MT5DealDaily, history, tmp_path / "history.parquet")
+    assert read_parquet(MT5DealDaily, tmp_path / "history.parquet")["Date"].tolist() == history["Date"].tolist()
+
+    AccountMetricByDealCalculator.set_metric_runner(MockMetricRunner(
+        {
+            MT5DealDaily: MockDatastore(MT5DealDaily, history),
+            AccountMetricByDeal: MockDatastore(AccountMetricByDeal,
+                                               pd.DataFrame(columns=AccountMetricByDeal.model_fields.keys()))
+        }
+    ))
+    calculated_df = AccountMetricByDealCalculator.calculate(deal, vectorized=True)
+    write_parquet(AccountMetricByDeal, calculated_df, tmp_path / "metric.parquet")
+    pd.testing.assert_frame_equal(read_parquet(AccountMetricByDeal, tmp_path / "metric.parquet"), calculated_df,
+                                  check_dtype=True)
+
+def test_parquet_filters_and_streaming(tmp_path):
+    deal = get_deal()
+    write_parquet(MT5Deal, deal, tmp_path / "deal.parquet", row_group_size=10)
+    logins = deal["login"].unique()[:2].tolist()
+    from_time, to_time = deal["Time"].quantile([0.25, 0.75]).astype("int64").tolist()
+    filters = {"login": logins, "server": deal["server"].iloc[0], "Time": (from_time, to_time)}
+    is_expected = deal["login"].isin(logins) & (deal["server"] == deal["server"].iloc[0])
+    expected = deal[is_expected & deal["Time"].between(from_time, to_time)]
+
+    filtered = read_parquet(MT5Deal, tmp_path / "deal.parquet", columns=["login", "Deal", "Time"], filters=filters)
+    assert filtered["Deal"].tolist() == expected["Deal"].tolist()
+    assert list(filtered.columns) == ["login", "Deal", "Time"]
+    batches = list(iter_parquet(MT5Deal, tmp_path / "deal.parquet", filters={"Time": (from_time, None)}, batch_size=5))
+    assert max(len(batch) for batch in batches) <= 5
+    assert pd.concat(batches)["Deal"].tolist() == deal[deal["Time"] >= from_time]["Deal"].tolist()
@@ -0,0 +1,92 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from account_metrics.account_metric_by_deal import AccountMetricByDealCalculator
+from account_metrics.metric_model import as_metric_types
+from account_metrics.mt5_deal import MT5Deal
+from account_metrics.mt5_deal_daily import MT5DealDaily
+from account_metrics.position_metric_by_deal import PositionMetricByDealCalculator
+from account_metrics.sqlite_datastore import SQLiteDatastore
+from tests.conftest import MockDatastore, get_deal, get_history
+
+
+def test_sqlite_datastore_lookups(tmp_path):
+    history = get_history()
+    path = str(tmp_path / "metrics.db")
+    datastore = SQLiteDatastore(MT5DealDaily, path)
+    for i in range(0, len(history), 50):
+        datastore.put(history.iloc[i:i+50])
+    datastore.close()
+
+    # Rows are read back from the file with the types of the model
+    datastore = SQLiteDatastore(MT5DealDaily, path)
+    assert len(datastore) == len(history) and datastore.data["Balance"].tolist() == history["Balance"].tolist()
+    assert datastore.data["Date"].tolist() == history["Date"].tolist()
+
+    login, date = history[["Login", "Date"]].iloc[-1]
+    expected = history[history["Login"] == login]
+    assert len(expected) > 1
+    assert datastore.get_latest_row({"Login": login})["Balance"] == expected["Balance"].iloc[-1]
+    assert datastore.get_latest_row({"Login": -1}) is None
+    expected_row = expected[expected["Date"] == date].iloc[-1]
+    assert datastore.get_row_by_timestamp({"Login": login}, date, "Date")["Balance"] == expected_row["Balance"]
+    assert datastore.get_row_by_timestamp({"Login": login}, datetime.date(1970, 1, 1), "Date") is None
+
+    from_date = history["Date"].min() + datetime.timedelta(days=1)
+    to_date = history["Date"].max() - datetime.timedelta(days=1)
+    logins = history["Login"].unique()[:2].tolist()
+    rows = datastore.get_rows_by_timestamp_range({"Login": logins}, from_date, to_date, "Date")
+    expected = history[history["Login"].isin(logins) & (history["Date"] >= from_date) & (history["Date"] <= to_date)]
+    assert rows["Balance"].tolist() == expected["Balance"].tolist()
+
+    # put upserts on Meta.key_columns (Login, Date)
+    datastore.put(pd.DataFrame({"Login": [login, -1], "Date": [date, date], "Balance": [-1.0, -2.0]}))
+    assert len(datastore) == len(history) + 1
+    assert datastore.get_row_by_timestamp({"Login": login}, date, "Date")["Balance"] == -1.0
+    keys = pd.DataFrame({"Login": [login, -1, -3]})
+    assert sorted(datastore.get_latest_rows(keys)["Balance"].tolist()) == [-2.0, -1.0]
+
+    # The latest row of a key is the last one written, also when an upsert updates an older row
+    first_date = history[history["Login"] == login]["Date"].iloc[0]
+    datastore.put(pd.DataFrame({"Login": [login], "Date": [first_date], "Balance": [-3.0]}))
+    assert datastore.get_latest_row({"Login": login})["Date"] == first_date
+    assert datastore.get_latest_rows(pd.DataFrame({"Login": [login]}))["Balance"].tolist() == [-3.0]
+    datastore.close()
+    assert SQLiteDatastore(MT5DealDaily, path).get_latest_row({"Login": login})["Balance"] == -3.0
+
+def test_sqlite_datastore_calculation(calculator_runner):
+    deal = get_deal()
+    first_retrieve_deal = deal[deal["timestamp_utc"] < deal["timestamp_utc"].iloc[len(deal)//2-1]]
+    for calculator in [AccountMetricByDealCalculator, PositionMetricByDealCalculator]:
+        calculated_dfs = []
+        for datastore_class in [MockDatastore, SQLiteDatastore]:
+            metric_runner = calculator_runner(calculator, datastore_class=datastore_class)
+            metric_runner.get_datastore(calculator.output_metric).put(calculator.calculate(first_retrieve_deal))
+            calculated_dfs.append(calculator.calculate(deal))
+            calculated_dfs.append(calculator.calculate(deal, vectorized=True))
+        for calculated_df in calculated_dfs[1:]:
+            pd.testing.assert_frame_equal(calculated_df, calculated_dfs[0], check_dtype=True)
+
+def test_sqlite_datastore_mt5_deal():
+    # MT5Deal has fields differing only by case (Login and login), stored in distinct columns
+    deal = get_deal()
+    datastore = SQLiteDatastore(MT5Deal, data=deal)
+    expected = as_metric_types(MT5Deal, deal[list(MT5Deal.model_fields)])
+    pd.testing.assert_frame_equal(datastore.data, expected, check_categorical=False)
+    login = deal["login"].iloc[-1]
+    assert datastore.get_latest_row({"login": login})["Deal"] == deal[deal["login"] == login]["Deal"].iloc[-1]
+
+def test_sqlite_datastore_threads():
+    # The datastore is read and written from worker threads (CalculatorScheduler),
+    # not only the thread that opened it
+    history = get_history()
+    datastore = SQLiteDatastore(MT5DealDaily)
+    logins = history["Login"].unique().tolist()
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(datastore.put, [history.iloc[i:i+10] for i in range(0, len(history), 10)]))
+        keys = [pd.DataFrame({"Login": [login]}) for login in logins * 4]
+        latest_rows = list(pool.map(datastore.get_latest_rows, keys))
+    assert len(datastore) == len(history)
+    assert [len(rows) for rows in latest_rows] == [1] * len(logins) * 4